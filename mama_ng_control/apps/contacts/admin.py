@@ -1,5 +1,6 @@
 from django.contrib import admin
 
-from .models import Contact
+from .models import Contact, ContactAddress
 # Register your models here.
 admin.site.register(Contact)
+admin.site.register(ContactAddress)
@@ -0,0 +1,97 @@
+"""
+Per-process cache of contact addresses.
+
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class ContactAddressCache(object):
+
+    """
+    LRU cache of Contact.address_map keyed by contact id and updated_at.
+
+    A contact that has been saved since its entry was cached has a newer
+    updated_at, so the stale entry is never returned.
+
+    :param int max_size:
+        Number of contacts to keep addresses for.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def address_map(self, contact):
+        """
+        Returns the contact's address_map, loading it only when this process
+        has not seen the contact at its current updated_at
+        """
+        with self.lock:
+            entry = self.entries.pop(contact.pk, None)
+            if entry is not None and entry[0] == contact.updated_at:
+                self.entries[contact.pk] = entry
+                self.hits += 1
+                contact._address_map = entry[1]
+                return entry[1]
+            self.misses += 1
+        address_map = contact.address_map
+        with self.lock:
+            self.entries[contact.pk] = (contact.updated_at, address_map)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return address_map
+
+    def preload(self, contacts):
+        """
+        Loads the address_map of every contact this process has not seen
+        at its current updated_at in one query
+        """
+        from .models import ContactAddress, group_addresses
+        missing = {}
+        with self.lock:
+            for contact in contacts:
+                entry = self.entries.get(contact.pk)
+                if entry is not None and entry[0] == contact.updated_at:
+                    contact._address_map = entry[1]
+                else:
+                    missing.setdefault(contact.pk, []).append(contact)
+        if not missing:
+            return
+        pairs = dict((contact_id, []) for contact_id in missing)
+        for contact_id, addr_type, addr_value in ContactAddress.objects.filter(
+                contact_id__in=list(missing)).order_by("id").values_list(
+                    "contact_id", "addr_type", "addr_value"):
+            pairs[contact_id].append((addr_type, addr_value))
+        with self.lock:
+            for contact_id, same_contact in missing.items():
+                address_map = group_addresses(pairs[contact_id])
+                for contact in same_contact:
+                    contact._address_map = address_map
+                self.entries.pop(contact_id, None)
+                self.entries[contact_id] = (same_contact[0].updated_at,
+                                            address_map)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def address(self, contact, addr_type=None):
+        """
+        Same as Contact.address but served from the cache
+        """
+        self.address_map(contact)
+        return contact.address(addr_type)
+
+    def discard(self, contact_id):
+        with self.lock:
+            self.entries.pop(contact_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+address_cache = ContactAddressCache(settings.CONTACT_ADDRESS_CACHE_SIZE)
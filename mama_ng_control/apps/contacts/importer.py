@@ -0,0 +1,130 @@
+"""
+Bulk loading of contacts from NDJSON or CSV streams.
+
+Rows are read lazily and written a chunk at a time with multi-row INSERTs,
+so memory use depends on the chunk size rather than the size of the file.
+"""
+import csv
+import json
+from itertools import islice
+
+from django.db import DatabaseError, transaction
+from rest_framework import serializers
+
+from .models import Contact, ContactAddress, parse_addresses
+
+
+def read_ndjson(lines):
+    """
+    Yields (row_number, details, error) for each line, where each line is
+    a contact as POSTed to the API, e.g. {"details": {"name": "Foo"}}
+    """
+    for row_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield row_number, None, ["Invalid JSON"]
+            continue
+        if not isinstance(row, dict) or "details" not in row:
+            yield row_number, None, ["Expected an object with details"]
+            continue
+        yield row_number, row["details"], None
+
+
+def read_csv(lines):
+    """
+    Yields (row_number, details, error) for each row, where the header row
+    names the details keys. Empty values are left out of details.
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        details = dict(
+            (key.decode("utf-8"), value.decode("utf-8"))
+            for key, value in row.items()
+            if key is not None and value)
+        yield reader.line_num, details, None
+
+
+READERS = {
+    "ndjson": read_ndjson,
+    "csv": read_csv,
+}
+
+
+class ContactImporter(object):
+
+    """
+    Validates and inserts contacts chunk by chunk, keeping a per-row report
+    of anything that could not be imported.
+
+    :param int chunk_size:
+        Number of rows to validate and insert per transaction.
+
+    :param int max_errors:
+        Number of row errors to keep for the report. Further errors are
+        still counted in ``failed``.
+    """
+
+    details_field = serializers.DictField(child=serializers.CharField())
+
+    def __init__(self, chunk_size=1000, max_errors=1000):
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+
+    def record_error(self, row_number, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row_number, "errors": errors})
+
+    def report(self):
+        return {
+            "created": self.created,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
+
+    def run(self, rows):
+        rows = iter(rows)
+        chunk = list(islice(rows, self.chunk_size))
+        while chunk:
+            self.load_chunk(chunk)
+            chunk = list(islice(rows, self.chunk_size))
+        return self.report()
+
+    def load_chunk(self, chunk):
+        contacts = []
+        addresses = []
+        row_numbers = []
+        for row_number, details, error in chunk:
+            if error is None:
+                try:
+                    details = self.details_field.run_validation(details)
+                except serializers.ValidationError as e:
+                    error = e.detail
+            if error is not None:
+                self.record_error(row_number, error)
+                continue
+            contact = Contact(details=details)
+            contacts.append(contact)
+            row_numbers.append(row_number)
+            addresses.extend(
+                ContactAddress(contact_id=contact.id, addr_type=addr_type,
+                               addr_value=addr_value)
+                for addr_type, addr_value in parse_addresses(
+                    details.get("addresses")))
+        if not contacts:
+            return
+        try:
+            with transaction.atomic():
+                Contact.objects.bulk_create(contacts)
+                ContactAddress.objects.bulk_create(addresses)
+        except DatabaseError as e:
+            for row_number in row_numbers:
+                self.record_error(row_number, [str(e)])
+            return
+        self.created += len(contacts)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from mama_ng_control.apps.contacts.models import Contact
+
+
+class Command(BaseCommand):
+
+    help = ("Populates the ContactAddress index from the addresses held in "
+            "each Contact's details")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of contacts to load per query')
+
+    def handle(self, *args, **options):
+        checked = 0
+        updated = 0
+        contacts = Contact.objects.order_by('id')
+        chunk = list(contacts[:options['chunk_size']])
+        while chunk:
+            for contact in chunk:
+                if contact.sync_addresses():
+                    updated += 1
+            checked += len(chunk)
+            self.stdout.write("Checked %s contacts, updated %s" % (
+                checked, updated))
+            chunk = list(contacts.filter(
+                id__gt=chunk[-1].id)[:options['chunk_size']])
+        self.stdout.write("Done. Checked %s contacts, updated %s" % (
+            checked, updated))
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mama_ng_control.apps.contacts.importer import ContactImporter, READERS
+
+
+class Command(BaseCommand):
+
+    help = "Creates contacts in bulk from an NDJSON or CSV file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import')
+        parser.add_argument(
+            '--file-type', choices=sorted(READERS),
+            help='Defaults to the extension of the file')
+        parser.add_argument(
+            '--chunk-size', type=int,
+            default=settings.CONTACT_IMPORT_CHUNK_SIZE,
+            help='Number of rows to insert per transaction')
+
+    def handle(self, *args, **options):
+        file_type = options['file_type'] or \
+            options['path'].rsplit('.', 1)[-1].lower()
+        if file_type not in READERS:
+            raise CommandError(
+                "Unknown file type %r, use --file-type" % (file_type,))
+        importer = ContactImporter(chunk_size=options['chunk_size'],
+                                   max_errors=0)
+        with open(options['path'], 'rb') as source:
+            rows = self.report_errors(READERS[file_type](source))
+            report = importer.run(rows)
+        self.stdout.write("Created %s contacts, %s rows failed" % (
+            report["created"], report["failed"]))
+
+    def report_errors(self, rows):
+        for row_number, details, error in rows:
+            if error is not None:
+                self.stderr.write("Row %s: %s" % (row_number, error))
+            yield row_number, details, error
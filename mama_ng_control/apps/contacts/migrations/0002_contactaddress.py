@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactAddress',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('addr_type', models.CharField(max_length=50)),
+                ('addr_value', models.CharField(max_length=255)),
+                ('contact', models.ForeignKey(related_name='addresses', to='contacts.Contact')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='contactaddress',
+            unique_together=set([('addr_type', 'addr_value', 'contact')]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contacts', '0002_contactaddress'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='contact',
+            index_together=set([('created_at', 'id')]),
+        ),
+    ]
@@ -4,11 +4,63 @@ from django.contrib.postgres.fields import HStoreField
 from django.db import models
 
 
+def parse_addresses(addresses):
+    """
+    Splits an addresses string into an ordered list of unique
+    (addr_type, addr_value) pairs, e.g.
+    "msisdn:+27001 email:foo@bar.com" ->
+        [("msisdn", "+27001"), ("email", "foo@bar.com")]
+    """
+    found = []
+    for address in (addresses or "").split():
+        parts = address.split(":", 1)
+        if len(parts) == 2 and parts[0] and parts[1] and \
+                tuple(parts) not in found:
+            found.append(tuple(parts))
+    return found
+
+
+def group_addresses(pairs):
+    """
+    Turns (addr_type, addr_value) pairs into a dict of addr_type to a tuple
+    of its values, keeping their order
+    """
+    grouped = {}
+    for addr_type, addr_value in pairs:
+        grouped.setdefault(addr_type, []).append(addr_value)
+    return dict((addr_type, tuple(values))
+                for addr_type, values in grouped.items())
+
+
 class ContactManager(models.Manager):
 
     def filter_by_addr(self, addr):
         # expects "addr_type:add" e.g. "msisdn:+123"
-        return self.filter(details__addresses__contains=addr)
+        addr_type, _, addr_value = addr.partition(":")
+        return self.filter(addresses__addr_type=addr_type,
+                           addresses__addr_value=addr_value)
+
+    def ids_by_addrs(self, addrs):
+        """
+        Resolves many "addr_type:addr_value" strings in one query, returning
+        a dict of each address to the list of matching contact ids
+        """
+        by_type = {}
+        found = {}
+        for addr in addrs:
+            addr_type, _, addr_value = addr.partition(":")
+            by_type.setdefault(addr_type, set()).add(addr_value)
+            found[addr] = []
+        if not by_type:
+            return found
+        query = models.Q()
+        for addr_type, addr_values in by_type.items():
+            query |= models.Q(addr_type=addr_type, addr_value__in=addr_values)
+        matches = ContactAddress.objects.filter(query).values_list(
+            "addr_type", "addr_value", "contact_id")
+        for addr_type, addr_value, contact_id in matches:
+            found["%s:%s" % (addr_type, addr_value)].append(str(contact_id))
+        return found
 
 
 class Contact(models.Model):
@@ -28,23 +80,87 @@ class Contact(models.Model):
 
     objects = ContactManager()
 
+    class Meta:
+        index_together = (('created_at', 'id'),)
+
+    def __init__(self, *args, **kwargs):
+        super(Contact, self).__init__(*args, **kwargs)
+        self._address_map = None
+
     def __str__(self):  # __unicode__ on Python 2
         return str(self.id)
 
+    def save(self, *args, **kwargs):
+        self._address_map = None
+        super(Contact, self).save(*args, **kwargs)
+
+    @property
+    def address_map(self):
+        """
+        addresses grouped by addr_type, e.g. {"msisdn": ("+27001",)},
+        loaded once per instance and dropped on save
+        """
+        if self._address_map is None:
+            self._address_map = group_addresses(
+                self.addresses.values_list("addr_type", "addr_value"))
+        return self._address_map
+
     def address(self, addr_type=None):
         """
         returns a list of all matches or empty list
         """
-        found = []
         if addr_type is None and "default_addr_type" in self.details:
             addr_type = self.details["default_addr_type"]
         elif addr_type is None and "default_addr_type" not in self.details:
             # fall back to sensible default
             addr_type = "msisdn"
-        if "addresses" in self.details:
-            addresses = self.details["addresses"].split()
-            for address in addresses:
-                parts = address.split(":")
-                if parts[0] == str(addr_type):
-                    found.append(parts[1])
-        return found
+        return list(self.address_map.get(str(addr_type), ()))
+
+    def sync_addresses(self):
+        """
+        Brings the ContactAddress rows in line with details["addresses"]
+        """
+        wanted = parse_addresses(self.details.get("addresses"))
+        existing = list(self.addresses.values_list("addr_type", "addr_value"))
+        self._address_map = group_addresses(wanted)
+        if existing == wanted:
+            return False
+        self.addresses.all().delete()
+        ContactAddress.objects.bulk_create([
+            ContactAddress(contact=self, addr_type=addr_type,
+                           addr_value=addr_value)
+            for addr_type, addr_value in wanted])
+        return True
+
+
+class ContactAddress(models.Model):
+
+    """
+    Indexed copy of the addr_type:addr_value pairs in Contact.details,
+    one row per address, kept in sync whenever the contact is saved
+    """
+    contact = models.ForeignKey(Contact,
+                                related_name='addresses',
+                                null=False)
+    addr_type = models.CharField(max_length=50, null=False, blank=False)
+    addr_value = models.CharField(max_length=255, null=False, blank=False)
+
+    class Meta:
+        ordering = ('id',)
+        unique_together = (('addr_type', 'addr_value', 'contact'),)
+
+    def __str__(self):  # __unicode__ on Python 2
+        return "%s:%s" % (self.addr_type, self.addr_value)
+
+# Keep the address index in step with details
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+
+from .cache import address_cache
+
+
+@receiver(post_save, sender=Contact)
+def sync_contact_addresses(sender, instance, **kwargs):
+    instance.sync_addresses()
+    address_cache.discard(instance.pk)
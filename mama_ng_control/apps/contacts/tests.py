@@ -1,13 +1,18 @@
 import json
+import tempfile
 
-from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
 from django.contrib.auth.models import User
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 
 
-from .models import Contact
+from .cache import ContactAddressCache
+from .models import Contact, ContactAddress
 
 
 class APITestCase(TestCase):
@@ -226,3 +231,250 @@ class TestContactsAPI(AuthenticatedAPITestCase):
         self.assertEqual(len(get.data["results"]), 1)
         self.assertEqual(get.data["results"][0]["details"]["name"],
                          "Test Name")
+
+    def test_create_contact_indexes_addresses(self):
+        post_contact = {
+            "details": {
+                "name": "Test Name",
+                "default_addr_type": "msisdn",
+                "addresses": "msisdn:+27123 msisdn:+27124 email:foo@bar.com"
+            }
+        }
+        response = self.client.post('/api/v1/contacts/',
+                                    json.dumps(post_contact),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        d = Contact.objects.get(pk=response.data["id"])
+        self.assertEqual(
+            list(d.addresses.values_list("addr_type", "addr_value")),
+            [("msisdn", "+27123"), ("msisdn", "+27124"),
+             ("email", "foo@bar.com")])
+        self.assertEqual(d.address(), ["+27123", "+27124"])
+        self.assertEqual(
+            list(Contact.objects.filter_by_addr("email:foo@bar.com")), [d])
+
+    def test_update_contact_reindexes_addresses(self):
+        existing = self.make_contact()
+        put_contact = {
+            "details": {
+                "name": "Test Changed",
+                "addresses": "msisdn:+27999"
+            }
+        }
+        response = self.client.put('/api/v1/contacts/%s/' % existing,
+                                   json.dumps(put_contact),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        d = Contact.objects.get(pk=existing)
+        self.assertEqual(d.address(), ["+27999"])
+        self.assertEqual(
+            Contact.objects.filter_by_addr("msisdn:+27999").count(), 1)
+
+    def test_search_matches_whole_address(self):
+        Contact.objects.create(details={
+            "name": "Test Name",
+            "addresses": "msisdn:+271234"
+        })
+        get = self.client.get('/api/v1/contacts/search/',
+                              {"msisdn": "+27123"},
+                              content_type='application/json')
+        self.assertEqual(get.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(get.data["results"]), 0)
+
+    def test_backfill_contact_addresses(self):
+        contact = Contact.objects.create(details={
+            "name": "Test Name",
+            "addresses": "msisdn:+27123 email:foo@bar.com"
+        })
+        ContactAddress.objects.all().delete()
+        self.assertEqual(Contact.objects.get(pk=contact.pk).address(), [])
+
+        stdout = StringIO()
+        call_command('backfill_contact_addresses', stdout=stdout)
+        contact = Contact.objects.get(pk=contact.pk)
+        self.assertEqual(contact.address(), ["+27123"])
+        self.assertEqual(contact.address("email"), ["foo@bar.com"])
+        self.assertIn("Checked 1 contacts, updated 1", stdout.getvalue())
+
+    def test_bulk_search(self):
+        first = Contact.objects.create(details={
+            "addresses": "msisdn:+27123 email:foo@bar.com"
+        })
+        second = Contact.objects.create(details={
+            "addresses": "msisdn:+27999 email:foo@bar.com"
+        })
+        post_search = {
+            "addresses": ["msisdn:+27123", "msisdn:+27999",
+                          "email:foo@bar.com", "msisdn:+27000"]
+        }
+        response = self.client.post('/api/v1/contacts/search/bulk',
+                                    json.dumps(post_search),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.data["results"]
+        self.assertEqual(results["msisdn:+27123"], [str(first.id)])
+        self.assertEqual(results["msisdn:+27999"], [str(second.id)])
+        self.assertEqual(sorted(results["email:foo@bar.com"]),
+                         sorted([str(first.id), str(second.id)]))
+        self.assertEqual(results["msisdn:+27000"], [])
+
+    def test_bulk_search_bad_addresses(self):
+        response = self.client.post('/api/v1/contacts/search/bulk',
+                                    json.dumps({"addresses": ["+27123"]}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["reason"],
+                         "Expected a list of addr_type:addr_value")
+
+    @override_settings(CONTACT_BULK_SEARCH_LIMIT=1)
+    def test_bulk_search_over_limit(self):
+        post_search = {
+            "addresses": ["msisdn:+27123", "msisdn:+27999"]
+        }
+        response = self.client.post('/api/v1/contacts/search/bulk',
+                                    json.dumps(post_search),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["reason"],
+                         "Too many addresses, limit is 1")
+
+    def test_import_contacts_ndjson(self):
+        lines = [
+            json.dumps({"details": {"name": "One",
+                                    "addresses": "msisdn:+27001"}}),
+            "not json",
+            json.dumps({"name": "No details"}),
+            "",
+            json.dumps({"details": {"name": "Two",
+                                    "addresses": "msisdn:+27002"}}),
+        ]
+        upload = SimpleUploadedFile("contacts.ndjson", "\n".join(lines))
+        response = self.client.post('/api/v1/contacts/import',
+                                    {"file": upload, "file_type": "ndjson"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(response.data["failed"], 2)
+        self.assertEqual(response.data["errors"], [
+            {"row": 2, "errors": ["Invalid JSON"]},
+            {"row": 3, "errors": ["Expected an object with details"]},
+        ])
+        self.assertEqual(
+            Contact.objects.filter_by_addr("msisdn:+27002").get()
+            .details["name"], "Two")
+
+    def test_import_contacts_csv(self):
+        upload = SimpleUploadedFile(
+            "contacts.csv",
+            "name,addresses\nOne,msisdn:+27001 email:one@bar.com\nTwo,\n")
+        response = self.client.post('/api/v1/contacts/import',
+                                    {"file": upload, "file_type": "csv"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 2)
+        self.assertEqual(response.data["failed"], 0)
+
+        d = Contact.objects.filter_by_addr("email:one@bar.com").get()
+        self.assertEqual(d.details["name"], "One")
+        self.assertEqual(d.address(), ["+27001"])
+        self.assertEqual(
+            Contact.objects.get(details__name="Two").details, {"name": "Two"})
+
+    def test_import_contacts_missing_file_type(self):
+        upload = SimpleUploadedFile("contacts.txt", "")
+        response = self.client.post('/api/v1/contacts/import',
+                                    {"file": upload})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["reason"],
+                         "Expected a file and a file_type of csv or ndjson")
+
+    def test_import_contacts_command(self):
+        source = tempfile.NamedTemporaryFile(suffix=".csv")
+        source.write("name,addresses\n")
+        for i in range(5):
+            source.write("Mother %s,msisdn:+2700%s\n" % (i, i))
+        source.flush()
+
+        stdout = StringIO()
+        call_command('import_contacts', source.name, chunk_size=2,
+                     stdout=stdout)
+        self.assertIn("Created 5 contacts, 0 rows failed", stdout.getvalue())
+        self.assertEqual(Contact.objects.count(), 5)
+        self.assertEqual(ContactAddress.objects.count(), 5)
+
+    def test_list_contacts_cursor(self):
+        created = [self.make_contact() for _ in range(5)]
+        seen = []
+        response = self.client.get('/api/v1/contacts/',
+                                   {"cursor": "", "page_size": 2})
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn("count", response.data)
+            self.assertLessEqual(len(response.data["results"]), 2)
+            seen.extend(c["id"] for c in response.data["results"])
+            if response.data["next"] is None:
+                break
+            response = self.client.get(response.data["next"])
+        ordered = Contact.objects.order_by("created_at", "id")
+        self.assertEqual(seen, [str(c.id) for c in ordered])
+        self.assertEqual(sorted(seen), sorted(created))
+
+    def test_list_contacts_invalid_cursor(self):
+        response = self.client.get('/api/v1/contacts/', {"cursor": "bogus"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_contacts_page_numbers_by_default(self):
+        self.make_contact()
+        response = self.client.get('/api/v1/contacts/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 1)
+
+    def test_address_map_is_memoized(self):
+        contact = Contact.objects.create(details={
+            "addresses": "msisdn:+27123 msisdn:+27124 email:foo@bar.com"
+        })
+        contact = Contact.objects.get(pk=contact.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(contact.address_map, {
+                "msisdn": ("+27123", "+27124"),
+                "email": ("foo@bar.com",),
+            })
+            self.assertEqual(contact.address(), ["+27123", "+27124"])
+            self.assertEqual(contact.address("email"), ["foo@bar.com"])
+
+    def test_address_map_reset_on_save(self):
+        contact = Contact.objects.create(details={
+            "addresses": "msisdn:+27123"
+        })
+        self.assertEqual(contact.address(), ["+27123"])
+        contact.details["addresses"] = "msisdn:+27999"
+        contact.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(contact.address(), ["+27999"])
+        self.assertEqual(Contact.objects.get(pk=contact.pk).address(),
+                         ["+27999"])
+
+    def test_address_cache(self):
+        cache = ContactAddressCache(max_size=1)
+        contact = Contact.objects.create(details={
+            "addresses": "msisdn:+27123"
+        })
+        loaded = Contact.objects.get(pk=contact.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.address(loaded), ["+27123"])
+        loaded = Contact.objects.get(pk=contact.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.address(loaded, "msisdn"), ["+27123"])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # a newer updated_at misses
+        contact.details["addresses"] = "msisdn:+27999"
+        contact.save()
+        self.assertEqual(
+            cache.address(Contact.objects.get(pk=contact.pk)), ["+27999"])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # least recently used contacts are evicted
+        other = Contact.objects.create(details={})
+        cache.address(other)
+        self.assertEqual(list(cache.entries), [other.pk])
@@ -10,6 +10,10 @@ router.register(r'contacts', views.ContactViewSet)
 urlpatterns = [
     url('^contacts/search/$',
         views.ContactSearchList.as_view()),
+    url('^contacts/search/bulk$',
+        views.ContactBulkSearch.as_view()),
+    url('^contacts/import$',
+        views.ContactImport.as_view()),
     url(r'^', include(router.urls)),
 
 ]
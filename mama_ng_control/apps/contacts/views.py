@@ -1,5 +1,10 @@
+from django.conf import settings
 from rest_framework import viewsets, generics
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
+from .importer import ContactImporter, READERS
 from .models import Contact
 from .serializers import ContactSerializer
 
@@ -24,9 +29,61 @@ class ContactSearchList(generics.ListAPIView):
         This view should return a list of all the contacts
         for the supplied msisdn
         """
-        contains = {
-            "addresses": "msisdn:%s" % self.request.query_params["msisdn"]
-        }
-        data = Contact.objects.filter(
-            details__contains=contains)
+        data = Contact.objects.filter_by_addr(
+            "msisdn:%s" % self.request.query_params["msisdn"])
         return data
+
+
+class ContactBulkSearch(APIView):
+
+    """
+    Looks up contacts for many addresses at once
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Expects {"addresses": ["msisdn:+27123", "email:foo@bar.com", ...]}
+        and returns the contact ids found for each address
+        """
+        addresses = request.data.get("addresses")
+        if not isinstance(addresses, list) or not all(
+                isinstance(addr, basestring) and ":" in addr
+                for addr in addresses):
+            return Response(
+                {"reason": "Expected a list of addr_type:addr_value"},
+                status=400)
+        if len(addresses) > settings.CONTACT_BULK_SEARCH_LIMIT:
+            return Response(
+                {"reason": "Too many addresses, limit is %s" % (
+                    settings.CONTACT_BULK_SEARCH_LIMIT,)},
+                status=400)
+        results = Contact.objects.ids_by_addrs(addresses)
+        return Response({"results": results}, status=200)
+
+
+class ContactImport(APIView):
+
+    """
+    Creates contacts in bulk from an uploaded NDJSON or CSV file
+    """
+    permission_classes = (IsAuthenticated,)
+    parser_classes = (MultiPartParser,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Expects a multipart "file" field and a "file_type" of csv or ndjson,
+        returns counts of created and failed rows with per-row errors
+        """
+        upload = request.data.get("file")
+        file_type = request.data.get("file_type")
+        if upload is None or file_type not in READERS:
+            return Response(
+                {"reason": "Expected a file and a file_type of %s" % (
+                    " or ".join(sorted(READERS)),)},
+                status=400)
+        importer = ContactImporter(
+            chunk_size=settings.CONTACT_IMPORT_CHUNK_SIZE,
+            max_errors=settings.CONTACT_IMPORT_MAX_ERRORS)
+        report = importer.run(READERS[file_type](upload))
+        return Response(report, status=201)
@@ -0,0 +1,10 @@
+from django.contrib import admin
+
+from .models import OutboxMessage
+
+
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('task_name', 'args', 'created_at', )
+    list_filter = ('task_name', 'created_at', )
+
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mama_ng_control.apps.outbox.models import OutboxMessage
+
+
+class Command(BaseCommand):
+
+    help = "Publishes committed outbox messages onto their Celery queues"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.OUTBOX_RELAY_BATCH_SIZE,
+            help='Number of messages to publish per transaction')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait when the outbox is empty')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once the outbox is empty')
+
+    def handle(self, *args, **options):
+        relayed = 0
+        while True:
+            count = OutboxMessage.objects.relay(options['batch_size'])
+            relayed += count
+            if count < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write("Relayed %s outbox messages" % relayed)
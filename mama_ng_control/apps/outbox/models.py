@@ -0,0 +1,81 @@
+import json
+
+from django.conf import settings
+from django.db import models, transaction
+
+from mama_ng_control.celery import app
+
+
+class OutboxManager(models.Manager):
+
+    def enqueue(self, task, *args):
+        """
+        Records a task call in the same transaction as the caller's writes.
+        Outside of a transaction the row is already committed, so it is
+        relayed straight away; otherwise the relay picks it up.
+        """
+        message = self.create(task_name=task.name, args=json.dumps(args))
+        if settings.OUTBOX_ALWAYS_RELAY or \
+                not transaction.get_connection().in_atomic_block:
+            self.publish([message])
+            message.delete()
+        return message
+
+    def enqueue_many(self, calls):
+        """
+        Records many (task, args) or (task, args, countdown) calls with one
+        INSERT. As with enqueue, outside of a transaction they are published
+        straight away. A countdown counts from when the call is published.
+        """
+        messages = [self.model(task_name=call[0].name,
+                               args=json.dumps(call[1]),
+                               countdown=call[2] if len(call) > 2 else 0)
+                    for call in calls]
+        if not messages:
+            return messages
+        if settings.OUTBOX_ALWAYS_RELAY or \
+                not transaction.get_connection().in_atomic_block:
+            self.publish(messages)
+        else:
+            self.bulk_create(messages)
+        return messages
+
+    def publish(self, messages):
+        with app.producer_or_acquire() as producer:
+            for message in messages:
+                app.tasks[message.task_name].apply_async(
+                    args=json.loads(message.args),
+                    countdown=message.countdown or None, producer=producer)
+
+    def relay(self, batch_size):
+        """
+        Publishes up to batch_size of the oldest messages and removes them.
+        Rows claimed by another relay are skipped rather than waited on.
+        Returns the number of messages published.
+        """
+        with transaction.atomic():
+            messages = list(self.raw(
+                "SELECT * FROM %s ORDER BY id LIMIT %%s "
+                "FOR UPDATE SKIP LOCKED" % self.model._meta.db_table,
+                [batch_size]))
+            if messages:
+                self.publish(messages)
+                self.filter(id__in=[m.id for m in messages]).delete()
+        return len(messages)
+
+
+class OutboxMessage(models.Model):
+
+    """
+    Task calls waiting to be published to Celery once the transaction that
+    recorded them has committed
+    """
+    task_name = models.CharField(max_length=255, null=False, blank=False)
+    args = models.TextField(null=False, blank=False)
+    countdown = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OutboxManager()
+
+    def __str__(self):  # __unicode__ on Python 2
+        return "%s %s" % (self.task_name, self.args)
@@ -0,0 +1,42 @@
+from celery.task import Task
+from celery.utils.log import get_task_logger
+from celery.exceptions import SoftTimeLimitExceeded
+
+from django.conf import settings
+
+logger = get_task_logger(__name__)
+
+from .models import OutboxMessage
+
+
+class Relay_Outbox(Task):
+
+    """
+    Task to publish committed outbox messages onto their Celery queues
+    """
+    name = "mama_ng_control.apps.outbox.tasks.relay_outbox"
+
+    def run(self, **kwargs):
+        """
+        Returns the number of messages relayed
+        """
+        l = self.get_logger(**kwargs)
+        relayed = 0
+        try:
+            for _ in range(settings.OUTBOX_RELAY_MAX_BATCHES):
+                count = OutboxMessage.objects.relay(
+                    settings.OUTBOX_RELAY_BATCH_SIZE)
+                relayed += count
+                if count < settings.OUTBOX_RELAY_BATCH_SIZE:
+                    break
+            l.info("Relayed %s outbox messages" % relayed)
+            return relayed
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing outbox relay \
+                 via Celery.',
+                exc_info=True)
+            return relayed
+
+relay_outbox = Relay_Outbox()
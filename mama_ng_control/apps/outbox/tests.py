@@ -0,0 +1,78 @@
+import json
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils.six import StringIO
+
+from go_http.send import LoggingSender
+
+from .models import OutboxMessage
+from .tasks import relay_outbox
+from mama_ng_control.apps.contacts.models import Contact
+from mama_ng_control.apps.vumimessages.models import Outbound
+from mama_ng_control.apps.vumimessages.tasks import Send_Message
+
+Send_Message.vumi_client = lambda x: LoggingSender('go_http.test')
+
+
+@override_settings(OUTBOX_ALWAYS_RELAY=False)
+class TestOutbox(TestCase):
+
+    def setUp(self):
+        self.contact = Contact.objects.create(details={
+            "default_addr_type": "msisdn",
+            "addresses": "msisdn:+27123"
+        })
+
+    def make_outbound(self):
+        return Outbound.objects.create(
+            contact=self.contact, content="Hello", metadata={})
+
+    def test_enqueue_in_transaction_waits_for_relay(self):
+        outbound = self.make_outbound()
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.task_name, Send_Message.name)
+        self.assertEqual(json.loads(message.args), [str(outbound.id)])
+        self.assertEqual(Outbound.objects.get(pk=outbound.pk).attempts, 0)
+
+    def test_enqueue_many(self):
+        outbounds = [self.make_outbound() for _ in range(2)]
+        OutboxMessage.objects.all().delete()
+        with self.assertNumQueries(1):
+            OutboxMessage.objects.enqueue_many(
+                [(Send_Message, [str(o.id)]) for o in outbounds])
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+        self.assertEqual(OutboxMessage.objects.relay(5), 2)
+
+    def test_enqueue_many_countdown(self):
+        outbound = self.make_outbound()
+        OutboxMessage.objects.all().delete()
+        OutboxMessage.objects.enqueue_many(
+            [(Send_Message, [str(outbound.id)], 30)])
+        self.assertEqual(OutboxMessage.objects.get().countdown, 30)
+        self.assertEqual(OutboxMessage.objects.relay(5), 1)
+
+    def test_relay(self):
+        outbounds = [self.make_outbound() for _ in range(3)]
+        self.assertEqual(OutboxMessage.objects.relay(2), 2)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+        self.assertEqual(OutboxMessage.objects.relay(2), 1)
+        self.assertEqual(OutboxMessage.objects.relay(2), 0)
+        for outbound in outbounds:
+            self.assertEqual(Outbound.objects.get(pk=outbound.pk).attempts, 1)
+
+    @override_settings(OUTBOX_RELAY_BATCH_SIZE=2)
+    def test_relay_outbox_task(self):
+        for _ in range(5):
+            self.make_outbound()
+        result = relay_outbox.delay()
+        self.assertEqual(result.get(), 5)
+        self.assertEqual(OutboxMessage.objects.count(), 0)
+        self.assertEqual(Outbound.objects.filter(attempts=1).count(), 5)
+
+    def test_relay_outbox_command(self):
+        self.make_outbound()
+        stdout = StringIO()
+        call_command('relay_outbox', once=True, stdout=stdout)
+        self.assertIn("Relayed 1 outbox messages", stdout.getvalue())
+        self.assertEqual(OutboxMessage.objects.count(), 0)
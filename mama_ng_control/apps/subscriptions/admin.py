@@ -1,5 +1,28 @@
 from django.contrib import admin
 
-from .models import Subscription
+from .models import (
+    BulkJob, Subscription, SubscriptionRollup, MessageContent)
+
+
+class MessageContentAdmin(admin.ModelAdmin):
+    list_display = ('messageset_id', 'sequence_number', 'lang',
+                    'contentstore_message_id', 'sync_version', 'synced_at', )
+    list_filter = ('messageset_id', 'lang', 'sync_version', )
+
+
+class BulkJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'action', 'status', 'total', 'processed', 'failed',
+                    'created_at', )
+    list_filter = ('action', 'status', )
+
+
+class SubscriptionRollupAdmin(admin.ModelAdmin):
+    list_display = ('day', 'messageset_id', 'lang', 'active', 'completed',
+                    'count', 'refreshed_at', )
+    list_filter = ('messageset_id', 'lang', 'active', 'completed', )
+
 # Register your models here.
 admin.site.register(Subscription)
+admin.site.register(MessageContent, MessageContentAdmin)
+admin.site.register(BulkJob, BulkJobAdmin)
+admin.site.register(SubscriptionRollup, SubscriptionRollupAdmin)
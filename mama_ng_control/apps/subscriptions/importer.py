@@ -0,0 +1,149 @@
+"""
+Bulk creation of subscriptions.
+
+Rows are written a chunk at a time with multi-row INSERTs. Nothing fires
+per row: each chunk queues schedule_create_bulk for its subscriptions, in
+the same transaction, so the scheduler is told about them in groups.
+"""
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from rest_framework import serializers
+
+from mama_ng_control.apps.contacts.models import Contact
+from mama_ng_control.apps.outbox.models import OutboxMessage
+from .models import Subscription
+from .tasks import schedule_create_bulk
+
+
+def read_ndjson(lines):
+    """
+    Yields (row_number, data, error) for each line, where each line is a
+    subscription with the contact id, e.g. {"contact": "<uuid>", ...}
+    """
+    for row_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield row_number, None, ["Invalid JSON"]
+            continue
+        yield row_number, row, None
+
+
+class BulkSubscriptionSerializer(serializers.Serializer):
+    contact = serializers.UUIDField()
+    messageset_id = serializers.IntegerField()
+    next_sequence_number = serializers.IntegerField(default=1)
+    lang = serializers.CharField(max_length=6)
+    active = serializers.BooleanField(default=True)
+    completed = serializers.BooleanField(default=False)
+    schedule = serializers.IntegerField(default=1)
+    process_status = serializers.IntegerField(default=0)
+    metadata = serializers.DictField(child=serializers.CharField(),
+                                     required=False)
+
+
+class SubscriptionImporter(object):
+
+    """
+    Validates and inserts subscriptions chunk by chunk, keeping a per-row
+    report of anything that could not be created.
+
+    :param int chunk_size:
+        Number of rows to validate and insert per transaction.
+
+    :param int max_errors:
+        Number of row errors to keep for the report. Further errors are
+        still counted in ``failed``.
+
+    :param bool register:
+        Queue schedule_create_bulk for each chunk. Otherwise the new ids are
+        kept in ``created_ids`` for the caller to register.
+    """
+
+    def __init__(self, chunk_size=1000, max_errors=1000, register=True):
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.register = register
+        self.created = 0
+        self.failed = 0
+        self.errors = []
+        self.created_ids = []
+
+    def record_error(self, row_number, errors):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row_number, "errors": errors})
+
+    def report(self):
+        return {
+            "created": self.created,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
+
+    def run(self, rows):
+        rows = iter(rows)
+        chunk = list(islice(rows, self.chunk_size))
+        while chunk:
+            self.load_chunk(chunk)
+            chunk = list(islice(rows, self.chunk_size))
+        return self.report()
+
+    def validate_chunk(self, chunk):
+        """
+        Returns [(row_number, validated_data)] for rows whose data is valid
+        and whose contact exists
+        """
+        checked = []
+        for row_number, data, error in chunk:
+            if error is None:
+                serializer = BulkSubscriptionSerializer(data=data)
+                if serializer.is_valid():
+                    data = serializer.validated_data
+                else:
+                    error = serializer.errors
+            checked.append((row_number, data, error))
+        contacts = set(Contact.objects.filter(
+            id__in=set(data["contact"] for _, data, error in checked
+                       if error is None)).values_list('id', flat=True))
+        valid = []
+        for row_number, data, error in checked:
+            if error is None and data["contact"] not in contacts:
+                error = {"contact": ["Unknown contact"]}
+            if error is not None:
+                self.record_error(row_number, error)
+                continue
+            valid.append((row_number, data))
+        return valid
+
+    def load_chunk(self, chunk):
+        rows = self.validate_chunk(chunk)
+        if not rows:
+            return
+        subscriptions = []
+        for _, data in rows:
+            data = dict(data)
+            data["contact_id"] = data.pop("contact")
+            data.setdefault("metadata", {})
+            subscriptions.append(Subscription(**data))
+        ids = [str(s.id) for s in subscriptions]
+        try:
+            with transaction.atomic():
+                Subscription.objects.bulk_create(subscriptions)
+                if self.register:
+                    size = settings.SUBSCRIPTION_BULK_SCHEDULE_CHUNK_SIZE
+                    for start in range(0, len(ids), size):
+                        OutboxMessage.objects.enqueue(
+                            schedule_create_bulk, ids[start:start + size])
+        except DatabaseError as e:
+            for row_number, _ in rows:
+                self.record_error(row_number, [str(e)])
+            return
+        self.created += len(subscriptions)
+        if not self.register:
+            self.created_ids.extend(ids)
@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mama_ng_control.apps.subscriptions.tasks import dispatch_subscriptions
+
+
+class Command(BaseCommand):
+
+    help = ("Sends due subscription messages when control is its own "
+            "scheduler engine. Several can run side by side.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.SUBSCRIPTION_DISPATCH_BATCH_SIZE,
+            help='Number of subscriptions to claim per transaction')
+        parser.add_argument(
+            '--interval', type=float, default=10.0,
+            help='Seconds to wait when nothing is due')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once nothing is due')
+
+    def handle(self, *args, **options):
+        dispatched = 0
+        while True:
+            count = dispatch_subscriptions.dispatch(options['batch_size'])
+            dispatched += count
+            if count < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write("Dispatched %s subscription sends" % dispatched)
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mama_ng_control.apps.subscriptions.importer import (
+    SubscriptionImporter, read_ndjson)
+from mama_ng_control.apps.subscriptions.tasks import schedule_create_bulk
+
+
+class Command(BaseCommand):
+
+    help = ("Creates subscriptions in bulk from an NDJSON file and creates "
+            "their schedules")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import')
+        parser.add_argument(
+            '--chunk-size', type=int,
+            default=settings.SUBSCRIPTION_IMPORT_CHUNK_SIZE,
+            help='Number of rows to insert per transaction')
+        parser.add_argument(
+            '--schedule-here', action='store_true',
+            help='Create the schedules in this process, reporting progress, '
+                 'instead of queueing schedule_create_bulk tasks')
+
+    def handle(self, *args, **options):
+        importer = SubscriptionImporter(
+            chunk_size=options['chunk_size'],
+            register=not options['schedule_here'])
+        with open(options['path'], 'rb') as source:
+            report = importer.run(read_ndjson(source))
+        for error in report["errors"]:
+            self.stderr.write("Row %s: %s" % (error["row"], error["errors"]))
+        self.stdout.write("Created %s subscriptions, %s rows failed" % (
+            report["created"], report["failed"]))
+        if options['schedule_here']:
+            registered = schedule_create_bulk.register(
+                importer.created_ids, progress=self.report_progress)
+            self.stdout.write("Scheduled %s subscriptions" % registered)
+
+    def report_progress(self, done, total):
+        self.stdout.write("Handled %s/%s subscriptions" % (done, total))
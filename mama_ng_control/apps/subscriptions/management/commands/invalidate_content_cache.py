@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from mama_ng_control.contentstore.cache import content_cache
+
+
+class Command(BaseCommand):
+
+    help = ("Drops cached Content Store lookups from the shared cache so "
+            "workers fetch fresh content")
+
+    def handle(self, *args, **options):
+        content_cache.invalidate_all()
+        self.stdout.write("Content cache invalidated")
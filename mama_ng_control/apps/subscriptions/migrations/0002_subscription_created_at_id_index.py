@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.contrib.postgres.fields.hstore
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subscription',
+            name='metadata',
+            field=django.contrib.postgres.fields.hstore.HStoreField(null=True, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='subscription',
+            index_together=set([('created_at', 'id')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0002_subscription_created_at_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageContent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('messageset_id', models.IntegerField()),
+                ('sequence_number', models.IntegerField()),
+                ('lang', models.CharField(max_length=6)),
+                ('contentstore_message_id', models.IntegerField()),
+                ('contentstore_updated_at', models.CharField(max_length=32, null=True, blank=True)),
+                ('text_content', models.TextField(null=True, blank=True)),
+                ('voice_speech_url', models.CharField(max_length=500, null=True, blank=True)),
+                ('sync_version', models.IntegerField(default=0, db_index=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='messagecontent',
+            unique_together=set([('messageset_id', 'sequence_number', 'lang')]),
+        ),
+    ]
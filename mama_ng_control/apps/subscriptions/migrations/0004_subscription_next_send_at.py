@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0003_messagecontent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='cron_definition',
+            field=models.CharField(max_length=100, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='next_send_at',
+            field=models.DateTimeField(db_index=True, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0004_subscription_next_send_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='frequency',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='scheduler_message_id',
+            field=models.CharField(db_index=True, max_length=100, null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='scheduler_schedule_id',
+            field=models.CharField(db_index=True, max_length=100, null=True, blank=True),
+        ),
+    ]
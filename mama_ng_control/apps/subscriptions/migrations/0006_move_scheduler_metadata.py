@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Moves the scheduler keys out of metadata into their own columns. Empty
+# ids, as left by scheduler acks, become NULL.
+FORWARDS = """
+UPDATE subscriptions_subscription SET
+    frequency = CASE WHEN metadata -> 'frequency' ~ '^[0-9]+$'
+                THEN (metadata -> 'frequency')::integer END,
+    scheduler_schedule_id = NULLIF(metadata -> 'scheduler_schedule_id', ''),
+    scheduler_message_id = NULLIF(metadata -> 'scheduler_message_id', ''),
+    metadata = metadata - ARRAY[
+        'frequency', 'scheduler_schedule_id', 'scheduler_message_id']
+WHERE metadata ?| ARRAY[
+    'frequency', 'scheduler_schedule_id', 'scheduler_message_id'];
+"""
+
+BACKWARDS = """
+UPDATE subscriptions_subscription SET
+    metadata = COALESCE(metadata, ''::hstore) || hstore(ARRAY[
+        'frequency', frequency::text,
+        'scheduler_schedule_id', scheduler_schedule_id,
+        'scheduler_message_id', COALESCE(scheduler_message_id, '')])
+WHERE frequency IS NOT NULL OR scheduler_schedule_id IS NOT NULL
+    OR scheduler_message_id IS NOT NULL;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0005_subscription_scheduler_columns'),
+    ]
+
+    operations = [
+        migrations.RunSQL(FORWARDS, BACKWARDS),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.contrib.postgres.fields
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0006_move_scheduler_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, serialize=False, editable=False, primary_key=True)),
+                ('action', models.CharField(max_length=20, choices=[(b'deactivate', b'Deactivate subscriptions'), (b'transition', b'Move subscriptions to another messageset')])),
+                ('subscriptions', django.contrib.postgres.fields.ArrayField(size=None, null=True, base_field=models.UUIDField(), blank=True)),
+                ('contacts', django.contrib.postgres.fields.ArrayField(size=None, null=True, base_field=models.UUIDField(), blank=True)),
+                ('messageset_id', models.IntegerField(null=True, blank=True)),
+                ('lang', models.CharField(max_length=6, null=True, blank=True)),
+                ('next_messageset_id', models.IntegerField(null=True, blank=True)),
+                ('next_schedule', models.IntegerField(null=True, blank=True)),
+                ('status', models.CharField(default=b'pending', max_length=20)),
+                ('total', models.IntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0007_bulkjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('day', models.DateField()),
+                ('messageset_id', models.IntegerField()),
+                ('lang', models.CharField(max_length=6)),
+                ('active', models.BooleanField()),
+                ('completed', models.BooleanField()),
+                ('count', models.IntegerField()),
+                ('refreshed_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='subscriptionrollup',
+            unique_together=set([('day', 'messageset_id', 'lang', 'active', 'completed')]),
+        ),
+    ]
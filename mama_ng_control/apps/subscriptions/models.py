@@ -1,9 +1,111 @@
 import uuid
 
-from django.contrib.postgres.fields import HStoreField
-from django.db import models
+from django.contrib.postgres.fields import ArrayField, HStoreField
+from django.db import connection, models, transaction
+from django.utils import timezone
 
 from mama_ng_control.apps.contacts.models import Contact
+from mama_ng_control.scheduler.cron import parse_cron
+
+
+class SubscriptionManager(models.Manager):
+
+    def record_sends(self, sends):
+        """
+        Applies many scheduler send triggers in one UPDATE. Expects
+        (subscription_id, send_counter, schedule_id, message_id) tuples and
+        returns (id, contact_id, messageset_id, next_sequence_number, lang)
+        for each subscription that was found.
+        """
+        sends = list(sends)
+        if not sends:
+            return []
+        values = ", ".join(["(%s::uuid, %s::integer, %s, %s)"] * len(sends))
+        params = [timezone.now()]
+        for send in sends:
+            params.extend(send)
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE %s AS s SET "
+            "next_sequence_number = v.send_counter, "
+            "scheduler_schedule_id = v.schedule_id, "
+            "scheduler_message_id = v.message_id, "
+            "updated_at = %%s "
+            "FROM (VALUES %s) AS v "
+            "(id, send_counter, schedule_id, message_id) "
+            "WHERE s.id = v.id "
+            "RETURNING s.id, s.contact_id, s.messageset_id, "
+            "s.next_sequence_number, s.lang" % (
+                self.model._meta.db_table, values),
+            params)
+        return cursor.fetchall()
+
+    def record_schedule_ids(self, schedules):
+        """
+        Stores many scheduler schedule ids in one UPDATE. Expects
+        (subscription_id, scheduler_schedule_id) tuples.
+        """
+        if not schedules:
+            return
+        values = ", ".join(["(%s::uuid, %s)"] * len(schedules))
+        params = [timezone.now()]
+        for schedule in schedules:
+            params.extend(schedule)
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE %s AS s SET "
+            "scheduler_schedule_id = v.scheduler_schedule_id, "
+            "updated_at = %%s "
+            "FROM (VALUES %s) AS v (id, scheduler_schedule_id) "
+            "WHERE s.id = v.id" % (self.model._meta.db_table, values),
+            params)
+
+    def claim_due(self, now, batch_size):
+        """
+        Advances up to batch_size active subscriptions whose next_send_at
+        has passed and returns create_message argument lists for them.
+        Rows locked by another dispatcher are skipped rather than waited on,
+        so call this inside the transaction that queues the messages.
+        A subscription that has sent its last message is completed.
+        Messages are triggered at the time they were due.
+        """
+        table = self.model._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT id, contact_id, messageset_id, next_sequence_number, "
+            "lang, cron_definition, frequency, next_send_at FROM %s "
+            "WHERE active AND NOT completed AND next_send_at <= %%s "
+            "ORDER BY next_send_at LIMIT %%s "
+            "FOR UPDATE SKIP LOCKED" % table,
+            [now, batch_size])
+        messages = []
+        updates = []
+        for (subscription_id, contact_id, messageset_id, sequence_number,
+             lang, cron_definition, frequency, due_at) in cursor.fetchall():
+            messages.append([str(contact_id), messageset_id, sequence_number,
+                             lang, str(subscription_id), 0,
+                             due_at.isoformat()])
+            if frequency and sequence_number >= frequency:
+                updates.extend([subscription_id, sequence_number, None, True])
+            else:
+                # skip sends missed while no dispatcher was running
+                updates.extend([
+                    subscription_id, sequence_number + 1,
+                    parse_cron(cron_definition).next_after(now), False])
+        if updates:
+            values = ", ".join(
+                ["(%s::uuid, %s::integer, %s::timestamptz, %s::boolean)"] *
+                len(messages))
+            cursor.execute(
+                "UPDATE %s AS s SET "
+                "next_sequence_number = v.next_sequence_number, "
+                "next_send_at = v.next_send_at, completed = v.completed, "
+                "updated_at = %%s "
+                "FROM (VALUES %s) AS v "
+                "(id, next_sequence_number, next_send_at, completed) "
+                "WHERE s.id = v.id" % (table, values),
+                [now] + updates)
+        return messages
 
 
 class Subscription(models.Model):
@@ -25,19 +127,202 @@ class Subscription(models.Model):
     schedule = models.IntegerField(default=1)
     process_status = models.IntegerField(default=0, null=False, blank=False)
     metadata = HStoreField(null=True, blank=True)
+    frequency = models.IntegerField(null=True, blank=True)
+    scheduler_schedule_id = models.CharField(max_length=100, null=True,
+                                             blank=True, db_index=True)
+    scheduler_message_id = models.CharField(max_length=100, null=True,
+                                            blank=True, db_index=True)
+    cron_definition = models.CharField(max_length=100, null=True, blank=True)
+    next_send_at = models.DateTimeField(null=True, blank=True, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = SubscriptionManager()
+
+    class Meta:
+        index_together = (('created_at', 'id'),)
+
     def __str__(self):  # __unicode__ on Python 2
         return str(self.id)
 
+
+class MessageContentManager(models.Manager):
+
+    def current_version(self):
+        return self.aggregate(
+            models.Max('sync_version'))['sync_version__max'] or 0
+
+    def stale(self):
+        """
+        Rows the latest sync did not see, e.g. removed from the content store
+        """
+        return self.filter(sync_version__lt=self.current_version())
+
+
+class MessageContent(models.Model):
+
+    """
+    Local copy of the content store message for each messageset,
+    sequence_number and lang, refreshed by the sync_message_content task
+    """
+    messageset_id = models.IntegerField(null=False, blank=False)
+    sequence_number = models.IntegerField(null=False, blank=False)
+    lang = models.CharField(max_length=6, null=False, blank=False)
+    contentstore_message_id = models.IntegerField(null=False, blank=False)
+    contentstore_updated_at = models.CharField(max_length=32, null=True,
+                                               blank=True)
+    text_content = models.TextField(null=True, blank=True)
+    voice_speech_url = models.CharField(max_length=500, null=True,
+                                        blank=True)
+    sync_version = models.IntegerField(default=0, db_index=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+    objects = MessageContentManager()
+
+    class Meta:
+        unique_together = (('messageset_id', 'sequence_number', 'lang'),)
+
+    def __str__(self):  # __unicode__ on Python 2
+        return "%s/%s/%s" % (self.messageset_id, self.sequence_number,
+                             self.lang)
+
+
+class BulkJob(models.Model):
+
+    """
+    A change applied to many active subscriptions at once, selected by
+    subscription, contact, messageset_id and lang. The subscriptions are
+    updated in one statement, then their scheduler schedules are cleaned
+    up in chunks which advance processed and failed.
+    """
+    DEACTIVATE = "deactivate"
+    TRANSITION = "transition"
+    ACTION_CHOICES = (
+        (DEACTIVATE, "Deactivate subscriptions"),
+        (TRANSITION, "Move subscriptions to another messageset"),
+    )
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    action = models.CharField(max_length=20, choices=ACTION_CHOICES)
+    subscriptions = ArrayField(models.UUIDField(), null=True, blank=True)
+    contacts = ArrayField(models.UUIDField(), null=True, blank=True)
+    messageset_id = models.IntegerField(null=True, blank=True)
+    lang = models.CharField(max_length=6, null=True, blank=True)
+    next_messageset_id = models.IntegerField(null=True, blank=True)
+    next_schedule = models.IntegerField(null=True, blank=True)
+    status = models.CharField(max_length=20, default=PENDING)
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):  # __unicode__ on Python 2
+        return "%s %s" % (self.action, self.id)
+
+    def selection(self):
+        """
+        The active subscriptions the job applies to
+        """
+        subscriptions = Subscription.objects.filter(active=True)
+        if self.subscriptions is not None:
+            subscriptions = subscriptions.filter(id__in=self.subscriptions)
+        if self.contacts is not None:
+            subscriptions = subscriptions.filter(contact_id__in=self.contacts)
+        if self.messageset_id is not None:
+            subscriptions = subscriptions.filter(
+                messageset_id=self.messageset_id)
+        if self.lang is not None:
+            subscriptions = subscriptions.filter(lang=self.lang)
+        return subscriptions
+
+    def changes(self):
+        """
+        The fields the action sets on each selected subscription
+        """
+        changes = {"next_send_at": None, "updated_at": timezone.now()}
+        if self.action == self.DEACTIVATE:
+            changes["active"] = False
+        else:
+            changes.update({
+                "messageset_id": self.next_messageset_id,
+                "next_sequence_number": 1,
+                "completed": False,
+                "frequency": None,
+                "scheduler_schedule_id": None,
+                "scheduler_message_id": None,
+                "cron_definition": None,
+            })
+            if self.next_schedule is not None:
+                changes["schedule"] = self.next_schedule
+        return changes
+
+
+class SubscriptionRollupManager(models.Manager):
+
+    def refresh(self):
+        """
+        Recounts subscriptions by day created, messageset_id, lang, active
+        and completed, replacing the previous counts in one transaction.
+        Returns the number of rollup rows.
+        """
+        table = self.model._meta.db_table
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM %s" % table)
+            cursor.execute(
+                "INSERT INTO %s (day, messageset_id, lang, active, "
+                "completed, count, refreshed_at) "
+                "SELECT (created_at AT TIME ZONE 'UTC')::date, messageset_id, "
+                "lang, active, completed, COUNT(*), %%s FROM %s "
+                "GROUP BY 1, 2, 3, 4, 5" % (
+                    table, Subscription._meta.db_table),
+                [timezone.now()])
+            return cursor.rowcount
+
+
+class SubscriptionRollup(models.Model):
+
+    """
+    Subscription counts kept up to date by the refresh_subscription_rollup
+    task, for dashboards
+    """
+    day = models.DateField()
+    messageset_id = models.IntegerField()
+    lang = models.CharField(max_length=6)
+    active = models.BooleanField()
+    completed = models.BooleanField()
+    count = models.IntegerField()
+    refreshed_at = models.DateTimeField()
+
+    objects = SubscriptionRollupManager()
+
+    class Meta:
+        unique_together = (
+            ('day', 'messageset_id', 'lang', 'active', 'completed'),)
+
+    def __str__(self):  # __unicode__ on Python 2
+        return "%s %s/%s: %s" % (self.day, self.messageset_id, self.lang,
+                                 self.count)
+
+
 # Make sure new subscriptions are created on scheduler
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from .tasks import schedule_create
+from mama_ng_control.apps.outbox.models import OutboxMessage
+from .tasks import schedule_create, apply_bulk_job
 
 
 @receiver(post_save, sender=Subscription)
 def fire_sub_action_if_new(sender, instance, created, **kwargs):
     if created:
-        schedule_create.delay(str(instance.id))
+        OutboxMessage.objects.enqueue(schedule_create, str(instance.id))
+
+
+@receiver(post_save, sender=BulkJob)
+def fire_job_if_new(sender, instance, created, **kwargs):
+    if created:
+        OutboxMessage.objects.enqueue(apply_bulk_job, str(instance.id))
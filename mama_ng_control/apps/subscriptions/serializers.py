@@ -1,4 +1,4 @@
-from .models import Subscription
+from .models import BulkJob, Subscription
 from rest_framework import serializers
 
 
@@ -10,4 +10,34 @@ class SubscriptionSerializer(serializers.HyperlinkedModelSerializer):
         fields = (
             'url', 'id', 'version', 'contact', 'messageset_id',
             'next_sequence_number', 'lang', 'active', 'completed', 'schedule',
-            'process_status', 'metadata', 'created_at', 'updated_at')
+            'process_status', 'metadata', 'frequency', 'scheduler_schedule_id',
+            'scheduler_message_id', 'next_send_at', 'created_at',
+            'updated_at')
+        read_only_fields = ('next_send_at',)
+
+
+class BulkJobSerializer(serializers.HyperlinkedModelSerializer):
+    subscriptions = serializers.ListField(child=serializers.UUIDField(),
+                                          required=False)
+    contacts = serializers.ListField(child=serializers.UUIDField(),
+                                     required=False)
+
+    class Meta:
+        model = BulkJob
+        fields = (
+            'url', 'id', 'action', 'subscriptions', 'contacts',
+            'messageset_id', 'lang', 'next_messageset_id', 'next_schedule',
+            'status', 'total', 'processed', 'failed', 'created_at',
+            'updated_at')
+        read_only_fields = ('status', 'total', 'processed', 'failed')
+
+    def validate(self, data):
+        selectors = ('subscriptions', 'contacts', 'messageset_id', 'lang')
+        if all(data.get(selector) is None for selector in selectors):
+            raise serializers.ValidationError(
+                "Expected subscriptions, contacts, messageset_id or lang")
+        if data["action"] == BulkJob.TRANSITION and \
+                data.get("next_messageset_id") is None:
+            raise serializers.ValidationError(
+                "Expected next_messageset_id for a transition")
+        return data
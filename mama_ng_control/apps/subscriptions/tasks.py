@@ -1,30 +1,47 @@
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
 from celery.task import Task
 from celery.utils.log import get_task_logger
 from celery.exceptions import SoftTimeLimitExceeded
-from client.messaging_contentstore.contentstore import ContentStoreApiClient
+from requests import HTTPError
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 
 logger = get_task_logger(__name__)
 
-from .models import Subscription
+from .models import (
+    BulkJob, Subscription, SubscriptionRollup, MessageContent)
+from mama_ng_control.apps.vumimessages.latency import (
+    parse_timestamp, record_latency)
 from mama_ng_control.apps.vumimessages.models import Outbound
 from mama_ng_control.apps.contacts.models import Contact
-from mama_ng_control.scheduler.client import SchedulerApiClient
-
-
-def contentstore_client():
-    return ContentStoreApiClient(
-        auth_token=settings.CONTENTSTORE_AUTH_TOKEN,
-        api_url=settings.CONTENTSTORE_API_URL)
+from mama_ng_control.contentstore.cache import (
+    CachedContentStoreApiClient, content_cache)
+from mama_ng_control.apps.outbox.models import OutboxMessage
+from mama_ng_control.circuit_breaker import CircuitOpenError
+from mama_ng_control.http_clients import contentstore_api, scheduler_api
+from mama_ng_control.scheduler.cron import CronError, parse_cron
 
 
-def scheduler_client():
-    return SchedulerApiClient(
-        username=settings.SCHEDULER_USERNAME,
-        password=settings.SCHEDULER_PASSWORD,
-        api_url=settings.SCHEDULER_URL)
+def content_from_message(message):
+    """
+    Builds an unsaved MessageContent from a content store message with its
+    binary content expanded
+    """
+    binary_content = message.get("binary_content") or {}
+    return MessageContent(
+        messageset_id=message["messageset"],
+        sequence_number=message["sequence_number"],
+        lang=message["lang"],
+        contentstore_message_id=message["id"],
+        contentstore_updated_at=message.get("updated_at"),
+        text_content=message.get("text_content"),
+        voice_speech_url=binary_content.get("content"))
 
 
 class Schedule_Create(Task):
@@ -42,15 +59,10 @@ class Schedule_Create(Task):
         """
 
     def contentstore_client(self):
-        return ContentStoreApiClient(
-            auth_token=settings.CONTENTSTORE_AUTH_TOKEN,
-            api_url=settings.CONTENTSTORE_API_URL)
+        return contentstore_api()
 
     def scheduler_client(self):
-        return SchedulerApiClient(
-            username=settings.SCHEDULER_USERNAME,
-            password=settings.SCHEDULER_PASSWORD,
-            api_url=settings.SCHEDULER_URL)
+        return scheduler_api()
 
     def schedule_to_cron(self, schedule):
         return "%s %s %s %s %s" % (
@@ -61,16 +73,29 @@ class Schedule_Create(Task):
             schedule["day_of_week"]
         )
 
+    def schedule_internally(self, subscription, cron_definition):
+        """
+        Stores the cron and first send time for the dispatcher instead of
+        creating a schedule on the scheduler. Returns the send time.
+        """
+        subscription.cron_definition = cron_definition
+        subscription.next_send_at = parse_cron(cron_definition).next_after(
+            timezone.now())
+        subscription.save()
+        return subscription.next_send_at.isoformat()
+
     def run(self, subscription_id, **kwargs):
         """
-        Returns scheduler-id
+        Returns scheduler-id, or the first send time when the internal
+        scheduler engine is used
         """
         l = self.get_logger(**kwargs)
         l.info("Creating schedule for <%s>" % (subscription_id,))
         try:
             subscription = Subscription.objects.get(pk=subscription_id)
             scheduler = self.scheduler_client()
-            contentstore = self.contentstore_client()
+            contentstore = CachedContentStoreApiClient(
+                self.contentstore_client(), content_cache)
             # get the subscription schedule/protocol from content store
             l.info("Loading contentstore schedule <%s>" % (
                 subscription.schedule,))
@@ -78,12 +103,17 @@ class Schedule_Create(Task):
             # get the messageset length for frequency
             messageset = contentstore.get_messageset_messages(
                 subscription.messageset_id)
-            subscription.metadata["frequency"] = \
-                str(len(messageset["messages"]))
+            subscription.frequency = len(messageset["messages"])
+            if settings.SCHEDULER_ENGINE == "internal":
+                next_send_at = self.schedule_internally(
+                    subscription, self.schedule_to_cron(csschedule))
+                l.info("Scheduled sub <%s> internally from <%s>" % (
+                    subscription_id, next_send_at))
+                return next_send_at
             # Build the schedule POST create object
             schedule = {
                 "subscriptionId": subscription_id,
-                "frequency": subscription.metadata["frequency"],
+                "frequency": str(subscription.frequency),
                 "sendCounter": subscription.next_sequence_number,
                 "cronDefinition": self.schedule_to_cron(csschedule),
                 "endpoint": "%s/subscriptions/%s/send" % (
@@ -92,13 +122,20 @@ class Schedule_Create(Task):
             result = scheduler.create_schedule(schedule)
             l.info("Created schedule <%s> on scheduler for sub <%s>" % (
                 result["id"], subscription_id))
-            subscription.metadata["scheduler_schedule_id"] = result["id"]
+            subscription.scheduler_schedule_id = result["id"]
             subscription.save()
             return result["id"]
 
         except ObjectDoesNotExist:
             logger.error('Missing Subscription', exc_info=True)
 
+        except CronError:
+            logger.error('Invalid schedule for Subscription', exc_info=True)
+
+        except CircuitOpenError as e:
+            l.info("Deferring schedule for <%s>: %s" % (subscription_id, e))
+            self.apply_async(args=[subscription_id], countdown=e.countdown())
+
         except SoftTimeLimitExceeded:
             logger.error(
                 'Soft time limit exceed processing schedule create \
@@ -108,6 +145,138 @@ class Schedule_Create(Task):
 schedule_create = Schedule_Create()
 
 
+class Schedule_Create_Bulk(Schedule_Create):
+
+    """
+    Task to tell scheduler about many new subscriptions, loading content
+    store data once per schedule and messageset
+    """
+    name = "mama_ng_control.apps.subscriptions.tasks.schedule_create_bulk"
+    calls_per_chunk = 100
+
+    def create_schedule(self, scheduler, schedule):
+        """
+        Returns (subscription_id, scheduler-id), with None if it failed
+        """
+        try:
+            return (schedule["subscriptionId"],
+                    str(scheduler.create_schedule(schedule)["id"]))
+        except Exception:
+            logger.error('Failed to create schedule for <%s>' % (
+                schedule["subscriptionId"],), exc_info=True)
+            return schedule["subscriptionId"], None
+
+    def register_group(self, scheduler, pool, members, cron, frequency,
+                       progress):
+        """
+        Creates schedules for (subscription_id, next_sequence_number)
+        members, calling the scheduler concurrently a chunk at a time.
+        Returns the number created.
+        """
+        schedules = [{
+            "subscriptionId": subscription_id,
+            "frequency": str(frequency),
+            "sendCounter": next_sequence_number,
+            "cronDefinition": cron,
+            "endpoint": "%s/subscriptions/%s/send" % (
+                settings.CONTROL_URL, subscription_id)
+        } for subscription_id, next_sequence_number in members]
+        registered = 0
+        for start in range(0, len(schedules), self.calls_per_chunk):
+            results = pool.map(
+                lambda schedule: self.create_schedule(scheduler, schedule),
+                schedules[start:start + self.calls_per_chunk])
+            created = [result for result in results if result[1] is not None]
+            Subscription.objects.record_schedule_ids(created)
+            registered += len(created)
+            progress(len(results))
+        return registered
+
+    def register(self, subscription_ids, progress=None):
+        """
+        Schedules those subscriptions that are not scheduled yet and
+        returns the number scheduled. progress is called with (done, total)
+        as subscriptions are handled.
+        """
+        groups = defaultdict(list)
+        for subscription_id, schedule, messageset_id, next_sequence_number \
+                in Subscription.objects.filter(
+                    id__in=subscription_ids,
+                    scheduler_schedule_id__isnull=True,
+                    cron_definition__isnull=True).values_list(
+                        'id', 'schedule', 'messageset_id',
+                        'next_sequence_number'):
+            groups[(schedule, messageset_id)].append(
+                (str(subscription_id), next_sequence_number))
+        total = sum(len(members) for members in groups.values())
+        state = {"done": 0}
+
+        def advance(count):
+            state["done"] += count
+            if progress is not None:
+                progress(state["done"], total)
+
+        internal = settings.SCHEDULER_ENGINE == "internal"
+        contentstore = CachedContentStoreApiClient(
+            self.contentstore_client(), content_cache)
+        scheduler = self.scheduler_client()
+        pool = ThreadPool(settings.SCHEDULER_CONCURRENCY)
+        registered = 0
+        try:
+            for (schedule, messageset_id), members in groups.items():
+                ids = [subscription_id for subscription_id, _ in members]
+                try:
+                    cron = self.schedule_to_cron(
+                        contentstore.get_schedule(schedule))
+                    frequency = len(contentstore.get_messageset_messages(
+                        messageset_id)["messages"])
+                    now = timezone.now()
+                    if internal:
+                        registered += Subscription.objects.filter(
+                            id__in=ids).update(
+                                frequency=frequency, cron_definition=cron,
+                                next_send_at=parse_cron(cron).next_after(
+                                    now),
+                                updated_at=now)
+                        advance(len(ids))
+                        continue
+                except (CronError, HTTPError):
+                    logger.error(
+                        'Failed to load schedule <%s> for messageset <%s>' % (
+                            schedule, messageset_id), exc_info=True)
+                    advance(len(ids))
+                    continue
+                Subscription.objects.filter(id__in=ids).update(
+                    frequency=frequency, updated_at=now)
+                registered += self.register_group(
+                    scheduler, pool, members, cron, frequency, advance)
+        finally:
+            pool.close()
+        return registered
+
+    def run(self, subscription_ids, **kwargs):
+        """
+        Returns the number of subscriptions scheduled
+        """
+        l = self.get_logger(**kwargs)
+        l.info("Creating schedules for %s subscriptions" % (
+            len(subscription_ids),))
+
+        def progress(done, total):
+            l.info("Handled %s/%s subscriptions" % (done, total))
+
+        try:
+            return self.register(subscription_ids, progress=progress)
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing bulk schedule create \
+                 via Celery.',
+                exc_info=True)
+
+schedule_create_bulk = Schedule_Create_Bulk()
+
+
 class Create_Message(Task):
 
     """
@@ -123,41 +292,73 @@ class Create_Message(Task):
         """
 
     def contentstore_client(self):
-        return ContentStoreApiClient(
-            auth_token=settings.CONTENTSTORE_AUTH_TOKEN,
-            api_url=settings.CONTENTSTORE_API_URL)
+        return contentstore_api()
+
+    def fetch_content(self, messageset_id, sequence_number, lang):
+        """
+        Returns an unsaved MessageContent from the content store, or None
+        """
+        contentstore = CachedContentStoreApiClient(
+            self.contentstore_client(), content_cache)
+        params = {
+            "messageset": messageset_id,
+            "sequence_number": sequence_number,
+            "lang": lang
+        }
+        # should only return one in a list
+        messages = contentstore.get_messages(params=params)
+        if len(messages) == 0:
+            return None
+        # it more than one matching message in Content store due to
+        # poor management then we just use first
+        return content_from_message(contentstore.get_message_content(
+            messages[0]["id"]))
 
     def run(self, contact_id, messageset_id, sequence_number, lang,
-            subscription, **kwargs):
+            subscription, generation=0, triggered_at=None, **kwargs):
         """
-        Returns success message
+        Returns success message. A message that already exists for the
+        subscription, sequence_number and generation is not created again,
+        pass a higher generation to deliberately send it again.
+        triggered_at is the ISO 8601 time the send was triggered.
         """
         l = self.get_logger(**kwargs)
         l.info("Creating Outbound Message and Content")
         try:
+            existing = Outbound.objects.filter(
+                subscription=subscription, sequence_number=sequence_number,
+                generation=generation).values_list('id', flat=True).first()
+            if existing is not None:
+                return "Message already created <%s>" % str(existing)
             contact = Contact.objects.get(pk=contact_id)
-            contentstore = self.contentstore_client()
-            params = {
-                "messageset": messageset_id,
-                "sequence_number": sequence_number,
-                "lang": lang
-            }
-            # should only return one in a list
-            messages = contentstore.get_messages(params=params)
-            if len(messages) > 0:
-                # it more than one matching message in Content store due to
-                # poor management then we just use first
-                message_id = messages[0]["id"]
-                message_details = contentstore.get_message_content(message_id)
-                # Create the message which will trigger send task
-                new_message = Outbound()
-                new_message.contact = contact
-                new_message.content = message_details["text_content"]
-                new_message.metadata = {}
-                new_message.metadata["voice_speech_url"] = \
-                    message_details["binary_content"]["content"]
-                new_message.metadata["subscription"] = subscription
-                new_message.save()
+            # prefer the synced local copy, falling back to the content store
+            content = MessageContent.objects.filter(
+                messageset_id=messageset_id, sequence_number=sequence_number,
+                lang=lang).first()
+            if content is None:
+                content = self.fetch_content(
+                    messageset_id, sequence_number, lang)
+            if content is not None:
+                metadata = {"subscription": subscription}
+                if content.voice_speech_url:
+                    metadata["voice_speech_url"] = content.voice_speech_url
+                # Create the message which will trigger send task, unless a
+                # concurrent trigger got there first
+                new_message, created = Outbound.objects.get_or_create(
+                    subscription=subscription,
+                    sequence_number=sequence_number,
+                    generation=generation,
+                    defaults={
+                        "contact": contact,
+                        "content": content.text_content,
+                        "metadata": metadata,
+                        "triggered_at": parse_timestamp(triggered_at),
+                    })
+                if not created:
+                    return "Message already created <%s>" % str(
+                        new_message.id)
+                record_latency("create", new_message.triggered_at,
+                               new_message.created_at)
                 return "New message created <%s>" % str(new_message.id)
             return "No message found for messageset <%s>, \
                     sequence_number <%s>, lang <%s>" % (
@@ -165,6 +366,13 @@ class Create_Message(Task):
         except ObjectDoesNotExist:
             logger.error('Missing Contact to message', exc_info=True)
 
+        except CircuitOpenError as e:
+            l.info("Deferring message for <%s>: %s" % (subscription, e))
+            self.apply_async(
+                args=[contact_id, messageset_id, sequence_number, lang,
+                      subscription, generation, triggered_at],
+                countdown=e.countdown())
+
         except SoftTimeLimitExceeded:
             logger.error(
                 'Soft time limit exceed processing message creation task \
@@ -172,3 +380,310 @@ class Create_Message(Task):
                 exc_info=True)
 
 create_message = Create_Message()
+
+
+class Create_Messages(Task):
+
+    """
+    Task to create and populate a chunk of messages with content
+    """
+    name = "mama_ng_control.apps.subscriptions.tasks.create_messages"
+
+    def run(self, messages, **kwargs):
+        """
+        Expects a list of create_message argument lists, returns the number
+        of messages processed
+        """
+        l = self.get_logger(**kwargs)
+        l.info("Creating %s Outbound Messages" % len(messages))
+        for message in messages:
+            try:
+                create_message.run(*message)
+            except Exception:
+                logger.error('Failed to create message for subscription '
+                             '<%s>' % message[4], exc_info=True)
+        return len(messages)
+
+create_messages = Create_Messages()
+
+
+class Invalidate_Content_Cache(Task):
+
+    """
+    Task to drop cached Content Store lookups after content changes
+    """
+    name = "mama_ng_control.apps.subscriptions.tasks.invalidate_content_cache"
+
+    def run(self, method=None, args=(), **kwargs):
+        """
+        Drops one lookup, e.g. method="get_schedule", args=[1], or
+        everything when no method is given
+        """
+        l = self.get_logger(**kwargs)
+        if method is None:
+            content_cache.invalidate_all()
+            l.info("Invalidated all cached content")
+        else:
+            content_cache.invalidate(method, *args)
+            l.info("Invalidated cached content for %s%r" % (method, args))
+        return True
+
+invalidate_content_cache = Invalidate_Content_Cache()
+
+
+class Sync_Message_Content(Task):
+
+    """
+    Task to refresh the local MessageContent copy from the content store
+    """
+    name = "mama_ng_control.apps.subscriptions.tasks.sync_message_content"
+
+    def contentstore_client(self):
+        return contentstore_api()
+
+    def sync_messageset(self, contentstore, messageset_id, version):
+        """
+        Returns the number of rows fetched and written. Messages whose id
+        and updated_at match the local row are only stamped with version.
+        """
+        existing = dict(
+            ((row.sequence_number, row.lang), row)
+            for row in MessageContent.objects.filter(
+                messageset_id=messageset_id))
+        unchanged = []
+        written = 0
+        for message in contentstore.get_messages(
+                params={"messageset": messageset_id}):
+            if message["messageset"] != messageset_id:
+                continue
+            row = existing.get((message["sequence_number"], message["lang"]))
+            if row is not None and \
+                    row.contentstore_message_id == message["id"] and \
+                    row.contentstore_updated_at == message["updated_at"]:
+                unchanged.append(row.id)
+                continue
+            content = content_from_message(
+                contentstore.get_message_content(message["id"]))
+            content.sync_version = version
+            if row is not None:
+                content.id = row.id
+            content.save()
+            written += 1
+        MessageContent.objects.filter(id__in=unchanged).update(
+            sync_version=version)
+        return written
+
+    def run(self, **kwargs):
+        """
+        Returns the number of rows fetched and written
+        """
+        l = self.get_logger(**kwargs)
+        l.info("Syncing message content")
+        try:
+            contentstore = self.contentstore_client()
+            version = MessageContent.objects.current_version() + 1
+            written = 0
+            for messageset in contentstore.get_messagesets():
+                written += self.sync_messageset(
+                    contentstore, messageset["id"], version)
+            if written:
+                content_cache.invalidate_all()
+            l.info("Synced message content version <%s>, %s rows written" % (
+                version, written))
+            return written
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing message content sync \
+                 via Celery.',
+                exc_info=True)
+
+sync_message_content = Sync_Message_Content()
+
+
+class Dispatch_Subscriptions(Task):
+
+    """
+    Task to send due subscription messages when control is its own
+    scheduler engine
+    """
+    name = "mama_ng_control.apps.subscriptions.tasks.dispatch_subscriptions"
+
+    def dispatch(self, batch_size):
+        """
+        Claims one batch of due subscriptions and queues their messages in
+        the same transaction. Returns the number of subscriptions sent.
+        """
+        chunk_size = settings.SUBSCRIPTION_SEND_BATCH_CHUNK_SIZE
+        with transaction.atomic():
+            messages = Subscription.objects.claim_due(
+                timezone.now(), batch_size)
+            for start in range(0, len(messages), chunk_size):
+                OutboxMessage.objects.enqueue(
+                    create_messages, messages[start:start + chunk_size])
+        return len(messages)
+
+    def run(self, **kwargs):
+        """
+        Returns the number of subscriptions sent
+        """
+        l = self.get_logger(**kwargs)
+        dispatched = 0
+        try:
+            for _ in range(settings.SUBSCRIPTION_DISPATCH_MAX_BATCHES):
+                count = self.dispatch(
+                    settings.SUBSCRIPTION_DISPATCH_BATCH_SIZE)
+                dispatched += count
+                if count < settings.SUBSCRIPTION_DISPATCH_BATCH_SIZE:
+                    break
+            l.info("Dispatched %s subscription sends" % dispatched)
+            return dispatched
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing subscription dispatch \
+                 via Celery.',
+                exc_info=True)
+            return dispatched
+
+dispatch_subscriptions = Dispatch_Subscriptions()
+
+
+class Apply_Bulk_Job(Task):
+
+    """
+    Task to apply a bulk job to its subscriptions and queue the scheduler
+    clean up
+    """
+    name = "mama_ng_control.apps.subscriptions.tasks.apply_bulk_job"
+
+    def run(self, job_id, **kwargs):
+        """
+        Returns the number of subscriptions changed
+        """
+        l = self.get_logger(**kwargs)
+        chunk_size = settings.SUBSCRIPTION_BULK_SCHEDULE_CHUNK_SIZE
+        try:
+            with transaction.atomic():
+                job = BulkJob.objects.select_for_update().get(
+                    pk=job_id, status=BulkJob.PENDING)
+                subscriptions = job.selection().select_for_update()
+                rows = [
+                    [str(subscription_id), schedule_id, message_id]
+                    for subscription_id, schedule_id, message_id
+                    in subscriptions.values_list(
+                        'id', 'scheduler_schedule_id',
+                        'scheduler_message_id')]
+                job.selection().update(**job.changes())
+                job.total = len(rows)
+                job.status = BulkJob.RUNNING if rows else BulkJob.DONE
+                job.save()
+                for start in range(0, len(rows), chunk_size):
+                    OutboxMessage.objects.enqueue(
+                        process_bulk_job_chunk, job_id,
+                        rows[start:start + chunk_size])
+            l.info("Applied %s to %s subscriptions" % (job.action, len(rows)))
+            return len(rows)
+
+        except ObjectDoesNotExist:
+            logger.error('Missing or already applied BulkJob', exc_info=True)
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing bulk job \
+                 via Celery.',
+                exc_info=True)
+
+apply_bulk_job = Apply_Bulk_Job()
+
+
+class Process_Bulk_Job_Chunk(Task):
+
+    """
+    Task to remove the old scheduler schedules for a chunk of a bulk job's
+    subscriptions, and schedule transitioned ones again
+    """
+    name = "mama_ng_control.apps.subscriptions.tasks.process_bulk_job_chunk"
+
+    def scheduler_client(self):
+        return scheduler_api()
+
+    def delete_schedule(self, scheduler, row):
+        """
+        Returns True if the schedule, and its pending message, were deleted
+        """
+        subscription_id, schedule_id, message_id = row
+        try:
+            # schedule messages must be deleted before the schedule
+            if message_id:
+                scheduler.delete_message(message_id)
+            scheduler.delete_schedule(schedule_id)
+            return True
+        except Exception:
+            logger.error('Failed to delete schedule <%s> for <%s>' % (
+                schedule_id, subscription_id), exc_info=True)
+            return False
+
+    def run(self, job_id, rows, **kwargs):
+        """
+        Expects [subscription_id, scheduler_schedule_id,
+        scheduler_message_id] rows, returns the number that failed
+        """
+        l = self.get_logger(**kwargs)
+        job = BulkJob.objects.get(pk=job_id)
+        cleared = [row[0] for row in rows if not row[1]]
+        scheduled = [row for row in rows if row[1]]
+        if scheduled:
+            scheduler = self.scheduler_client()
+            pool = ThreadPool(settings.SCHEDULER_CONCURRENCY)
+            try:
+                deleted = pool.map(
+                    lambda row: self.delete_schedule(scheduler, row),
+                    scheduled)
+            finally:
+                pool.close()
+            cleared.extend(
+                row[0] for row, ok in zip(scheduled, deleted) if ok)
+        failed = len(rows) - len(cleared)
+        if job.action == BulkJob.TRANSITION and cleared:
+            # only schedule again once the old schedule is gone
+            failed += len(cleared) - schedule_create_bulk.register(cleared)
+        BulkJob.objects.filter(pk=job_id).update(
+            processed=F('processed') + len(rows),
+            failed=F('failed') + failed,
+            updated_at=timezone.now())
+        BulkJob.objects.filter(
+            pk=job_id, status=BulkJob.RUNNING,
+            processed__gte=F('total')).update(status=BulkJob.DONE)
+        l.info("Processed %s subscriptions for %s job <%s>, %s failed" % (
+            len(rows), job.action, job_id, failed))
+        return failed
+
+process_bulk_job_chunk = Process_Bulk_Job_Chunk()
+
+
+class Refresh_Subscription_Rollup(Task):
+
+    """
+    Task to recount subscriptions for the rollup endpoint
+    """
+    name = "mama_ng_control.apps.subscriptions.tasks." \
+        "refresh_subscription_rollup"
+
+    def run(self, **kwargs):
+        """
+        Returns the number of rollup rows
+        """
+        l = self.get_logger(**kwargs)
+        try:
+            rows = SubscriptionRollup.objects.refresh()
+            l.info("Refreshed subscription rollup, %s rows" % rows)
+            return rows
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing subscription rollup \
+                 via Celery.',
+                exc_info=True)
+
+refresh_subscription_rollup = Refresh_Subscription_Rollup()
@@ -1,27 +1,41 @@
 import json
 import uuid
 import logging
+import tempfile
+import threading
 import responses
+from datetime import datetime, timedelta
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.management import call_command
 from django.db.models.signals import post_save
+from django.utils import timezone
 
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 
 
-from .models import Subscription, fire_sub_action_if_new
+from .models import (
+    BulkJob, Subscription, SubscriptionRollup, MessageContent,
+    fire_sub_action_if_new)
 from mama_ng_control.apps.contacts.models import Contact
 from mama_ng_control.apps.vumimessages.models import Outbound
-from .tasks import Create_Message, schedule_create
+from .tasks import (
+    Create_Message, Sync_Message_Content, schedule_create,
+    dispatch_subscriptions, invalidate_content_cache,
+    refresh_subscription_rollup, sync_message_content)
+from mama_ng_control.contentstore.cache import (
+    CachedContentStoreApiClient, ContentStoreCache, TTLCache, content_cache)
 
 # override Vumi sending handlers
 from go_http.send import LoggingSender
-from mama_ng_control.apps.vumimessages.tasks import Send_Message, Send_Metric
+from mama_ng_control.apps.vumimessages.tasks import (
+    Send_Message, Send_Metric, Send_Metrics)
 Send_Metric.vumi_client = lambda x: LoggingSender('go_http.test')
+Send_Metrics.vumi_client = lambda x: LoggingSender('go_http.test')
 Send_Message.vumi_client = lambda x: LoggingSender('go_http.test')
 
 # from requests import HTTPError
@@ -30,6 +44,7 @@ from requests_testadapter import TestSession, Resp
 from verified_fake.fake_contentstore import Request, FakeContentStoreApi
 
 from client.messaging_contentstore.contentstore import ContentStoreApiClient
+from mama_ng_control.scheduler.cron import CronError, CronSchedule
 
 
 class RecordingHandler(logging.Handler):
@@ -107,6 +122,7 @@ class APITestCase(TestCase):
 
     def setUp(self):
         self.client = APIClient()
+        content_cache.invalidate_all()
         self.messageset_data = {}
         self.schedule_data = {}
         self.message_data = {}
@@ -288,6 +304,17 @@ class TestSubscriptionsAPI(AuthenticatedAPITestCase):
         self.assertEqual(d.next_sequence_number, 10)
         self.assertEqual(d.lang, "en_ZA")
 
+    def test_filter_by_scheduler_ids(self):
+        existing = self.make_subscription()
+        self.make_subscription()
+        Subscription.objects.filter(id=existing).update(
+            scheduler_schedule_id="11", scheduler_message_id="4")
+        for query in ("scheduler_schedule_id=11", "scheduler_message_id=4"):
+            response = self.client.get('/api/v1/subscriptions/?%s' % query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                [r["id"] for r in response.data["results"]], [existing])
+
     def test_delete_subscription_data(self):
         existing = self.make_subscription()
         response = self.client.delete('/api/v1/subscriptions/%s/' % existing,
@@ -317,13 +344,40 @@ class TestSubscriptionsAPI(AuthenticatedAPITestCase):
         self.assertEqual(o.delivered, False)
         self.assertEqual(o.attempts, 1)
         self.assertEqual(o.metadata["subscription"], existing)
+        self.assertTrue(o.triggered_at <= o.created_at <= o.sent_at)
         s = Subscription.objects.last()
-        self.assertEqual(s.metadata["scheduler_message_id"], "4")
-        self.assertEqual(s.metadata["scheduler_schedule_id"], "3")
+        self.assertEqual(s.scheduler_message_id, "4")
+        self.assertEqual(s.scheduler_schedule_id, "3")
 
         s = Subscription.objects.get(id=existing)
         self.assertEqual(s.next_sequence_number, 2)
 
+    def test_trigger_subscription_send_repeated(self):
+        existing = self.make_subscription()
+        post_trigger = {
+            "send-counter": 2,
+            "message-id": "4",
+            "schedule-id": "3"
+        }
+        for _ in range(2):
+            response = self.client.post(
+                '/api/v1/subscriptions/%s/send' % existing,
+                json.dumps(post_trigger), content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        o = Outbound.objects.get()
+        self.assertEqual(str(o.subscription), existing)
+        self.assertEqual(o.sequence_number, 2)
+        self.assertEqual(o.generation, 0)
+        # only sent once
+        self.assertEqual(o.attempts, 1)
+
+        # a new generation is sent again
+        s = Subscription.objects.get(id=existing)
+        result = Create_Message().run(
+            str(self.contact), s.messageset_id, 2, s.lang, existing, 1)
+        self.assertTrue(result.startswith("New message created"))
+        self.assertEqual(Outbound.objects.count(), 2)
+
     def test_trigger_subscription_send_missing_subscription(self):
         post_trigger = {
             "send-counter": 2,
@@ -353,6 +407,57 @@ class TestSubscriptionsAPI(AuthenticatedAPITestCase):
         self.assertEqual(response.data["reason"],
                          "Missing expected body keys")
 
+    def test_trigger_subscription_send_batch(self):
+        first = self.make_subscription()
+        second = self.make_subscription()
+        missing = str(uuid.uuid4())
+        post_trigger = [
+            {"subscription_id": first, "send-counter": 1,
+             "message-id": "4", "schedule-id": "3"},
+            {"subscription_id": second, "send-counter": 1,
+             "message-id": "6", "schedule-id": "5"},
+            {"subscription_id": missing, "send-counter": 1,
+             "message-id": "8", "schedule-id": "7"},
+            {"subscription_id": first, "send-counter": 1,
+             "message-id": "4", "schedule-id": "3"},
+            {"subscription_id": "not-a-uuid", "send-counter": 1,
+             "message-id": "4", "schedule-id": "3"},
+            {"subscription_id": first, "send-counter": 2},
+        ]
+        response = self.client.post('/api/v1/subscriptions/send',
+                                    json.dumps(post_trigger),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"], [
+            {"subscription_id": first, "accepted": True},
+            {"subscription_id": second, "accepted": True},
+            {"subscription_id": missing, "accepted": False,
+             "reason": "Missing subscription in control"},
+            {"subscription_id": first, "accepted": False,
+             "reason": "Duplicate subscription in batch"},
+            {"subscription_id": "not-a-uuid", "accepted": False,
+             "reason": "Invalid subscription_id or send-counter"},
+            {"subscription_id": first, "accepted": False,
+             "reason": "Missing expected body keys"},
+        ])
+
+        s = Subscription.objects.get(id=second)
+        self.assertEqual(s.next_sequence_number, 1)
+        self.assertEqual(s.metadata["source"], "RapidProVoice")
+        self.assertEqual(s.scheduler_message_id, "6")
+        self.assertEqual(s.scheduler_schedule_id, "5")
+        for existing in (first, second):
+            o = Outbound.objects.get(metadata__subscription=existing)
+            self.assertEqual(o.content, "Message one")
+            self.assertEqual(o.attempts, 1)
+
+    def test_trigger_subscription_send_batch_not_a_list(self):
+        response = self.client.post('/api/v1/subscriptions/send',
+                                    json.dumps({"send-counter": 1}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data["reason"], "Expected a list of sends")
+
     @responses.activate
     def test_create_schedule_data(self):
         # create existing but surpress post save hook
@@ -414,4 +519,527 @@ class TestSubscriptionsAPI(AuthenticatedAPITestCase):
 
         d = Subscription.objects.get(pk=existing)
         self.assertIsNotNone(d.id)
-        self.assertEqual(d.metadata["scheduler_schedule_id"], "11")
+        self.assertEqual(d.scheduler_schedule_id, "11")
+        self.assertEqual(d.frequency, 2)
+
+    @responses.activate
+    @override_settings(SCHEDULER_ENGINE="internal")
+    def test_create_schedule_internally(self):
+        existing = self.make_subscription()
+        responses.add(
+            responses.GET,
+            "http://127.0.0.1:8000/contentstore/schedule/1",
+            json.dumps({"id": 1, "minute": "1", "hour": "6",
+                        "day_of_week": "1", "day_of_month": "*",
+                        "month_of_year": "*"}),
+            status=200, content_type='application/json')
+        responses.add(
+            responses.GET,
+            "http://127.0.0.1:8000/contentstore/messageset/2/messages",
+            json.dumps({"id": 2, "messages": [{"id": 1}, {"id": 2}]}),
+            status=200, content_type='application/json')
+
+        schedule_create.delay(existing)
+        # nothing is posted to the scheduler
+        self.assertEqual(len(responses.calls), 2)
+
+        d = Subscription.objects.get(pk=existing)
+        self.assertEqual(d.cron_definition, "1 6 * * 1")
+        self.assertEqual(d.frequency, 2)
+        self.assertEqual(d.next_send_at.isoweekday(), 1)
+        self.assertEqual((d.next_send_at.hour, d.next_send_at.minute), (6, 1))
+        self.assertTrue(d.next_send_at > timezone.now())
+
+    def test_dispatch_subscriptions(self):
+        existing = self.make_subscription()
+        due = timezone.now() - timedelta(hours=1)
+        Subscription.objects.filter(id=existing).update(
+            cron_definition="0 8 * * *", next_send_at=due,
+            frequency=2)
+        # not due yet
+        later = self.make_subscription()
+        Subscription.objects.filter(id=later).update(
+            cron_definition="0 8 * * *",
+            next_send_at=timezone.now() + timedelta(hours=1))
+
+        self.assertEqual(dispatch_subscriptions.delay().get(), 1)
+        o = Outbound.objects.get()
+        self.assertEqual(o.content, "Message one")
+        self.assertEqual(o.metadata["subscription"], existing)
+        # triggered when it was due rather than when it was dispatched
+        self.assertEqual(o.triggered_at, due)
+        d = Subscription.objects.get(id=existing)
+        self.assertEqual(d.next_sequence_number, 2)
+        self.assertEqual((d.next_send_at.hour, d.next_send_at.minute), (8, 0))
+        self.assertTrue(d.next_send_at > timezone.now())
+        self.assertFalse(d.completed)
+
+        # the last message completes the subscription
+        Subscription.objects.filter(id=existing).update(next_send_at=due)
+        self.assertEqual(dispatch_subscriptions.delay().get(), 1)
+        d = Subscription.objects.get(id=existing)
+        self.assertEqual(d.next_sequence_number, 2)
+        self.assertIsNone(d.next_send_at)
+        self.assertTrue(d.completed)
+        self.assertEqual(dispatch_subscriptions.delay().get(), 0)
+
+    def add_bulk_schedule_responses(self):
+        for schedule_id in (1, 2):
+            responses.add(
+                responses.GET,
+                "http://127.0.0.1:8000/contentstore/schedule/%s" % (
+                    schedule_id,),
+                json.dumps({"id": schedule_id, "minute": "1", "hour": "6",
+                            "day_of_week": str(schedule_id),
+                            "day_of_month": "*", "month_of_year": "*"}),
+                status=200, content_type='application/json')
+        responses.add(
+            responses.GET,
+            "http://127.0.0.1:8000/contentstore/messageset/2/messages",
+            json.dumps({"id": 2, "messages": [{"id": 1}, {"id": 2}]}),
+            status=200, content_type='application/json')
+        created = []
+        lock = threading.Lock()
+
+        def create_schedule(request):
+            with lock:
+                created.append(json.loads(request.body))
+                return (200, {}, json.dumps({"id": len(created) + 10}))
+
+        responses.add_callback(
+            responses.POST,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/schedules",
+            callback=create_schedule, content_type='application/json')
+        return created
+
+    @responses.activate
+    def test_bulk_create_subscriptions(self):
+        created = self.add_bulk_schedule_responses()
+        row = {"contact": str(self.contact), "messageset_id": 2,
+               "lang": "en_ZA", "metadata": {"source": "bulk"}}
+        post_data = [
+            row, row, dict(row, schedule=2),
+            dict(row, contact=str(uuid.uuid4())),
+            dict(row, messageset_id="two"),
+        ]
+        response = self.client.post('/api/v1/subscriptions/bulk',
+                                    json.dumps(post_data),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["created"], 3)
+        self.assertEqual(response.data["failed"], 2)
+        self.assertEqual([e["row"] for e in response.data["errors"]], [4, 5])
+
+        subscriptions = Subscription.objects.all()
+        self.assertEqual(len(subscriptions), 3)
+        self.assertEqual(
+            sorted(s.scheduler_schedule_id for s in subscriptions),
+            ["11", "12", "13"])
+        self.assertEqual(set(s.frequency for s in subscriptions), set([2]))
+        self.assertEqual(subscriptions[0].metadata, {"source": "bulk"})
+        # content store data is loaded once per schedule and messageset
+        self.assertEqual(len(responses.calls), 3 + 3)
+        self.assertEqual(
+            sorted(schedule["cronDefinition"] for schedule in created),
+            ["1 6 * * 1", "1 6 * * 1", "1 6 * * 2"])
+
+    def test_bulk_create_subscriptions_not_a_list(self):
+        response = self.client.post('/api/v1/subscriptions/bulk',
+                                    json.dumps({"contact": "foo"}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @responses.activate
+    def test_import_subscriptions_command(self):
+        created = self.add_bulk_schedule_responses()
+        source = tempfile.NamedTemporaryFile(suffix=".ndjson")
+        for schedule in (1, 2, 1):
+            source.write(json.dumps({
+                "contact": str(self.contact), "messageset_id": 2,
+                "lang": "en_ZA", "schedule": schedule}) + "\n")
+        source.write("not json\n")
+        source.flush()
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+        call_command('import_subscriptions', source.name, chunk_size=2,
+                     schedule_here=True, stdout=stdout, stderr=stderr)
+        stdout.seek(0)
+        stderr.seek(0)
+        output = stdout.read()
+        self.assertIn("Created 3 subscriptions, 1 rows failed", output)
+        self.assertIn("Handled 3/3 subscriptions", output)
+        self.assertIn("Scheduled 3 subscriptions", output)
+        self.assertIn("Row 4:", stderr.read())
+        self.assertEqual(len(created), 3)
+        self.assertEqual(Subscription.objects.filter(
+            scheduler_schedule_id__isnull=True).count(), 0)
+
+    @responses.activate
+    def test_bulk_job_deactivate(self):
+        existing = self.make_subscription()
+        unscheduled = self.make_subscription()
+        Subscription.objects.filter(id=existing).update(
+            scheduler_schedule_id="11", scheduler_message_id="4")
+        other = Contact.objects.create(details={})
+        untouched = Subscription.objects.create(
+            contact=other, messageset_id=2, lang="en_ZA")
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/messages/4",
+            status=204)
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/schedules/11",
+            status=204)
+
+        response = self.client.post('/api/v1/subscriptionjobs/', json.dumps({
+            "action": "deactivate",
+            "contacts": [str(self.contact)],
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        job = self.client.get(
+            '/api/v1/subscriptionjobs/%s/' % response.data["id"]).data
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["total"], 2)
+        self.assertEqual(job["processed"], 2)
+        self.assertEqual(job["failed"], 0)
+        self.assertEqual(
+            [call.request.url.rsplit("/", 2)[-2:] for call in responses.calls],
+            [["messages", "4"], ["schedules", "11"]])
+        self.assertEqual(
+            set(Subscription.objects.filter(active=False).values_list(
+                'id', flat=True)),
+            set([uuid.UUID(existing), uuid.UUID(unscheduled)]))
+        self.assertTrue(Subscription.objects.get(id=untouched.id).active)
+
+    @responses.activate
+    def test_bulk_job_transition(self):
+        existing = self.make_subscription()
+        stuck = self.make_subscription()
+        Subscription.objects.filter(id=existing).update(
+            scheduler_schedule_id="11", next_sequence_number=5)
+        Subscription.objects.filter(id=stuck).update(
+            scheduler_schedule_id="12")
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/schedules/11",
+            status=204)
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/schedules/12",
+            status=500)
+        responses.add(
+            responses.GET,
+            "http://127.0.0.1:8000/contentstore/schedule/3",
+            json.dumps({"id": 3, "minute": "0", "hour": "9",
+                        "day_of_week": "*", "day_of_month": "*",
+                        "month_of_year": "*"}),
+            status=200, content_type='application/json')
+        responses.add(
+            responses.GET,
+            "http://127.0.0.1:8000/contentstore/messageset/5/messages",
+            json.dumps({"id": 5, "messages": [{"id": 1}]}),
+            status=200, content_type='application/json')
+        responses.add(
+            responses.POST,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/schedules",
+            json.dumps({"id": 21}),
+            status=200, content_type='application/json')
+
+        response = self.client.post('/api/v1/subscriptionjobs/', json.dumps({
+            "action": "transition",
+            "messageset_id": 2,
+            "next_messageset_id": 5,
+            "next_schedule": 3,
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        job = BulkJob.objects.get(id=response.data["id"])
+        self.assertEqual(job.status, "done")
+        self.assertEqual((job.total, job.processed, job.failed), (2, 2, 1))
+        d = Subscription.objects.get(id=existing)
+        self.assertEqual(d.messageset_id, 5)
+        self.assertEqual(d.schedule, 3)
+        self.assertEqual(d.next_sequence_number, 1)
+        self.assertEqual(d.frequency, 1)
+        self.assertEqual(d.scheduler_schedule_id, "21")
+        # not scheduled again while its old schedule remains
+        d = Subscription.objects.get(id=stuck)
+        self.assertEqual(d.messageset_id, 5)
+        self.assertIsNone(d.scheduler_schedule_id)
+
+    def test_bulk_job_validation(self):
+        for data in ({"action": "deactivate"},
+                     {"action": "transition", "messageset_id": 2}):
+            response = self.client.post(
+                '/api/v1/subscriptionjobs/', json.dumps(data),
+                content_type='application/json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(BulkJob.objects.count(), 0)
+
+    def test_rollup(self):
+        contact = Contact.objects.get(id=self.contact)
+        for messageset_id, lang, active in ((1, "en_ZA", True),
+                                            (1, "en_ZA", True),
+                                            (1, "en_ZA", False),
+                                            (2, "xh_ZA", True)):
+            Subscription.objects.create(
+                contact=contact, messageset_id=messageset_id, lang=lang,
+                active=active)
+        self.assertEqual(refresh_subscription_rollup.delay().get(), 3)
+
+        response = self.client.get(
+            '/api/v1/subscriptions/rollup?group_by=messageset_id,active')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(response.data["refreshed_at"])
+        self.assertEqual(response.data["results"], [
+            {"messageset_id": 1, "active": False, "count": 1},
+            {"messageset_id": 1, "active": True, "count": 2},
+            {"messageset_id": 2, "active": True, "count": 1},
+        ])
+
+        today = timezone.now().date().isoformat()
+        response = self.client.get(
+            '/api/v1/subscriptions/rollup?group_by=day&active=true'
+            '&since=%s&until=%s' % (today, today))
+        self.assertEqual(response.data["results"], [
+            {"day": timezone.now().date(), "count": 3}])
+        response = self.client.get(
+            '/api/v1/subscriptions/rollup?lang=xh_ZA')
+        self.assertEqual(response.data["results"], [{"count": 1}])
+
+        # counts only change when refreshed
+        Subscription.objects.update(active=False)
+        response = self.client.get('/api/v1/subscriptions/rollup?active=false')
+        self.assertEqual(response.data["results"], [{"count": 1}])
+        refresh_subscription_rollup.delay()
+        self.assertEqual(SubscriptionRollup.objects.count(), 2)
+        response = self.client.get('/api/v1/subscriptions/rollup?active=false')
+        self.assertEqual(response.data["results"], [{"count": 4}])
+
+    def test_rollup_bad_params(self):
+        for query in ("group_by=contact", "active=yes", "since=yesterday"):
+            response = self.client.get(
+                '/api/v1/subscriptions/rollup?%s' % query)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class TestCron(TestCase):
+
+    def test_weekly(self):
+        cron = CronSchedule("1 6 * * 1")
+        # a Sunday
+        start = datetime(2015, 4, 5, 21, 59)
+        self.assertEqual(cron.next_after(start), datetime(2015, 4, 6, 6, 1))
+        self.assertEqual(cron.next_after(datetime(2015, 4, 6, 6, 1)),
+                         datetime(2015, 4, 13, 6, 1))
+
+    def test_steps_and_ranges(self):
+        cron = CronSchedule("*/15 8-17 * * *")
+        self.assertEqual(cron.next_after(datetime(2015, 4, 5, 8, 1)),
+                         datetime(2015, 4, 5, 8, 15))
+        self.assertEqual(cron.next_after(datetime(2015, 4, 5, 17, 45)),
+                         datetime(2015, 4, 6, 8, 0))
+
+    def test_day_of_month_or_day_of_week(self):
+        # the 1st of the month or any Sunday
+        cron = CronSchedule("0 0 1 * 0,7")
+        self.assertEqual(cron.next_after(datetime(2015, 4, 5, 1, 0)),
+                         datetime(2015, 4, 12, 0, 0))
+        self.assertEqual(cron.next_after(datetime(2015, 4, 26, 1, 0)),
+                         datetime(2015, 5, 1, 0, 0))
+
+    def test_next_month_and_year(self):
+        cron = CronSchedule("30 9 29 2 *")
+        self.assertEqual(cron.next_after(datetime(2015, 4, 5)),
+                         datetime(2016, 2, 29, 9, 30))
+
+    def test_invalid(self):
+        for definition in ("1 6 * *", "61 * * * *", "a * * * *",
+                           "* * * * */0", "0 0 31 2 *"):
+            with self.assertRaises(CronError):
+                CronSchedule(definition).next_after(datetime(2015, 4, 5))
+
+
+class FakeRedis(object):
+
+    """ Enough of StrictRedis for the shared content cache. """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match=None):
+        return [k for k in self.data if k.startswith(match.rstrip("*"))]
+
+
+class CountingContentStore(object):
+
+    """ Records calls made to a Content Store client. """
+
+    def __init__(self):
+        self.calls = []
+
+    def get_schedule(self, schedule_id):
+        self.calls.append(("get_schedule", schedule_id))
+        return {"id": schedule_id, "minute": "1"}
+
+    def get_messages(self, params=None):
+        self.calls.append(("get_messages", params))
+        return [{"id": 1}]
+
+
+class TestContentStoreCache(APITestCase):
+
+    def make_cache(self, redis=None, clock=None):
+        return ContentStoreCache(
+            local=TTLCache(10, 60, clock=clock or (lambda: 0)),
+            shared_ttl=3600, redis=lambda: redis)
+
+    def test_local_hits(self):
+        cache = self.make_cache()
+        backend = CountingContentStore()
+        contentstore = CachedContentStoreApiClient(backend, cache)
+        params = {"messageset": 1, "sequence_number": 2, "lang": "en_ZA"}
+        self.assertEqual(contentstore.get_messages(params=params), [{"id": 1}])
+        self.assertEqual(contentstore.get_messages(params=dict(params)),
+                         [{"id": 1}])
+        self.assertEqual(contentstore.get_schedule(1)["id"], 1)
+        self.assertEqual(backend.calls, [("get_messages", params),
+                                         ("get_schedule", 1)])
+        self.assertEqual(cache.stats, {
+            "local_hits": 1, "shared_hits": 0, "misses": 2})
+
+    def test_local_entries_expire(self):
+        now = [0]
+        cache = self.make_cache(clock=lambda: now[0])
+        backend = CountingContentStore()
+        contentstore = CachedContentStoreApiClient(backend, cache)
+        contentstore.get_schedule(1)
+        now[0] = 61
+        contentstore.get_schedule(1)
+        self.assertEqual(len(backend.calls), 2)
+
+    def test_shared_hits(self):
+        redis = FakeRedis()
+        backend = CountingContentStore()
+        first = CachedContentStoreApiClient(backend, self.make_cache(redis))
+        second_cache = self.make_cache(redis)
+        second = CachedContentStoreApiClient(backend, second_cache)
+        first.get_schedule(1)
+        self.assertEqual(second.get_schedule(1)["minute"], "1")
+        self.assertEqual(backend.calls, [("get_schedule", 1)])
+        self.assertEqual(second_cache.stats["shared_hits"], 1)
+
+    def test_invalidate(self):
+        redis = FakeRedis()
+        cache = self.make_cache(redis)
+        backend = CountingContentStore()
+        contentstore = CachedContentStoreApiClient(backend, cache)
+        contentstore.get_schedule(1)
+        contentstore.get_schedule(2)
+        cache.invalidate("get_schedule", 1)
+        contentstore.get_schedule(1)
+        contentstore.get_schedule(2)
+        self.assertEqual(len(backend.calls), 3)
+        cache.invalidate_all()
+        self.assertEqual(redis.data, {})
+        contentstore.get_schedule(2)
+        self.assertEqual(len(backend.calls), 4)
+
+    def test_create_message_reuses_content(self):
+        Create_Message.contentstore_client = lambda x: self.make_cs_client()
+        contact = Contact.objects.create(details={
+            "addresses": "msisdn:+27123"
+        })
+        before = dict(content_cache.stats)
+        for _ in range(2):
+            Create_Message().run(str(contact.id), 1, 1, "en_ZA",
+                                 str(uuid.uuid4()))
+        self.assertEqual(Outbound.objects.filter(
+            content="Message one").count(), 2)
+        self.assertEqual(
+            content_cache.stats["misses"] - before["misses"], 2)
+        self.assertEqual(
+            content_cache.stats["local_hits"] - before["local_hits"], 2)
+        invalidate_content_cache.delay()
+        self.assertEqual(content_cache.local.entries, {})
+
+
+class TestMessageContentSync(APITestCase):
+
+    def setUp(self):
+        super(TestMessageContentSync, self).setUp()
+        Sync_Message_Content.contentstore_client = \
+            lambda x: self.make_cs_client()
+
+    def test_sync_creates_content(self):
+        self.assertEqual(sync_message_content.delay().get(), 1)
+        content = MessageContent.objects.get()
+        self.assertEqual(content.messageset_id, self.message1["messageset"])
+        self.assertEqual(content.sequence_number, 1)
+        self.assertEqual(content.lang, "en_ZA")
+        self.assertEqual(content.contentstore_message_id, self.message1["id"])
+        self.assertEqual(content.text_content, "Message one")
+        self.assertEqual(content.voice_speech_url,
+                         "http://foo.com/message1.mp3")
+        self.assertEqual(content.sync_version, 1)
+
+    def test_sync_is_incremental(self):
+        sync_message_content.delay()
+        # unchanged messages are only restamped
+        self.assertEqual(sync_message_content.delay().get(), 0)
+        self.assertEqual(MessageContent.objects.get().sync_version, 2)
+
+        self.message1["text_content"] = "Message one, revised"
+        self.message1["updated_at"] = "2015-07-25 12:44:11.159151"
+        self.assertEqual(sync_message_content.delay().get(), 1)
+        content = MessageContent.objects.get()
+        self.assertEqual(content.text_content, "Message one, revised")
+        self.assertEqual(content.sync_version, 3)
+        self.assertEqual(MessageContent.objects.stale().count(), 0)
+
+    def test_sync_leaves_removed_content_stale(self):
+        sync_message_content.delay()
+        self.message_data.clear()
+        sync_message_content.delay()
+        message2 = make_message_dict({
+            "messageset": self.message1["messageset"],
+            "sequence_number": 2,
+            "lang": "en_ZA",
+            "text_content": "Message two",
+        })
+        self.message_data[message2["id"]] = message2
+        sync_message_content.delay()
+        stale = MessageContent.objects.stale().get()
+        self.assertEqual(stale.sequence_number, 1)
+        self.assertIsNone(MessageContent.objects.get(
+            sequence_number=2).voice_speech_url)
+
+    def test_create_message_uses_local_content(self):
+        def unavailable(task):
+            raise AssertionError("Content store should not be called")
+        Create_Message.contentstore_client = unavailable
+        MessageContent.objects.create(
+            messageset_id=7, sequence_number=3, lang="en_ZA",
+            contentstore_message_id=99, text_content="Local copy")
+        contact = Contact.objects.create(details={
+            "addresses": "msisdn:+27123"
+        })
+        subscription = str(uuid.uuid4())
+        Create_Message().run(str(contact.id), 7, 3, "en_ZA", subscription)
+        o = Outbound.objects.get(metadata__subscription=subscription)
+        self.assertEqual(o.content, "Local copy")
+        self.assertNotIn("voice_speech_url", o.metadata)
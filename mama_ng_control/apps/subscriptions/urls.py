@@ -4,11 +4,18 @@ from . import views
 
 router = routers.DefaultRouter()
 router.register(r'subscriptions', views.SubscriptionViewSet)
+router.register(r'subscriptionjobs', views.BulkJobViewSet)
 
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browseable API.
 urlpatterns = [
     url(r'^', include(router.urls)),
+    url('^subscriptions/bulk$',
+        views.SubscriptionBulkCreate.as_view()),
+    url('^subscriptions/rollup$',
+        views.SubscriptionRollupView.as_view()),
+    url('^subscriptions/send$',
+        views.SubscriptionSendBatch.as_view()),
     url('^subscriptions/(?P<subscription_id>.+)/send$',
         views.SubscriptionSend.as_view()),
 ]
@@ -1,12 +1,19 @@
-from rest_framework import viewsets
+import uuid
+
+from rest_framework import mixins, viewsets
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from django.conf import settings
+from django.db.models import Max, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 from django.core.exceptions import ObjectDoesNotExist
 
-from .models import Subscription
-from .serializers import SubscriptionSerializer
-from .tasks import create_message
+from .importer import SubscriptionImporter
+from .models import BulkJob, Subscription, SubscriptionRollup
+from .serializers import BulkJobSerializer, SubscriptionSerializer
+from .tasks import create_message, create_messages
 
 
 class SubscriptionViewSet(viewsets.ModelViewSet):
@@ -18,7 +25,21 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
     queryset = Subscription.objects.all()
     serializer_class = SubscriptionSerializer
     filter_fields = ('contact', 'messageset_id', 'lang', 'active', 'completed',
-                     'schedule', 'process_status', 'metadata',)
+                     'schedule', 'process_status', 'metadata',
+                     'scheduler_schedule_id', 'scheduler_message_id',)
+
+
+class BulkJobViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                     mixins.ListModelMixin, viewsets.GenericViewSet):
+
+    """
+    API endpoint that starts bulk subscription changes and reports their
+    progress.
+    """
+    permission_classes = (IsAuthenticated,)
+    queryset = BulkJob.objects.all()
+    serializer_class = BulkJobSerializer
+    filter_fields = ('action', 'status',)
 
 
 class SubscriptionSend(APIView):
@@ -42,9 +63,9 @@ class SubscriptionSend(APIView):
                 subscription.next_sequence_number = request.data[
                     "send-counter"]
                 # Keep the subscription up-to-date for acks later
-                subscription.metadata["scheduler_schedule_id"] = \
+                subscription.scheduler_schedule_id = \
                     request.data["schedule-id"]
-                subscription.metadata["scheduler_message_id"] = \
+                subscription.scheduler_message_id = \
                     request.data["message-id"]
                 subscription.save()
                 # Create and populate the message which will trigger send task
@@ -53,7 +74,8 @@ class SubscriptionSend(APIView):
                     subscription.messageset_id,
                     subscription.next_sequence_number,
                     subscription.lang,
-                    str(subscription.id))
+                    str(subscription.id),
+                    triggered_at=timezone.now().isoformat())
                 # Return
                 status = 201
                 accepted = {"accepted": True}
@@ -66,3 +88,182 @@ class SubscriptionSend(APIView):
             accepted = {"accepted": False,
                         "reason": "Missing subscription in control"}
         return Response(accepted, status=status)
+
+
+class SubscriptionSendBatch(APIView):
+
+    """
+    Triggers sends for many subscriptions at once
+    """
+    permission_classes = (AllowAny,)
+    expect = ["subscription_id", "message-id", "send-counter", "schedule-id"]
+
+    def parse(self, item):
+        """
+        Returns the (subscription_id, send_counter, schedule_id, message_id)
+        to record, or raises ValueError with the reason to reject the item
+        """
+        if not isinstance(item, dict) or \
+                not set(self.expect).issubset(item.keys()):
+            raise ValueError("Missing expected body keys")
+        try:
+            return (str(uuid.UUID(str(item["subscription_id"]))),
+                    int(item["send-counter"]),
+                    str(item["schedule-id"]),
+                    str(item["message-id"]))
+        except ValueError:
+            raise ValueError("Invalid subscription_id or send-counter")
+
+    def post(self, request, *args, **kwargs):
+        """
+        Expects a list of {"subscription_id", "message-id", "send-counter",
+        "schedule-id"} and returns whether each was accepted, in order
+        """
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"accepted": False,
+                             "reason": "Expected a list of sends"},
+                            status=400)
+        if len(items) > settings.SUBSCRIPTION_SEND_BATCH_LIMIT:
+            return Response({"accepted": False,
+                             "reason": "Too many sends, limit is %s" % (
+                                 settings.SUBSCRIPTION_SEND_BATCH_LIMIT,)},
+                            status=400)
+        results = []
+        sends = {}
+        for item in items:
+            try:
+                send = self.parse(item)
+                if send[0] in sends:
+                    raise ValueError("Duplicate subscription in batch")
+            except ValueError as e:
+                results.append({
+                    "subscription_id": item.get("subscription_id")
+                    if isinstance(item, dict) else None,
+                    "accepted": False,
+                    "reason": str(e)})
+                continue
+            sends[send[0]] = send
+            results.append({"subscription_id": send[0]})
+
+        found = dict(
+            (str(row[0]), row)
+            for row in Subscription.objects.record_sends(sends.values()))
+        messages = []
+        triggered_at = timezone.now().isoformat()
+        for result in results:
+            if "accepted" in result:
+                continue
+            row = found.get(result["subscription_id"])
+            if row is None:
+                result["accepted"] = False
+                result["reason"] = "Missing subscription in control"
+                continue
+            result["accepted"] = True
+            subscription_id, contact_id, messageset_id, sequence_number, \
+                lang = row
+            messages.append([str(contact_id), messageset_id, sequence_number,
+                             lang, str(subscription_id), 0, triggered_at])
+
+        # Create and populate the messages which will trigger send tasks
+        chunk_size = settings.SUBSCRIPTION_SEND_BATCH_CHUNK_SIZE
+        for start in range(0, len(messages), chunk_size):
+            create_messages.delay(messages[start:start + chunk_size])
+        return Response({"results": results}, status=200)
+
+
+class SubscriptionBulkCreate(APIView):
+
+    """
+    Creates many subscriptions in one transaction
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Expects a list of subscriptions with contact ids, returns counts of
+        created and failed rows with per-row errors. Schedules are created
+        in the background.
+        """
+        items = request.data
+        if not isinstance(items, list):
+            return Response({"reason": "Expected a list of subscriptions"},
+                            status=400)
+        if len(items) > settings.SUBSCRIPTION_BULK_CREATE_LIMIT:
+            return Response(
+                {"reason": "Too many subscriptions, limit is %s" % (
+                    settings.SUBSCRIPTION_BULK_CREATE_LIMIT,)},
+                status=400)
+        importer = SubscriptionImporter(chunk_size=max(len(items), 1),
+                                        max_errors=len(items))
+        report = importer.run(
+            (row_number, item, None)
+            for row_number, item in enumerate(items, 1))
+        return Response(report, status=201)
+
+
+class SubscriptionRollupView(APIView):
+
+    """
+    Subscription counts from the periodically refreshed rollup
+    """
+    permission_classes = (IsAuthenticated,)
+    dimensions = ("day", "messageset_id", "lang", "active", "completed")
+
+    def parse_filters(self, params):
+        """
+        Returns the rollup filters, raising ValueError for bad values
+        """
+        filters = {}
+        for name, parse in (("messageset_id", int), ("lang", str),
+                            ("active", self.parse_bool),
+                            ("completed", self.parse_bool),
+                            ("since", self.parse_day),
+                            ("until", self.parse_day)):
+            if name in params:
+                filters[name] = parse(params[name])
+        for name, lookup in (("since", "day__gte"), ("until", "day__lte")):
+            if name in filters:
+                filters[lookup] = filters.pop(name)
+        return filters
+
+    def parse_bool(self, value):
+        if value not in ("true", "false"):
+            raise ValueError("Expected true or false, got %r" % value)
+        return value == "true"
+
+    def parse_day(self, value):
+        day = parse_date(value)
+        if day is None:
+            raise ValueError("Expected a YYYY-MM-DD date, got %r" % value)
+        return day
+
+    def get(self, request, *args, **kwargs):
+        """
+        Sums counts over ?group_by=messageset_id,lang (any of day,
+        messageset_id, lang, active and completed), filtered by
+        messageset_id, lang, active, completed, since and until
+        """
+        group_by = [
+            name for name in
+            request.query_params.get("group_by", "").split(",") if name]
+        unknown = set(group_by) - set(self.dimensions)
+        if unknown:
+            return Response(
+                {"reason": "Unknown group_by %s, expected %s" % (
+                    ", ".join(sorted(unknown)), ", ".join(self.dimensions))},
+                status=400)
+        try:
+            filters = self.parse_filters(request.query_params)
+        except ValueError as e:
+            return Response({"reason": str(e)}, status=400)
+        rollup = SubscriptionRollup.objects.filter(**filters)
+        if group_by:
+            results = list(rollup.values(*group_by).annotate(
+                count=Sum("count")).order_by(*group_by))
+        else:
+            results = [{"count": rollup.aggregate(
+                count=Sum("count"))["count"] or 0}]
+        refreshed_at = SubscriptionRollup.objects.aggregate(
+            refreshed_at=Max("refreshed_at"))["refreshed_at"]
+        return Response({"refreshed_at": refreshed_at, "results": results})
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Outbound, Inbound
+from .models import Outbound, Inbound, PendingEvent, DeadLetter
 
 
 class OutboundAdmin(admin.ModelAdmin):
@@ -16,5 +16,19 @@ class InboundAdmin(admin.ModelAdmin):
     list_filter = ('message_id', 'in_reply_to', 'to_addr', 'from_addr',
                    'created_at', 'updated_at', )
 
+
+class PendingEventAdmin(admin.ModelAdmin):
+    list_display = ('user_message_id', 'event_type', 'timestamp',
+                    'created_at', )
+    list_filter = ('event_type', )
+
+
+class DeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('outbound', 'reason', 'detail', 'created_at',
+                    'redriven_at', )
+    list_filter = ('reason', 'created_at', 'redriven_at', )
+
 admin.site.register(Outbound, OutboundAdmin)
 admin.site.register(Inbound, InboundAdmin)
+admin.site.register(PendingEvent, PendingEventAdmin)
+admin.site.register(DeadLetter, DeadLetterAdmin)
@@ -0,0 +1,190 @@
+"""
+Applying Vumi events to outbound messages.
+
+Each event only writes the columns it changes, so acks, nacks and
+delivery reports do not rewrite the whole row. apply_events does the
+same for a batch, with one UPDATE for all of their messages.
+
+Acks and delivery reports also set acked_at and delivered_at from the
+event's timestamp, and record the ack, delivery and total latencies the
+first time they're set.
+
+Nacked messages are resent after a backoff until the nack retry budget
+runs out, when they go to the dead letter table instead.
+"""
+from collections import OrderedDict
+
+from django.db import connection
+from django.utils import timezone
+
+from mama_ng_control.apps.outbox.models import OutboxMessage
+from .latency import parse_timestamp, record_latency
+from .models import DeadLetter, Outbound
+from .retries import nack_policy
+from .tasks import send_message, scheduler_ack
+
+EVENT_TYPES = ("ack", "nack", "delivery_report")
+
+
+def event_time(event):
+    return parse_timestamp(event.get("timestamp")) or timezone.now()
+
+
+def earliest(current, timestamp):
+    return timestamp if current is None else min(current, timestamp)
+
+
+def record_event_latencies(triggered_at, sent_at, acked_at, delivered_at):
+    """
+    Records the latencies of an ack and delivery time newly set on a
+    message, either of which can be None
+    """
+    record_latency("ack", sent_at, acked_at)
+    record_latency("delivery", sent_at, delivered_at)
+    record_latency("total", triggered_at, delivered_at)
+
+
+def apply_event(message, event):
+    """
+    Applies an ack, nack or delivery_report event to an Outbound, which
+    only needs id, delivered, nacks, metadata and the stage timestamps
+    loaded
+    """
+    event_type = event["event_type"]
+    if event_type == "ack":
+        message.delivered = True
+        message.metadata["ack_timestamp"] = event["timestamp"]
+        fields = ["delivered", "metadata", "updated_at"]
+        if message.acked_at is None:
+            message.acked_at = event_time(event)
+            fields.append("acked_at")
+            record_event_latencies(None, message.sent_at,
+                                   message.acked_at, None)
+        message.save(update_fields=fields)
+        scheduler_ack.delay(message.metadata["subscription"])
+    elif event_type == "delivery_report":
+        message.delivered = True
+        message.metadata["delivery_timestamp"] = event["timestamp"]
+        fields = ["delivered", "metadata", "updated_at"]
+        if message.delivered_at is None:
+            message.delivered_at = event_time(event)
+            fields.append("delivered_at")
+            record_event_latencies(message.triggered_at, message.sent_at,
+                                   None, message.delivered_at)
+        message.save(update_fields=fields)
+    elif event_type == "nack":
+        if "nack_reason" in event:
+            message.metadata["nack_reason"] = event["nack_reason"]
+        message.nacks += 1
+        message.save(update_fields=["nacks", "metadata", "updated_at"])
+        policy = nack_policy()
+        if policy.exhausted(message.nacks):
+            DeadLetter.objects.create(outbound=message,
+                                      reason=DeadLetter.NACK,
+                                      detail=event.get("nack_reason"))
+            if "subscription" in message.metadata:
+                scheduler_ack.delay(message.metadata["subscription"])
+        else:
+            send_message.apply_async(args=[str(message.id)],
+                                     countdown=policy.backoff(message.nacks))
+
+
+def coalesce_events(events):
+    """
+    Folds events, in order, into one change per user_message_id:
+    {"delivered": bool, "metadata": {...}, "ack": bool, "nack": bool,
+     "acked_at": datetime, "delivered_at": datetime}
+    keeping the earliest ack and delivery times
+    """
+    changes = OrderedDict()
+    for event in events:
+        change = changes.setdefault(event["user_message_id"], {
+            "delivered": False, "metadata": {}, "ack": False, "nack": False,
+            "acked_at": None, "delivered_at": None})
+        event_type = event["event_type"]
+        if event_type == "ack":
+            change["delivered"] = change["ack"] = True
+            change["metadata"]["ack_timestamp"] = event["timestamp"]
+            change["acked_at"] = earliest(change["acked_at"],
+                                          event_time(event))
+        elif event_type == "delivery_report":
+            change["delivered"] = True
+            change["metadata"]["delivery_timestamp"] = event["timestamp"]
+            change["delivered_at"] = earliest(change["delivered_at"],
+                                              event_time(event))
+        elif event_type == "nack":
+            change["nack"] = True
+            if "nack_reason" in event:
+                change["metadata"]["nack_reason"] = event["nack_reason"]
+    return changes
+
+
+def apply_events(events):
+    """
+    Applies a batch of events with one lookup and one UPDATE, queueing at
+    most one scheduler ack and one resend per message through the outbox
+    with one INSERT.
+    A nacked message that was also acked or delivered is not resent, and
+    its nack isn't counted against the budget.
+    Returns the user_message_ids that matched no Outbound.
+    """
+    changes = coalesce_events(events)
+    if not changes:
+        return []
+    messages = dict(
+        (row[1], row) for row in Outbound.objects.filter(
+            vumi_message_id__in=list(changes)).values_list(
+                'id', 'vumi_message_id', 'nacks', 'metadata',
+                'triggered_at', 'sent_at', 'acked_at', 'delivered_at'))
+    policy = nack_policy()
+    calls = []
+    letters = []
+    values = []
+    params = [timezone.now()]
+    for vumi_message_id, change in changes.items():
+        if vumi_message_id not in messages:
+            continue
+        (message_id, _, nacks, metadata,
+         triggered_at, sent_at, acked_at, delivered_at) = \
+            messages[vumi_message_id]
+        nacked = change["nack"] and not change["delivered"]
+        keys = list(change["metadata"])
+        values.append("(%s::uuid, %s::boolean, %s::integer, %s::text[], "
+                      "%s::text[], %s::timestamptz, %s::timestamptz)")
+        params.extend([str(message_id), change["delivered"], int(nacked),
+                       keys, [change["metadata"][key] for key in keys],
+                       change["acked_at"], change["delivered_at"]])
+        record_event_latencies(
+            triggered_at, sent_at,
+            change["acked_at"] if acked_at is None else None,
+            change["delivered_at"] if delivered_at is None else None)
+        # one bad message must not fail the batch, unlike a single event
+        ack = change["ack"]
+        if nacked and policy.exhausted(nacks + 1):
+            letters.append((message_id, DeadLetter.NACK,
+                            change["metadata"].get("nack_reason")))
+            ack = True
+        elif nacked:
+            calls.append((send_message, [str(message_id)],
+                          policy.backoff(nacks + 1)))
+        if ack and "subscription" in metadata:
+            calls.append((scheduler_ack, [metadata["subscription"]]))
+    if values:
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE %s AS o SET "
+            "delivered = o.delivered OR v.delivered, "
+            "nacks = o.nacks + v.nacks, "
+            "metadata = o.metadata || hstore(v.keys, v.vals), "
+            "acked_at = COALESCE(o.acked_at, v.acked_at), "
+            "delivered_at = COALESCE(o.delivered_at, v.delivered_at), "
+            "updated_at = %%s "
+            "FROM (VALUES %s) AS v (id, delivered, nacks, keys, vals, "
+            "acked_at, delivered_at) "
+            "WHERE o.id = v.id" % (
+                Outbound._meta.db_table, ", ".join(values)),
+            params)
+    DeadLetter.objects.record_many(letters)
+    OutboxMessage.objects.enqueue_many(calls)
+    return [vumi_message_id for vumi_message_id in changes
+            if vumi_message_id not in messages]
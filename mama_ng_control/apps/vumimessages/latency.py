@@ -0,0 +1,45 @@
+"""
+Latency of each stage an outbound message goes through.
+
+Outbound records when the scheduler triggered it, when it was created,
+submitted to Vumi, acked and delivered. Each stage's latency is recorded
+as a histogram metric named vumimessage.latency.<stage>:
+
+- create: scheduler trigger to Outbound created
+- send: created to submitted to Vumi
+- ack: submitted to acked
+- delivery: submitted to delivery report
+- total: scheduler trigger to delivery report
+"""
+from datetime import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from mama_ng_control.metrics import metrics
+
+
+def parse_timestamp(value):
+    """
+    Returns an aware datetime for an ISO 8601 or Vumi timestamp, which
+    are in UTC when they have no offset, or None if it can't be parsed
+    """
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = parse_datetime(value or "")
+        except ValueError:
+            return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
+
+
+def record_latency(stage, start, end):
+    if start is None or end is None:
+        return
+    metrics.record_histogram(
+        "vumimessage.latency.%s" % stage,
+        max((end - start).total_seconds(), 0), settings.LATENCY_BUCKETS)
@@ -0,0 +1,74 @@
+import json
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+
+from mama_ng_control.apps.contacts.models import Contact
+from mama_ng_control.apps.vumimessages.models import Outbound
+from mama_ng_control.apps.vumimessages.views import EventListener
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+
+    help = ("Times delivery report events against a growing Outbound table. "
+            "Everything it creates is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='1000,10000,100000',
+            help='Comma separated numbers of extra outbounds to time at')
+        parser.add_argument(
+            '--events', type=int, default=200,
+            help='Number of events to time at each size')
+        parser.add_argument(
+            '--chunk-size', type=int, default=5000,
+            help='Number of outbounds to insert per query')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, options):
+        view = EventListener.as_view()
+        factory = RequestFactory()
+        contact = Contact.objects.create(details={})
+        created = 0
+        self.stdout.write("outbounds\tmean ms\tp95 ms")
+        for size in [int(s) for s in options['sizes'].split(',')]:
+            while created < size:
+                count = min(options['chunk_size'], size - created)
+                Outbound.objects.bulk_create([
+                    Outbound(contact=contact, vumi_message_id=uuid.uuid4().hex,
+                             metadata={})
+                    for _ in range(count)])
+                created += count
+            message_ids = list(Outbound.objects.filter(
+                contact=contact).order_by('?').values_list(
+                    'vumi_message_id', flat=True)[:options['events']])
+            timings = []
+            for message_id in message_ids:
+                request = factory.post('/api/v1/messages/events', json.dumps({
+                    "message_type": "event",
+                    "event_type": "delivery_report",
+                    "event_id": uuid.uuid4().hex,
+                    "user_message_id": message_id,
+                    "timestamp": "2015-10-28 16:19:37.485612",
+                }), content_type='application/json')
+                start = time.time()
+                view(request)
+                timings.append((time.time() - start) * 1000)
+            timings.sort()
+            self.stdout.write("%s\t%.2f\t%.2f" % (
+                created, sum(timings) / len(timings),
+                timings[int(len(timings) * 0.95) - 1]))
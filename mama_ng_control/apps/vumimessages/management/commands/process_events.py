@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mama_ng_control.apps.vumimessages.tasks import process_events
+
+
+class Command(BaseCommand):
+
+    help = ("Applies buffered Vumi events in batches. Several can run side "
+            "by side.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.VUMI_EVENTS_BATCH_SIZE,
+            help='Number of events to apply per transaction')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait when no events are buffered')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once no events are buffered')
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            count = process_events.process(options['batch_size'])
+            processed += count
+            if count < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write("Processed %s events" % processed)
@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mama_ng_control.apps.outbox.models import OutboxMessage
+from mama_ng_control.apps.vumimessages.models import DeadLetter
+from mama_ng_control.apps.vumimessages.tasks import send_message
+
+
+class Command(BaseCommand):
+
+    help = ("Sends dead lettered outbound messages again at a steady rate, "
+            "with fresh retry budgets.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rate', type=int, default=10,
+            help='Number of messages to redrive a second')
+        parser.add_argument(
+            '--reason', choices=[c[0] for c in DeadLetter.REASON_CHOICES],
+            help='Only redrive dead letters given up on for this reason')
+        parser.add_argument(
+            '--limit', type=int,
+            help='Most messages to redrive')
+
+    def handle(self, *args, **options):
+        redriven = 0
+        limit = options['limit']
+        while limit is None or redriven < limit:
+            started = time.time()
+            batch_size = options['rate']
+            if limit is not None:
+                batch_size = min(batch_size, limit - redriven)
+            with transaction.atomic():
+                outbound_ids = DeadLetter.objects.redrive(
+                    batch_size, reason=options['reason'])
+                # in batch mode send_outbounds picks them up as unsent
+                if settings.VUMI_SEND_MODE != "batch":
+                    OutboxMessage.objects.enqueue_many([
+                        (send_message, [str(outbound_id)])
+                        for outbound_id in outbound_ids])
+            OutboxMessage.objects.relay(len(outbound_ids))
+            redriven += len(outbound_ids)
+            if len(outbound_ids) < batch_size:
+                break
+            time.sleep(max(0, 1 - (time.time() - started)))
+        self.stdout.write("Redrove %s dead letters" % redriven)
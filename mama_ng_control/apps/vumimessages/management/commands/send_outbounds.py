@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mama_ng_control.apps.vumimessages.tasks import send_outbounds
+
+
+class Command(BaseCommand):
+
+    help = ("Sends unsent outbound messages in concurrent batches. Several "
+            "can run side by side.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int,
+            default=settings.VUMI_SEND_BATCH_SIZE,
+            help='Number of messages to send per transaction')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait when no messages are ready to send')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Exit once no messages are ready to send')
+
+    def handle(self, *args, **options):
+        handled = 0
+        while True:
+            count = send_outbounds.send_batch(options['batch_size'])
+            handled += count
+            if count < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write("Handled %s outbound messages" % handled)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vumimessages', '0002_created_at_id_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outbound',
+            name='generation',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='outbound',
+            name='sequence_number',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outbound',
+            name='subscription',
+            field=models.UUIDField(null=True, blank=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='outbound',
+            unique_together=set([('subscription', 'sequence_number', 'generation')]),
+        ),
+    ]
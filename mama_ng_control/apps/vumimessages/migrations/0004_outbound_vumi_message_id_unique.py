@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vumimessages', '0003_outbound_subscription_sequence'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outbound',
+            name='vumi_message_id',
+            field=models.CharField(max_length=36, unique=True, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vumimessages', '0004_outbound_vumi_message_id_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('user_message_id', models.CharField(max_length=36)),
+                ('event_id', models.CharField(max_length=36)),
+                ('event_type', models.CharField(max_length=20)),
+                ('timestamp', models.CharField(max_length=32)),
+                ('nack_reason', models.TextField(null=True, blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vumimessages', '0005_pendingevent'),
+    ]
+
+    operations = [
+        # keeps claiming unsent messages cheap as sent ones pile up
+        migrations.RunSQL(
+            "CREATE INDEX vumimessages_outbound_unsent "
+            "ON vumimessages_outbound (created_at) "
+            "WHERE vumi_message_id IS NULL",
+            "DROP INDEX vumimessages_outbound_unsent"),
+    ]
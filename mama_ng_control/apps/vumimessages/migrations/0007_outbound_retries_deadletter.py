@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vumimessages', '0006_outbound_unsent_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeadLetter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('reason', models.CharField(max_length=20, choices=[(b'http', b'HTTP errors'), (b'nack', b'Nacks'), (b'attempts', b'Attempts'), (b'address', b'No address')])),
+                ('detail', models.TextField(null=True, blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('redriven_at', models.DateTimeField(null=True, blank=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='outbound',
+            name='failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='outbound',
+            name='nacks',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='outbound',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='deadletter',
+            name='outbound',
+            field=models.ForeignKey(related_name='dead_letters', to='vumimessages.Outbound'),
+        ),
+        migrations.AlterIndexTogether(
+            name='deadletter',
+            index_together=set([('redriven_at', 'id')]),
+        ),
+    ]
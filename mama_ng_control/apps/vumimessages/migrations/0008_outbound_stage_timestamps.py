@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+# Vumi timestamps are naive UTC, e.g. 2015-10-28 16:19:37.485612
+TIMESTAMP = r"'^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?$'"
+
+
+def backfill(column, key):
+    return (
+        "UPDATE vumimessages_outbound "
+        "SET %(column)s = (metadata -> '%(key)s')::timestamp "
+        "AT TIME ZONE 'UTC' "
+        "WHERE %(column)s IS NULL AND metadata -> '%(key)s' ~ %(pattern)s" % {
+            "column": column, "key": key, "pattern": TIMESTAMP})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vumimessages', '0007_outbound_retries_deadletter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outbound',
+            name='acked_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outbound',
+            name='delivered_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outbound',
+            name='sent_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='outbound',
+            name='triggered_at',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        # ack and delivery times were only kept in metadata before
+        migrations.RunSQL(backfill("acked_at", "ack_timestamp"),
+                          migrations.RunSQL.noop),
+        migrations.RunSQL(backfill("delivered_at", "delivery_timestamp"),
+                          migrations.RunSQL.noop),
+    ]
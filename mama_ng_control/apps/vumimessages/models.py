@@ -1,16 +1,86 @@
 import uuid
+from datetime import timedelta
 
 from django.contrib.postgres.fields import HStoreField
-from django.db import models
+from django.db import connection, models, transaction
+from django.utils import timezone
 
 from mama_ng_control.apps.contacts.models import Contact
 
 
+class OutboundManager(models.Manager):
+
+    def claim_unsent(self, batch_size, max_attempts, now, lease):
+        """
+        Leases and returns up to batch_size of the oldest messages that
+        have no vumi_message_id yet, with their contacts. Messages that
+        failed are only claimed again once their next_attempt_at has
+        passed. The lease moves next_attempt_at lease seconds ahead in its
+        own short transaction, so other senders skip the messages while
+        they're sent without holding any row locks, and messages whose
+        results are never recorded are claimed again once it runs out.
+        """
+        table = self.model._meta.db_table
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(
+                "UPDATE %s SET next_attempt_at = %%s WHERE id IN ("
+                "SELECT id FROM %s WHERE vumi_message_id IS NULL "
+                "AND attempts < %%s "
+                "AND (next_attempt_at IS NULL OR next_attempt_at <= %%s) "
+                "ORDER BY created_at LIMIT %%s FOR UPDATE SKIP LOCKED) "
+                "RETURNING id" % (table, table),
+                [now + timedelta(seconds=lease), max_attempts, now,
+                 batch_size])
+            ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return []
+        return list(self.select_related('contact').filter(
+            id__in=ids).order_by('created_at'))
+
+    def record_attempts(self, attempts):
+        """
+        Stores many send results in one UPDATE. Expects (id, attempts,
+        failures, next_attempt_at, vumi_message_id, sent_at) tuples, with
+        vumi_message_id and sent_at None for failures. Replacing
+        next_attempt_at also ends the lease from claim_unsent.
+        """
+        if not attempts:
+            return
+        values = ", ".join(
+            ["(%s::uuid, %s::integer, %s::integer, %s::timestamptz, "
+             "%s::varchar, %s::timestamptz)"] * len(attempts))
+        params = [timezone.now()]
+        for attempt in attempts:
+            params.extend(attempt)
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE %s AS o SET "
+            "attempts = v.attempts, "
+            "failures = v.failures, "
+            "next_attempt_at = v.next_attempt_at, "
+            "vumi_message_id = COALESCE(v.vumi_message_id, "
+            "o.vumi_message_id), "
+            "sent_at = COALESCE(v.sent_at, o.sent_at), "
+            "updated_at = %%s "
+            "FROM (VALUES %s) AS v "
+            "(id, attempts, failures, next_attempt_at, vumi_message_id, "
+            "sent_at) "
+            "WHERE o.id = v.id" % (self.model._meta.db_table, values),
+            params)
+
+
 class Outbound(models.Model):
 
     """
     Contacts outbound messages and their status.
     Delivered is set to true when ack received because delivery reports patchy
+    Subscription messages are unique on subscription, sequence_number and
+    generation, so repeated send triggers do not create duplicates.
+    Failed sends and nacks are counted separately, each against its own
+    retry budget.
+    The *_at stage timestamps record when the scheduler triggered the
+    message and when it was sent, acked and delivered.
     """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     contact = models.ForeignKey(Contact,
@@ -18,13 +88,30 @@ class Outbound(models.Model):
                                 null=False)
     version = models.IntegerField(default=1)
     content = models.CharField(null=True, blank=True, max_length=1000)
-    vumi_message_id = models.CharField(null=True, blank=True, max_length=36)
+    vumi_message_id = models.CharField(null=True, blank=True, max_length=36,
+                                       unique=True)
     delivered = models.BooleanField(default=False)
     attempts = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    nacks = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
     metadata = HStoreField()
+    subscription = models.UUIDField(null=True, blank=True)
+    sequence_number = models.IntegerField(null=True, blank=True)
+    generation = models.IntegerField(default=0)
+    triggered_at = models.DateTimeField(null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    acked_at = models.DateTimeField(null=True, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = OutboundManager()
+
+    class Meta:
+        index_together = (('created_at', 'id'),)
+        unique_together = (('subscription', 'sequence_number', 'generation'),)
+
     def __str__(self):  # __unicode__ on Python 2
         return str(self.id)
 
@@ -46,16 +133,139 @@ class Inbound(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        index_together = (('created_at', 'id'),)
+
     def __str__(self):  # __unicode__ on Python 2
         return str(self.id)
 
+
+class DeadLetterManager(models.Manager):
+
+    def record_many(self, letters):
+        """
+        Stores (outbound_id, reason, detail) tuples with one INSERT
+        """
+        return self.bulk_create([
+            self.model(outbound_id=outbound_id, reason=reason, detail=detail)
+            for outbound_id, reason, detail in letters])
+
+    def redrive(self, batch_size, reason=None):
+        """
+        Marks up to batch_size of the oldest dead letters redriven and
+        resets their messages to be sent again with fresh retry budgets.
+        Rows claimed by another redrive are skipped. Returns the outbound
+        ids.
+        """
+        table = self.model._meta.db_table
+        now = timezone.now()
+        params = [now]
+        condition = "redriven_at IS NULL"
+        if reason is not None:
+            condition += " AND reason = %s"
+            params.append(reason)
+        params.append(batch_size)
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(
+                "UPDATE %s SET redriven_at = %%s WHERE id IN ("
+                "SELECT id FROM %s WHERE %s ORDER BY id LIMIT %%s "
+                "FOR UPDATE SKIP LOCKED) RETURNING outbound_id" % (
+                    table, table, condition),
+                params)
+            outbound_ids = list(set(row[0] for row in cursor.fetchall()))
+            Outbound.objects.filter(id__in=outbound_ids).update(
+                attempts=0, failures=0, nacks=0, next_attempt_at=None,
+                vumi_message_id=None, updated_at=now)
+        return outbound_ids
+
+
+class DeadLetter(models.Model):
+
+    """
+    Outbound messages given up on after running out of retries, kept to
+    be redriven once the cause has cleared
+    """
+    HTTP = "http"
+    NACK = "nack"
+    ATTEMPTS = "attempts"
+    ADDRESS = "address"
+    REASON_CHOICES = (
+        (HTTP, "HTTP errors"),
+        (NACK, "Nacks"),
+        (ATTEMPTS, "Attempts"),
+        (ADDRESS, "No address"),
+    )
+    outbound = models.ForeignKey(Outbound, related_name='dead_letters')
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    detail = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    redriven_at = models.DateTimeField(null=True, blank=True)
+
+    objects = DeadLetterManager()
+
+    class Meta:
+        index_together = (('redriven_at', 'id'),)
+
+    def __str__(self):  # __unicode__ on Python 2
+        return "%s %s" % (self.reason, self.outbound_id)
+
+
+class PendingEventManager(models.Manager):
+
+    def claim(self, batch_size):
+        """
+        Removes and returns up to batch_size of the oldest events as
+        dicts, skipping rows claimed by another worker. Call this inside
+        the transaction that applies them.
+        """
+        table = self.model._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute(
+            "DELETE FROM %s WHERE id IN ("
+            "SELECT id FROM %s ORDER BY id LIMIT %%s FOR UPDATE SKIP LOCKED) "
+            "RETURNING id, user_message_id, event_type, timestamp, "
+            "nack_reason" % (table, table),
+            [batch_size])
+        events = [
+            {"id": row[0], "user_message_id": row[1], "event_type": row[2],
+             "timestamp": row[3], "nack_reason": row[4]}
+            for row in cursor.fetchall()]
+        for event in events:
+            if event["nack_reason"] is None:
+                del event["nack_reason"]
+        return sorted(events, key=lambda event: event["id"])
+
+
+class PendingEvent(models.Model):
+
+    """
+    Vumi events accepted but not yet applied to their Outbound, when
+    VUMI_EVENTS_FAST_ACCEPT is on
+    """
+    user_message_id = models.CharField(max_length=36)
+    event_id = models.CharField(max_length=36)
+    event_type = models.CharField(max_length=20)
+    timestamp = models.CharField(max_length=32)
+    nack_reason = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = PendingEventManager()
+
+    def __str__(self):  # __unicode__ on Python 2
+        return "%s %s" % (self.event_type, self.user_message_id)
+
+
 # Make sure new messages are sent
+from django.conf import settings
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from mama_ng_control.apps.outbox.models import OutboxMessage
 from .tasks import send_message
 
 
 @receiver(post_save, sender=Outbound)
 def fire_msg_action_if_new(sender, instance, created, **kwargs):
-    if created:
-        send_message.delay(str(instance.id))
+    # in batch mode the send_outbounds task picks new messages up
+    if created and settings.VUMI_SEND_MODE != "batch":
+        OutboxMessage.objects.enqueue(send_message, str(instance.id))
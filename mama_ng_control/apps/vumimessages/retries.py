@@ -0,0 +1,56 @@
+"""
+Retry policies for outbound messages.
+
+HTTP failures and nacks each have their own budget, so a run of Vumi 5xx
+errors doesn't use up a message's nack retries or the other way round.
+Retries back off exponentially with jitter, which spreads out messages
+that failed together.
+"""
+import random
+
+from django.conf import settings
+
+
+class RetryPolicy(object):
+
+    """
+    Exponential backoff with jitter over a fixed budget of retries.
+
+    :param int budget:
+        Retries allowed before a message is given up on.
+
+    :param float base:
+        Seconds before the first retry, doubled for each one after.
+
+    :param float cap:
+        Most seconds to wait before a retry.
+    """
+
+    def __init__(self, budget, base, cap, random=random.random):
+        self.budget = budget
+        self.base = base
+        self.cap = cap
+        self.random = random
+
+    def exhausted(self, failures):
+        return failures > self.budget
+
+    def backoff(self, failures):
+        """
+        Returns the seconds to wait after the given number of failures,
+        between half and all of the exponential delay
+        """
+        delay = float(min(self.cap, self.base * 2 ** max(failures - 1, 0)))
+        return int(delay / 2 + delay / 2 * self.random())
+
+
+def http_policy():
+    return RetryPolicy(settings.VUMI_HTTP_RETRY_BUDGET,
+                       settings.VUMI_RETRY_BACKOFF_BASE,
+                       settings.VUMI_RETRY_BACKOFF_CAP)
+
+
+def nack_policy():
+    return RetryPolicy(settings.VUMI_NACK_RETRY_BUDGET,
+                       settings.VUMI_RETRY_BACKOFF_BASE,
+                       settings.VUMI_RETRY_BACKOFF_CAP)
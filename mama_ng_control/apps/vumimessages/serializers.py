@@ -9,7 +9,10 @@ class OutboundSerializer(serializers.HyperlinkedModelSerializer):
         model = Outbound
         fields = (
             'url', 'id', 'version', 'contact', 'vumi_message_id', 'content',
-            'delivered', 'attempts', 'metadata', 'created_at', 'updated_at')
+            'delivered', 'attempts', 'metadata', 'triggered_at', 'sent_at',
+            'acked_at', 'delivered_at', 'created_at', 'updated_at')
+        read_only_fields = (
+            'triggered_at', 'sent_at', 'acked_at', 'delivered_at')
 
 
 class InboundSerializer(serializers.HyperlinkedModelSerializer):
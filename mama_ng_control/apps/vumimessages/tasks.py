@@ -1,18 +1,31 @@
+import random
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
 from celery.task import Task
 from celery.utils.log import get_task_logger
 from celery.exceptions import SoftTimeLimitExceeded
-from go_http.send import HttpApiSender
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 
+from mama_ng_control.apps.contacts.cache import address_cache
+from mama_ng_control.apps.outbox.models import OutboxMessage
 from mama_ng_control.apps.subscriptions.models import Subscription
-from mama_ng_control.scheduler.client import SchedulerApiClient
+from mama_ng_control.circuit_breaker import CircuitOpenError
+from mama_ng_control.http_clients import scheduler_api, sessions, vumi_sender
+from mama_ng_control.metrics import metrics
+from mama_ng_control.rate_limit import send_limiter
 
 logger = get_task_logger(__name__)
 
-from .models import Outbound
+from .latency import record_latency
+from .models import DeadLetter, Outbound, PendingEvent
+from .retries import http_policy
 
 
 class Send_Metric(Task):
@@ -31,11 +44,7 @@ class Send_Metric(Task):
         """
 
     def vumi_client(self):
-        return HttpApiSender(
-            account_key=settings.VUMI_ACCOUNT_KEY,
-            conversation_key=settings.VUMI_CONVERSATION_KEY,
-            conversation_token=settings.VUMI_ACCOUNT_TOKEN
-        )
+        return vumi_sender()
         # return LoggingSender('go_http.test')
 
     def run(self, metric, value, agg, **kwargs):
@@ -62,6 +71,48 @@ class Send_Metric(Task):
 send_metric = Send_Metric()
 
 
+class Send_Metrics(Task):
+
+    """
+    Task to fire a batch of metrics aggregated by a worker process
+    """
+    name = "mama_ng_control.apps.vumimessages.tasks.send_metrics"
+
+    def vumi_client(self):
+        return vumi_sender()
+
+    def run(self, batch, **kwargs):
+        """
+        Expects a list of [metric, value, agg]. Returns the number fired.
+        Metrics are best effort, so the rest of the batch is dropped
+        rather than retried when Vumi can't be reached, which would
+        double count the sums already fired.
+        """
+        l = self.get_logger(**kwargs)
+        fired = 0
+        try:
+            sender = self.vumi_client()
+            for metric, value, agg in batch:
+                l.info("Firing metric: %r [%s] -> %g" % (
+                    metric, agg, float(value)))
+                sender.fire_metric(metric, value, agg=agg)
+                fired += 1
+            return fired
+
+        except RequestException as e:
+            logger.warning("Dropped %s of %s metrics: %s" % (
+                len(batch) - fired, len(batch), e))
+            return fired
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing metrics fire \
+                 via Celery.',
+                exc_info=True)
+
+send_metrics = Send_Metrics()
+
+
 class Scheduler_Ack(Task):
 
     """
@@ -77,10 +128,7 @@ class Scheduler_Ack(Task):
         """
 
     def scheduler_client(self):
-        return SchedulerApiClient(
-            username=settings.SCHEDULER_USERNAME,
-            password=settings.SCHEDULER_PASSWORD,
-            api_url=settings.SCHEDULER_URL)
+        return scheduler_api()
 
     def run(self, subscription_id, **kwargs):
         """
@@ -92,16 +140,21 @@ class Scheduler_Ack(Task):
             subscription = Subscription.objects.get(pk=subscription_id)
             scheduler = self.scheduler_client()
             # Call the scheduler and delete the pending message
-            scheduler.delete_message(
-                subscription.metadata["scheduler_message_id"])
+            scheduler.delete_message(subscription.scheduler_message_id)
             l.info("Deleted message <%s> from scheduler id <%s>" % (
-                subscription.metadata["scheduler_message_id"],
-                subscription.metadata["scheduler_subscription_id"]))
+                subscription.scheduler_message_id,
+                subscription.scheduler_schedule_id))
             # remove the message_id in acknowledgement
-            subscription.metadata["scheduler_message_id"] = ""
-            subscription.save()
+            subscription.scheduler_message_id = None
+            subscription.save(
+                update_fields=["scheduler_message_id", "updated_at"])
             return True
 
+        except CircuitOpenError as e:
+            l.info("Deferring ack of <%s>: %s" % (subscription_id, e))
+            self.apply_async(args=[subscription_id], countdown=e.countdown())
+            return False
+
         except ObjectDoesNotExist:
             logger.error('Missing Subscription', exc_info=True)
             return False
@@ -122,6 +175,8 @@ class Send_Message(Task):
     Task to load and contruct message and send them off
     """
     name = "mama_ng_control.apps.vumimessages.tasks.send_message"
+    # retries are bounded by VUMI_HTTP_RETRY_BUDGET instead
+    max_retries = None
 
     class FailedEventRequest(Exception):
 
@@ -131,12 +186,37 @@ class Send_Message(Task):
         """
 
     def vumi_client(self):
-        return HttpApiSender(
-            api_url=settings.VUMI_API_URL,
-            account_key=settings.VUMI_ACCOUNT_KEY,
-            conversation_key=settings.VUMI_CONVERSATION_KEY,
-            conversation_token=settings.VUMI_ACCOUNT_TOKEN
-        )
+        return vumi_sender()
+
+    def limiter(self, message_type):
+        return send_limiter(message_type)
+
+    def give_up(self, message, reason, detail=None):
+        """
+        Moves the message to the dead letter table and lets the scheduler
+        move on
+        """
+        DeadLetter.objects.create(outbound=message, reason=reason,
+                                  detail=detail)
+        metrics.record("vumimessage.deadletter", 1, "sum")
+        if "subscription" in message.metadata:
+            scheduler_ack.delay(message.metadata["subscription"])
+
+    def retry_failure(self, message, exc):
+        """
+        Counts a failed send against the HTTP retry budget and retries
+        after a backoff, or gives up once the budget has run out
+        """
+        Outbound.objects.filter(id=message.id).update(
+            failures=F("failures") + 1)
+        failures = message.failures + 1
+        policy = http_policy()
+        if policy.exhausted(failures):
+            logger.warning("Message <%s> out of HTTP retries: %s" % (
+                message.id, exc))
+            self.give_up(message, DeadLetter.HTTP, str(exc))
+            return None
+        raise self.retry(exc=exc, countdown=policy.backoff(failures))
 
     def run(self, message_id, **kwargs):
         """
@@ -146,19 +226,33 @@ class Send_Message(Task):
 
         l.info("Loading Outbound Message")
         try:
-            message = Outbound.objects.get(id=message_id)
-            if message.attempts < settings.MAMA_NG_CONTROL_MAX_RETRIES:
+            message = Outbound.objects.select_related('contact').get(
+                id=message_id)
+            if message.attempts < int(settings.MAMA_NG_CONTROL_MAX_RETRIES):
                 print("Attempts: %s" % message.attempts)
                 # send or resend
                 sender = self.vumi_client()
                 content = message.content
-                to_addr = message.contact.address("msisdn")
+                to_addr = address_cache.address(message.contact, "msisdn")
                 if len(to_addr) == 0:
                     l.info("Failed to send message <%s>. No address." % (
                         message_id,))
-                    scheduler_ack.delay(
-                        message.metadata["subscription"])
+                    self.give_up(message, DeadLetter.ADDRESS)
                 else:
+                    message_type = ("voice" if "voice_speech_url" in
+                                    message.metadata else "text")
+                    wait = self.limiter(message_type).acquire()
+                    if wait:
+                        # requeue rather than retry, so throttling doesn't
+                        # use up the message's retries. Jitter spreads the
+                        # deferred sends out.
+                        countdown = wait + random.uniform(0, wait)
+                        l.info("Deferring %s message <%s> for %.2fs" % (
+                            message_type, message_id, countdown))
+                        self.apply_async(args=[message_id],
+                                         countdown=countdown)
+                        metrics.record("vumimessage.throttled", 1, "sum")
+                        return None
                     try:
                         if "voice_speech_url" in message.metadata:
                             # Voice message
@@ -174,25 +268,37 @@ class Send_Message(Task):
                                 to_addr[0], content,
                                 session_event="new")
                             l.info("Sent text message to <%s>" % to_addr)
+                        first_send = message.sent_at is None
                         message.attempts += 1
                         message.vumi_message_id = vumiresponse["message_id"]
-                        message.save()
-                        send_metric.delay(metric="vumimessage.tries", value=1,
-                                          agg="sum")
+                        message.sent_at = timezone.now()
+                        message.save(update_fields=[
+                            "attempts", "vumi_message_id", "sent_at",
+                            "updated_at"])
+                        metrics.record("vumimessage.tries", 1, "sum")
+                        if first_send:
+                            record_latency("send", message.created_at,
+                                           message.sent_at)
                     except HTTPError as e:
-                        # retry message sending if in 500 range (3 default
-                        # retries)
-                        if 500 < e.response.status_code < 599:
-                            raise self.retry(exc=e)
+                        # retry message sending if in 500 range
+                        if e.response.status_code >= 500:
+                            return self.retry_failure(message, e)
                         else:
                             raise e
+                    except CircuitOpenError as e:
+                        # deferred without using up the HTTP budget
+                        l.info("Deferring message <%s>: %s" % (
+                            message_id, e))
+                        self.apply_async(args=[message_id],
+                                         countdown=e.countdown())
+                        return None
+                    except RequestException as e:
+                        return self.retry_failure(message, e)
                     return vumiresponse
             else:
                 l.info("Message <%s> at max retries." % str(message_id))
-                send_metric.delay(metric="vumimessage.maxretries", value=1,
-                                  agg="sum")
-                # send scheduler ack
-                scheduler_ack.delay(message.metadata["subscription"])
+                metrics.record("vumimessage.maxretries", 1, "sum")
+                self.give_up(message, DeadLetter.ATTEMPTS)
         except ObjectDoesNotExist:
             logger.error('Missing Outbound message', exc_info=True)
 
@@ -203,3 +309,216 @@ class Send_Message(Task):
                 exc_info=True)
 
 send_message = Send_Message()
+
+
+class Send_Outbounds(Task):
+
+    """
+    Task to send unsent outbounds in batches, many at a time
+    """
+    name = "mama_ng_control.apps.vumimessages.tasks.send_outbounds"
+
+    def vumi_client(self):
+        return vumi_sender()
+
+    def limiter(self, message_type):
+        return send_limiter(message_type)
+
+    def breaker(self):
+        return sessions.breaker("vumi")
+
+    def send(self, sender, message, to_addr):
+        """
+        Returns (vumi_message_id, error, retry), with vumi_message_id None
+        when the send failed and retry False when it shouldn't be tried
+        again. Both are None when the circuit is open and the message
+        wasn't tried.
+        """
+        try:
+            if "voice_speech_url" in message.metadata:
+                response = sender.send_voice(
+                    to_addr, message.content,
+                    speech_url=message.metadata["voice_speech_url"],
+                    session_event="new")
+            else:
+                response = sender.send_text(
+                    to_addr, message.content, session_event="new")
+            return response["message_id"], None, True
+        except CircuitOpenError:
+            return None, None, True
+        except HTTPError as e:
+            logger.warning("Failed to send message <%s>: %s" % (
+                message.id, e))
+            return None, str(e), e.response.status_code >= 500
+        except RequestException as e:
+            logger.warning("Failed to send message <%s>: %s" % (
+                message.id, e))
+            return None, str(e), True
+
+    def send_batch(self, batch_size):
+        """
+        Claims and sends one batch of messages, recording the results
+        afterwards. No transaction is open while sending, claimed messages
+        are leased for VUMI_SEND_LEASE seconds instead. Returns the number
+        of messages handled, which leaves out those held back by the rate
+        limit or an open circuit.
+        """
+        if self.breaker().is_open():
+            return 0
+        max_attempts = int(settings.MAMA_NG_CONTROL_MAX_RETRIES)
+        policy = http_policy()
+        now = timezone.now()
+        messages = Outbound.objects.claim_unsent(
+            batch_size, max_attempts, now, settings.VUMI_SEND_LEASE)
+        address_cache.preload([message.contact for message in messages])
+        sends = []
+        abandoned = []
+        released = []
+        for message in messages:
+            to_addr = address_cache.address(message.contact, "msisdn")
+            message_type = ("voice" if "voice_speech_url" in
+                            message.metadata else "text")
+            if len(to_addr) == 0:
+                logger.info("Failed to send message <%s>. No address." % (
+                    message.id,))
+                abandoned.append((message, DeadLetter.ADDRESS, None))
+            elif self.limiter(message_type).acquire():
+                # left for a later batch
+                released.append(message)
+            else:
+                sends.append((message, to_addr[0]))
+        results = []
+        if sends:
+            sender = self.vumi_client()
+            pool = ThreadPool(min(settings.VUMI_SEND_CONCURRENCY,
+                                  len(sends)))
+            try:
+                results = pool.map(
+                    lambda send: self.send(sender, *send), sends)
+            finally:
+                pool.close()
+        attempts = []
+        latencies = []
+        sent = 0
+        sent_at = timezone.now()
+        for (message, _), (vumi_message_id, error, retry) in zip(
+                sends, results):
+            if vumi_message_id is None and error is None:
+                # left for a later batch
+                released.append(message)
+                continue
+            if vumi_message_id is not None:
+                sent += 1
+                attempts.append((str(message.id), message.attempts + 1,
+                                 message.failures, None, vumi_message_id,
+                                 sent_at))
+                if message.sent_at is None:
+                    latencies.append(message.created_at)
+                continue
+            message.failures += 1
+            if retry and not policy.exhausted(message.failures):
+                attempts.append((
+                    str(message.id), message.attempts, message.failures,
+                    now + timedelta(seconds=policy.backoff(message.failures)),
+                    None, None))
+            else:
+                abandoned.append((message, DeadLetter.HTTP, error))
+        # ends the lease on messages that weren't tried
+        attempts.extend(
+            (str(message.id), message.attempts, message.failures, None, None,
+             None)
+            for message in released)
+        # keeps dead letters from being claimed until redriven
+        attempts.extend(
+            (str(message.id), max_attempts, message.failures, None, None,
+             None)
+            for message, _, _ in abandoned)
+        with transaction.atomic():
+            Outbound.objects.record_attempts(attempts)
+            DeadLetter.objects.record_many(
+                (message.id, reason, detail)
+                for message, reason, detail in abandoned)
+            calls = [(scheduler_ack, [message.metadata["subscription"]])
+                     for message, _, _ in abandoned
+                     if "subscription" in message.metadata]
+            OutboxMessage.objects.enqueue_many(calls)
+        if sent:
+            metrics.record("vumimessage.tries", sent, "sum")
+        for created_at in latencies:
+            record_latency("send", created_at, sent_at)
+        if abandoned:
+            metrics.record("vumimessage.deadletter", len(abandoned), "sum")
+        return len(messages) - len(released)
+
+    def run(self, **kwargs):
+        """
+        Returns the number of messages handled
+        """
+        l = self.get_logger(**kwargs)
+        handled = 0
+        try:
+            for _ in range(settings.VUMI_SEND_MAX_BATCHES):
+                count = self.send_batch(settings.VUMI_SEND_BATCH_SIZE)
+                handled += count
+                if count < settings.VUMI_SEND_BATCH_SIZE:
+                    break
+            l.info("Handled %s outbound messages" % handled)
+            return handled
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed sending outbounds \
+                 via Celery.',
+                exc_info=True)
+            return handled
+
+send_outbounds = Send_Outbounds()
+
+
+# events queues the tasks above
+from .events import apply_events
+
+
+class Process_Events(Task):
+
+    """
+    Task to apply buffered Vumi events in batches
+    """
+    name = "mama_ng_control.apps.vumimessages.tasks.process_events"
+
+    def process(self, batch_size):
+        """
+        Claims and applies one batch of events in a transaction. Returns
+        the number of events claimed.
+        """
+        with transaction.atomic():
+            events = PendingEvent.objects.claim(batch_size)
+            unknown = apply_events(events)
+        if unknown:
+            logger.warning("Dropped events for %s unknown messages" % (
+                len(unknown),))
+        return len(events)
+
+    def run(self, **kwargs):
+        """
+        Returns the number of events processed
+        """
+        l = self.get_logger(**kwargs)
+        processed = 0
+        try:
+            for _ in range(settings.VUMI_EVENTS_MAX_BATCHES):
+                count = self.process(settings.VUMI_EVENTS_BATCH_SIZE)
+                processed += count
+                if count < settings.VUMI_EVENTS_BATCH_SIZE:
+                    break
+            l.info("Processed %s events" % processed)
+            return processed
+
+        except SoftTimeLimitExceeded:
+            logger.error(
+                'Soft time limit exceed processing events \
+                 via Celery.',
+                exc_info=True)
+            return processed
+
+process_events = Process_Events()
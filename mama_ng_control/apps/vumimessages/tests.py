@@ -1,26 +1,49 @@
 import json
+import time
 import uuid
 import logging
+import datetime
+import tempfile
+import threading
+import requests
 import responses
+from redis import RedisError
+from requests.exceptions import HTTPError
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
 from django.db.models.signals import post_save
+from django.utils import timezone
+from django.utils.six import StringIO
 
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 
+from celery.exceptions import Retry
 from go_http.send import LoggingSender
 
-from .models import Inbound, Outbound, fire_msg_action_if_new
-from .tasks import Send_Message, Send_Metric
+from .models import (
+    DeadLetter, Inbound, Outbound, PendingEvent, fire_msg_action_if_new)
+from .retries import RetryPolicy
+from .tasks import (
+    Send_Message, Send_Metric, Send_Metrics, Send_Outbounds, process_events,
+    send_message, send_metrics, send_outbounds)
 from mama_ng_control.apps.contacts.models import Contact
+from mama_ng_control.circuit_breaker import CircuitBreaker, CircuitOpenError
+from mama_ng_control.http_clients import SessionRegistry, sessions
+from mama_ng_control.metrics import MetricsAggregator, http_gauges, metrics
+from mama_ng_control.rate_limit import TokenBucket
 from mama_ng_control.apps.subscriptions.models import (
     Subscription, fire_sub_action_if_new)
 
 Send_Metric.vumi_client = lambda x: LoggingSender('go_http.test')
+Send_Metrics.vumi_client = lambda x: LoggingSender('go_http.test')
 Send_Message.vumi_client = lambda x: LoggingSender('go_http.test')
+Send_Outbounds.vumi_client = lambda x: LoggingSender('go_http.test')
 
 
 class RecordingHandler(logging.Handler):
@@ -125,11 +148,11 @@ class TestVumiMessagesAPI(AuthenticatedAPITestCase):
             "completed": "false",
             "schedule": "1",
             "process_status": "0",
+            "frequency": 10,
+            "scheduler_schedule_id": "1",
+            "scheduler_message_id": "1",
             "metadata": {
-                "source": "RapidProVoice",
-                "frequency": 10,
-                "scheduler_subscription_id": "1",
-                "scheduler_message_id": "1"
+                "source": "RapidProVoice"
             }
         }
         response = self.client.post('/api/v1/subscriptions/',
@@ -210,6 +233,142 @@ class TestVumiMessagesAPI(AuthenticatedAPITestCase):
         self.assertEqual(d.attempts, 1)
         self.assertEqual(d.metadata, {})
 
+    def test_send_deferred_when_throttled(self):
+        outbound_id = self.make_outbound()
+        task = Send_Message()
+        bucket = TokenBucket("test", 1, 1, redis=lambda: None,
+                             clock=lambda: 0)
+        requested = []
+        deferred = []
+        task.limiter = lambda message_type: (
+            requested.append(message_type) or bucket)
+        task.apply_async = lambda **kwargs: deferred.append(kwargs)
+
+        self.assertIn("message_id", task.run(outbound_id))
+        self.assertIsNone(task.run(outbound_id))
+
+        self.assertEqual(requested, ["text", "text"])
+        self.assertEqual(len(deferred), 1)
+        self.assertEqual(deferred[0]["args"], [outbound_id])
+        self.assertTrue(1 <= deferred[0]["countdown"] <= 2)
+        self.assertEqual(Outbound.objects.get(id=outbound_id).attempts, 2)
+
+    def test_send_deferred_when_circuit_open(self):
+        outbound_id = self.make_outbound()
+
+        class OpenCircuitSender(object):
+            def send_text(self, to_addr, content, session_event):
+                raise CircuitOpenError("vumi", 5)
+
+        task = Send_Message()
+        deferred = []
+        task.vumi_client = OpenCircuitSender
+        task.apply_async = lambda **kwargs: deferred.append(kwargs)
+        self.assertIsNone(task.run(outbound_id))
+        self.assertEqual(deferred[0]["args"], [outbound_id])
+        self.assertTrue(5 <= deferred[0]["countdown"] <= 10)
+        d = Outbound.objects.get(id=outbound_id)
+        self.assertEqual((d.attempts, d.failures), (1, 0))
+
+    @override_settings(VUMI_SEND_MODE="batch")
+    def test_send_outbounds(self):
+        nowhere = Contact.objects.create(details={"addresses": ""})
+        text = Outbound.objects.create(
+            contact_id=self.contact, content="Text", metadata={})
+        voice = Outbound.objects.create(
+            contact_id=self.contact, content="Voice",
+            metadata={"voice_speech_url": "https://foo.com/file.mp3"})
+        unreachable = Outbound.objects.create(
+            contact=nowhere, content="Lost", metadata={})
+        # batch mode leaves new messages for the task
+        self.assertEqual(Outbound.objects.filter(
+            vumi_message_id__isnull=True).count(), 3)
+
+        # lease, load with contacts, load addresses, record results, record
+        # the dead letter, and the savepoint queries of both transactions
+        with self.assertNumQueries(9):
+            send_outbounds.send_batch(10)
+
+        text = Outbound.objects.get(id=text.id)
+        self.assertIsNotNone(text.vumi_message_id)
+        self.assertEqual(text.attempts, 1)
+        self.assertIsNotNone(Outbound.objects.get(
+            id=voice.id).vumi_message_id)
+        unreachable = Outbound.objects.get(id=unreachable.id)
+        self.assertIsNone(unreachable.vumi_message_id)
+        self.assertEqual(unreachable.attempts, 3)
+        self.assertEqual(unreachable.dead_letters.get().reason, "address")
+        self.assertEqual(send_outbounds.delay().get(), 0)
+
+    @override_settings(VUMI_SEND_MODE="batch", VUMI_SEND_LEASE=300)
+    def test_send_outbounds_leases_claimed_messages(self):
+        first = Outbound.objects.create(
+            contact_id=self.contact, content="First", metadata={})
+        second = Outbound.objects.create(
+            contact_id=self.contact, content="Second", metadata={})
+        now = timezone.now()
+        claimed = Outbound.objects.claim_unsent(1, 3, now, 300)
+        self.assertEqual([message.id for message in claimed], [first.id])
+        self.assertEqual(
+            Outbound.objects.get(id=first.id).next_attempt_at,
+            now + datetime.timedelta(seconds=300))
+        # another sender only gets what isn't leased
+        self.assertEqual(
+            [message.id for message in
+             Outbound.objects.claim_unsent(10, 3, now, 300)], [second.id])
+        self.assertEqual(Outbound.objects.claim_unsent(10, 3, now, 300), [])
+        # and the lease runs out if the results are never recorded
+        self.assertEqual(len(Outbound.objects.claim_unsent(
+            10, 3, now + datetime.timedelta(seconds=301), 300)), 2)
+
+        # messages held back by the rate limit are released
+        Outbound.objects.update(next_attempt_at=None)
+        task = Send_Outbounds()
+        bucket = TokenBucket("test", 1, 1, redis=lambda: None,
+                             clock=lambda: 0)
+        task.limiter = lambda message_type: bucket
+        self.assertEqual(task.send_batch(10), 1)
+        self.assertEqual(Outbound.objects.filter(
+            vumi_message_id__isnull=True, next_attempt_at=None).count(), 1)
+
+    @override_settings(VUMI_SEND_MODE="batch", VUMI_RETRY_BACKOFF_BASE=0,
+                       VUMI_HTTP_RETRY_BUDGET=2)
+    def test_send_outbounds_retries_failures(self):
+        class UnavailableSender(object):
+            def send_text(self, to_addr, content, session_event):
+                response = requests.Response()
+                response.status_code = 503
+                raise HTTPError(response=response)
+
+        message = Outbound.objects.create(
+            contact_id=self.contact, content="Text", metadata={})
+        task = Send_Outbounds()
+        task.vumi_client = UnavailableSender
+
+        with override_settings(VUMI_RETRY_BACKOFF_BASE=60):
+            self.assertEqual(task.send_batch(10), 1)
+            self.assertEqual(task.send_batch(10), 0)
+        d = Outbound.objects.get(id=message.id)
+        self.assertEqual((d.attempts, d.failures), (0, 1))
+        self.assertTrue(d.next_attempt_at > timezone.now())
+        Outbound.objects.filter(id=message.id).update(next_attempt_at=None)
+        self.assertEqual(task.send_batch(10), 1)
+        self.assertEqual(Outbound.objects.get(id=message.id).failures, 2)
+        self.assertEqual(task.send_batch(10), 1)
+        d = Outbound.objects.get(id=message.id)
+        self.assertEqual((d.attempts, d.failures), (3, 3))
+        self.assertEqual(d.dead_letters.get().reason, "http")
+        self.assertEqual(task.send_batch(10), 0)
+
+        task.vumi_client = lambda: LoggingSender('go_http.test')
+        self.assertEqual(task.send_batch(10), 0)
+        call_command('redrive_dead_letters', stdout=StringIO())
+        self.assertEqual(task.send_batch(10), 1)
+        d = Outbound.objects.get(id=message.id)
+        self.assertIsNotNone(d.vumi_message_id)
+        self.assertEqual((d.attempts, d.failures), (1, 0))
+        self.assertIsNotNone(d.dead_letters.get().redriven_at)
+
     def test_create_outbound_data_simple(self):
         post_outbound = {
             "contact": "/api/v1/contacts/%s/" % self.contact,
@@ -354,10 +513,12 @@ class TestVumiMessagesAPI(AuthenticatedAPITestCase):
         self.assertEqual(d.attempts, 1)
         self.assertEqual(d.metadata["ack_timestamp"],
                          "2015-10-28 16:19:37.485612")
+        self.assertEqual(d.acked_at, datetime.datetime(
+            2015, 10, 28, 16, 19, 37, 485612, tzinfo=timezone.utc))
         self.assertEquals(False, self.check_logs(
             "Message: u'Simple outbound message' sent to u'+27123'"))
         s = Subscription.objects.get(pk=d.metadata["subscription"])
-        self.assertEqual(s.metadata["scheduler_message_id"], "")
+        self.assertIsNone(s.scheduler_message_id)
 
     def test_event_delivery_report(self):
         existing = self.make_outbound()
@@ -381,9 +542,47 @@ class TestVumiMessagesAPI(AuthenticatedAPITestCase):
         self.assertEqual(d.attempts, 1)
         self.assertEqual(d.metadata["delivery_timestamp"],
                          "2015-10-28 16:20:37.485612")
+        self.assertEqual(d.delivered_at, datetime.datetime(
+            2015, 10, 28, 16, 20, 37, 485612, tzinfo=timezone.utc))
         self.assertEquals(False, self.check_logs(
             "Message: u'Simple outbound message' sent to u'+27123'"))
 
+    def test_event_delivery_report_queries(self):
+        existing = self.make_outbound()
+        d = Outbound.objects.get(pk=existing)
+        dr = {
+            "message_type": "event",
+            "event_id": "b04ec322fc1c4819bc3f28e6e0c69de6",
+            "event_type": "delivery_report",
+            "user_message_id": d.vumi_message_id,
+            "timestamp": "2015-10-28 16:20:37.485612",
+        }
+        self.client.credentials()  # Vumi posts events without a token
+        # one indexed lookup and one narrow update
+        with self.assertNumQueries(2):
+            self.client.post('/api/v1/messages/events', json.dumps(dr),
+                             content_type='application/json')
+
+    def test_vumi_message_id_unique(self):
+        existing = self.make_outbound()
+        d = Outbound.objects.get(pk=existing)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Outbound.objects.create(contact=d.contact,
+                                        vumi_message_id=d.vumi_message_id,
+                                        metadata={})
+
+    def test_benchmark_events(self):
+        before = Outbound.objects.count()
+        stdout = tempfile.TemporaryFile()
+        call_command('benchmark_events', sizes='10,20', events=5,
+                     stdout=stdout)
+        stdout.seek(0)
+        lines = stdout.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[2].startswith("20\t"))
+        self.assertEqual(Outbound.objects.count(), before)
+
     def test_event_nack_first(self):
         existing = self.make_outbound()
         d = Outbound.objects.get(pk=existing)
@@ -459,4 +658,533 @@ class TestVumiMessagesAPI(AuthenticatedAPITestCase):
         #     True,
         #     self.check_logs("Metric: 'vumimessage.maxretries' [sum] -> 1"))
         s = Subscription.objects.get(pk=d.metadata["subscription"])
-        self.assertEqual(s.metadata["scheduler_message_id"], "")
+        self.assertIsNone(s.scheduler_message_id)
+
+    @responses.activate
+    @override_settings(VUMI_NACK_RETRY_BUDGET=1)
+    def test_event_nack_out_of_retries(self):
+        existing = self.make_outbound()
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/messages/1",
+            json.dumps({}), status=200, content_type='application/json')
+        d = Outbound.objects.get(pk=existing)
+        for reason in ("busy", "no answer"):
+            nack = self.make_event("nack", d.vumi_message_id,
+                                   nack_reason=reason)
+            self.client.post('/api/v1/messages/events', json.dumps(nack),
+                             content_type='application/json')
+            d = Outbound.objects.get(pk=existing)
+
+        # resent after the first nack, given up on after the second
+        self.assertEqual((d.attempts, d.nacks), (2, 2))
+        letter = DeadLetter.objects.get()
+        self.assertEqual((letter.outbound_id, letter.reason, letter.detail),
+                         (d.id, "nack", "no answer"))
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    @override_settings(VUMI_HTTP_RETRY_BUDGET=2, VUMI_RETRY_BACKOFF_BASE=0)
+    def test_send_out_of_http_retries(self):
+        outbound_id = self.make_outbound()
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/messages/1",
+            json.dumps({}), status=200, content_type='application/json')
+
+        class UnavailableSender(object):
+            def send_text(self, to_addr, content, session_event):
+                response = requests.Response()
+                response.status_code = 502
+                raise HTTPError(response=response)
+
+        Send_Message.vumi_client = lambda x: UnavailableSender()
+        try:
+            # retries run eagerly, then the first call's Retry propagates
+            with self.assertRaises(Retry):
+                send_message.delay(outbound_id)
+        finally:
+            Send_Message.vumi_client = lambda x: LoggingSender(
+                'go_http.test')
+
+        d = Outbound.objects.get(pk=outbound_id)
+        self.assertEqual((d.attempts, d.failures), (1, 3))
+        self.assertEqual(d.dead_letters.get().reason, "http")
+        self.assertEqual(len(responses.calls), 1)
+
+    def make_event(self, event_type, vumi_message_id, **kwargs):
+        event = {
+            "message_type": "event",
+            "event_id": uuid.uuid4().hex,
+            "event_type": event_type,
+            "user_message_id": vumi_message_id,
+            "helper_metadata": {},
+            "timestamp": "2015-10-28 16:19:37.485612",
+            "sent_message_id": "external-id"
+        }
+        event.update(kwargs)
+        return event
+
+    @responses.activate
+    @override_settings(VUMI_EVENTS_FAST_ACCEPT=True)
+    def test_event_fast_accept(self):
+        existing = self.make_outbound()
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/messages/1",
+            json.dumps({}), status=200, content_type='application/json')
+        d = Outbound.objects.get(pk=existing)
+        events = [
+            self.make_event("ack", d.vumi_message_id),
+            self.make_event("delivery_report", d.vumi_message_id,
+                            timestamp="2015-10-28 16:20:37.485612"),
+            self.make_event("ack", d.vumi_message_id,
+                            timestamp="2015-10-28 16:21:37.485612"),
+            self.make_event("ack", "unknown"),
+        ]
+        for event in events:
+            response = self.client.post('/api/v1/messages/events',
+                                        json.dumps(event),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # nothing is applied until the events are processed
+        self.assertEqual(PendingEvent.objects.count(), 4)
+        self.assertFalse(Outbound.objects.get(pk=existing).delivered)
+
+        self.assertEqual(process_events.delay().get(), 4)
+        self.assertEqual(PendingEvent.objects.count(), 0)
+        d = Outbound.objects.get(pk=existing)
+        self.assertEqual(d.delivered, True)
+        self.assertEqual(d.attempts, 1)
+        self.assertEqual(d.metadata["ack_timestamp"],
+                         "2015-10-28 16:21:37.485612")
+        self.assertEqual(d.metadata["delivery_timestamp"],
+                         "2015-10-28 16:20:37.485612")
+        self.assertIn("subscription", d.metadata)
+        # the two acks are coalesced into one scheduler ack
+        self.assertEqual(len(responses.calls), 1)
+        s = Subscription.objects.get(pk=d.metadata["subscription"])
+        self.assertIsNone(s.scheduler_message_id)
+
+    @override_settings(VUMI_EVENTS_FAST_ACCEPT=True)
+    def test_event_fast_accept_nacks(self):
+        existing = self.make_outbound()
+        d = Outbound.objects.get(pk=existing)
+        for reason in ("busy", "no answer"):
+            nack = self.make_event("nack", d.vumi_message_id,
+                                   nack_reason=reason)
+            self.client.post('/api/v1/messages/events', json.dumps(nack),
+                             content_type='application/json')
+        process_events.delay()
+        # resent once
+        d = Outbound.objects.get(pk=existing)
+        self.assertEqual(d.attempts, 2)
+        self.assertEqual(d.metadata["nack_reason"], "no answer")
+
+    @override_settings(VUMI_EVENTS_FAST_ACCEPT=True)
+    def test_event_fast_accept_invalid(self):
+        for event in (self.make_event("bounce", "abc"),
+                      self.make_event("ack", "abc", message_type="user")):
+            response = self.client.post('/api/v1/messages/events',
+                                        json.dumps(event),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(PendingEvent.objects.count(), 0)
+
+    @responses.activate
+    def test_event_batch(self):
+        acked = self.make_outbound()
+        Outbound.objects.filter(pk=acked).update(vumi_message_id="acked")
+        nacked = self.make_outbound()
+        nacked_id = Outbound.objects.get(pk=nacked).vumi_message_id
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/messages/1",
+            json.dumps({}), status=200, content_type='application/json')
+        events = [
+            self.make_event("ack", "acked", event_id="1"),
+            self.make_event("nack", nacked_id, event_id="2",
+                            nack_reason="busy"),
+            self.make_event("ack", "unknown", event_id="3"),
+            self.make_event("bounce", "acked", event_id="4"),
+            {"event_id": "5"},
+        ]
+        response = self.client.post('/api/v1/messages/events/batch',
+                                    json.dumps(events),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["results"], [
+            {"event_id": "1", "accepted": True},
+            {"event_id": "2", "accepted": True},
+            {"event_id": "3", "accepted": False,
+             "reason": "Missing message in control"},
+            {"event_id": "4", "accepted": False,
+             "reason": "Unexpected event_type"},
+            {"event_id": "5", "accepted": False,
+             "reason": "Missing expected body keys"},
+        ])
+        d = Outbound.objects.get(pk=acked)
+        self.assertTrue(d.delivered)
+        self.assertEqual(d.metadata["ack_timestamp"],
+                         "2015-10-28 16:19:37.485612")
+        self.assertEqual(len(responses.calls), 1)
+        d = Outbound.objects.get(pk=nacked)
+        self.assertFalse(d.delivered)
+        self.assertEqual(d.metadata["nack_reason"], "busy")
+        self.assertEqual(d.attempts, 2)
+
+    @override_settings(METRICS_FLUSH_INTERVAL=3600, METRICS_FLUSH_SIZE=1000,
+                       LATENCY_BUCKETS=[60])
+    def test_event_batch_keeps_first_times(self):
+        existing = self.make_outbound()
+        sent_at = timezone.now()
+        Outbound.objects.filter(pk=existing).update(
+            sent_at=sent_at,
+            triggered_at=sent_at - datetime.timedelta(seconds=90))
+        d = Outbound.objects.get(pk=existing)
+        metrics.take()
+        events = [
+            self.make_event("delivery_report", d.vumi_message_id,
+                            event_id=str(seconds),
+                            timestamp=(d.sent_at + datetime.timedelta(
+                                seconds=seconds)).isoformat())
+            for seconds in (30, 120)]
+        self.client.post('/api/v1/messages/events/batch', json.dumps(events),
+                         content_type='application/json')
+        delivered_at = d.sent_at + datetime.timedelta(seconds=30)
+        self.assertEqual(Outbound.objects.get(pk=existing).delivered_at,
+                         delivered_at)
+        # a later report doesn't move it or count again
+        self.client.post('/api/v1/messages/events/batch',
+                         json.dumps(events[1:]),
+                         content_type='application/json')
+        self.assertEqual(Outbound.objects.get(pk=existing).delivered_at,
+                         delivered_at)
+        recorded = dict((metric, value) for metric, value, _ in
+                        metrics.take())
+        self.assertEqual(recorded["vumimessage.latency.delivery.count"], 1)
+        self.assertEqual(recorded["vumimessage.latency.delivery.le_60"], 1)
+        self.assertEqual(recorded["vumimessage.latency.total.count"], 1)
+        self.assertNotIn("vumimessage.latency.total.le_60", recorded)
+
+    @responses.activate
+    @override_settings(VUMI_NACK_RETRY_BUDGET=0)
+    def test_event_batch_nack_out_of_retries(self):
+        nacked = self.make_outbound()
+        d = Outbound.objects.get(pk=nacked)
+        responses.add(
+            responses.DELETE,
+            "http://127.0.0.1:8000/mama-ng-scheduler/rest/messages/1",
+            json.dumps({}), status=200, content_type='application/json')
+        events = [self.make_event("nack", d.vumi_message_id,
+                                  nack_reason="busy")]
+        self.client.post('/api/v1/messages/events/batch',
+                         json.dumps(events), content_type='application/json')
+        d = Outbound.objects.get(pk=nacked)
+        self.assertEqual((d.attempts, d.nacks), (1, 1))
+        self.assertEqual(d.dead_letters.get().detail, "busy")
+        self.assertEqual(len(responses.calls), 1)
+
+    @override_settings(VUMI_EVENTS_FAST_ACCEPT=True)
+    def test_event_batch_fast_accept(self):
+        events = [self.make_event("ack", "abc"),
+                  self.make_event("delivery_report", "abc")]
+        response = self.client.post('/api/v1/messages/events/batch',
+                                    json.dumps(events),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [result["accepted"] for result in response.data["results"]],
+            [True, True])
+        self.assertEqual(PendingEvent.objects.count(), 2)
+
+    def test_event_batch_not_a_list(self):
+        response = self.client.post('/api/v1/messages/events/batch',
+                                    json.dumps(self.make_event("ack", "abc")),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(0.5)
+        self.send_response(500 if self.path == "/error" else 200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("{}")
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSessionRegistry(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        self.url = "http://127.0.0.1:%s" % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.registry = SessionRegistry()
+
+    def tearDown(self):
+        self.registry.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        session = self.registry.session("vumi")
+        for _ in range(3):
+            self.registry.session("vumi").get(self.url + "/")
+        self.assertIs(self.registry.session("vumi"), session)
+        self.assertEqual(self.registry.stats(), {
+            "vumi": {"requests": 3, "connections": 1, "reused": 2}})
+
+    def test_stats_are_published_as_gauges(self):
+        sessions.clear()
+        self.addCleanup(sessions.clear)
+        for _ in range(2):
+            sessions.session("vumi").get(self.url + "/")
+        self.assertEqual(http_gauges(), [
+            ["http.vumi.connections", 1, "last"],
+            ["http.vumi.requests", 2, "last"],
+            ["http.vumi.reused", 1, "last"]])
+
+    def test_sessions_are_replaced_after_fork(self):
+        session = self.registry.session("vumi")
+        self.registry.pid = -1  # as if this process were forked
+        self.assertEqual(self.registry.stats(), {})
+        self.assertIsNot(self.registry.session("vumi"), session)
+
+    @override_settings(CIRCUIT_BREAKER_MIN_CALLS=2)
+    def test_errors_open_the_circuit(self):
+        session = self.registry.session("vumi")
+        for _ in range(2):
+            self.assertEqual(session.get(self.url + "/error").status_code, 500)
+        with self.assertRaises(CircuitOpenError):
+            session.get(self.url + "/")
+        self.assertEqual(self.registry.stats()["vumi"]["requests"], 2)
+
+    @override_settings(HTTP_READ_TIMEOUT=0.1)
+    def test_default_timeout(self):
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.registry.session("vumi").get(self.url + "/slow")
+
+
+class FailingRedis(object):
+
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise RedisError("unavailable")
+        return fail
+
+
+class TestTokenBucket(TestCase):
+
+    def test_rate_and_burst(self):
+        now = [0]
+        bucket = TokenBucket("test", 2, 3, redis=lambda: None,
+                             clock=lambda: now[0])
+        self.assertEqual([bucket.acquire() for _ in range(3)], [0, 0, 0])
+        self.assertEqual(bucket.acquire(), 0.5)
+        now[0] = 0.25
+        self.assertEqual(bucket.acquire(), 0.25)
+        now[0] = 0.5
+        self.assertEqual(bucket.acquire(), 0)
+        now[0] = 100
+        self.assertEqual([bucket.acquire() for _ in range(4)],
+                         [0, 0, 0, 0.5])
+
+    def test_unlimited(self):
+        bucket = TokenBucket("test", 0, 1, redis=lambda: None,
+                             clock=lambda: 0)
+        self.assertEqual([bucket.acquire() for _ in range(5)], [0] * 5)
+
+    def test_falls_back_to_local_bucket(self):
+        bucket = TokenBucket("test", 1, 1, redis=FailingRedis,
+                             clock=lambda: 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 1)
+
+
+class TestRetryPolicy(TestCase):
+
+    def test_backoff(self):
+        lowest = RetryPolicy(3, 30, 100, random=lambda: 0)
+        highest = RetryPolicy(3, 30, 100, random=lambda: 1)
+        self.assertEqual([lowest.backoff(n) for n in range(1, 5)],
+                         [15, 30, 50, 50])
+        self.assertEqual([highest.backoff(n) for n in range(1, 5)],
+                         [30, 60, 100, 100])
+
+    def test_budget(self):
+        policy = RetryPolicy(3, 30, 100)
+        self.assertEqual([policy.exhausted(n) for n in range(5)],
+                         [False, False, False, False, True])
+
+
+@override_settings(METRICS_FLUSH_INTERVAL=60, METRICS_FLUSH_SIZE=5)
+class TestMetricsAggregator(TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.published = []
+        self.aggregator = MetricsAggregator(
+            publish=self.published.append, clock=lambda: self.now[0])
+
+    @override_settings(METRICS_FLUSH_SIZE=100)
+    def test_aggregates(self):
+        for value in (1, 3):
+            for agg in ("sum", "avg", "max", "min", "last"):
+                self.aggregator.record("m.%s" % agg, value, agg)
+        self.assertEqual(self.published, [])
+        self.aggregator.flush()
+        self.assertEqual(self.published, [[
+            ["m.avg", 2.0, "avg"], ["m.last", 3.0, "last"],
+            ["m.max", 3.0, "max"], ["m.min", 1.0, "min"],
+            ["m.sum", 4.0, "sum"]]])
+        self.assertRaises(ValueError, self.aggregator.record, "m", 1, "mean")
+
+    def test_flushes_on_size(self):
+        for _ in range(4):
+            self.aggregator.record("m", 1)
+        self.assertEqual(self.published, [])
+        self.aggregator.record("m", 1)
+        self.assertEqual(self.published, [[["m", 5.0, "sum"]]])
+        self.assertEqual(self.aggregator.flush(), [])
+
+    def test_flushes_on_interval(self):
+        self.aggregator.record("m", 1)
+        self.now[0] = 59
+        self.aggregator.maybe_flush()
+        self.assertEqual(self.published, [])
+        self.now[0] = 60
+        self.aggregator.maybe_flush()
+        self.assertEqual(self.published, [[["m", 1.0, "sum"]]])
+
+    def test_flush_reads_gauges(self):
+        self.aggregator.gauges = lambda: [["g", 2.0, "last"]]
+        self.assertEqual(self.aggregator.flush(), [])
+        self.aggregator.record("m", 1)
+        self.assertEqual(self.aggregator.flush(),
+                         [["m", 1.0, "sum"], ["g", 2.0, "last"]])
+
+    def test_forked_process_starts_empty(self):
+        self.aggregator.record("m", 1)
+        self.aggregator.pid = -1  # as if this process were forked
+        self.aggregator.record("n", 1)
+        self.assertEqual(self.aggregator.flush(), [["n", 1.0, "sum"]])
+
+    def test_send_metrics(self):
+        fired = []
+
+        class RecordingSender(object):
+            def fire_metric(self, metric, value, agg):
+                if metric == "down":
+                    raise requests.ConnectionError("Vumi is down")
+                fired.append([metric, value, agg])
+
+        task = Send_Metrics()
+        task.vumi_client = RecordingSender
+        self.assertEqual(task.run(
+            [["m", 5.0, "sum"], ["n", 2.5, "avg"]]), 2)
+        self.assertEqual(fired, [["m", 5.0, "sum"], ["n", 2.5, "avg"]])
+        # the rest of the batch is dropped rather than retried
+        self.assertEqual(task.run(
+            [["o", 1.0, "sum"], ["down", 1.0, "sum"], ["p", 1.0, "sum"]]),
+            1)
+        self.assertEqual(fired[-1], ["o", 1.0, "sum"])
+        self.assertEqual(send_metrics.delay([["m", 5.0, "sum"]]).get(), 1)
+
+    @override_settings(METRICS_FLUSH_INTERVAL=3600, METRICS_FLUSH_SIZE=1000)
+    def test_sends_record_metrics(self):
+        contact = Contact.objects.create(details={
+            "default_addr_type": "msisdn", "addresses": "msisdn:+27123"})
+        metrics.take()
+        for _ in range(3):
+            Outbound.objects.create(contact=contact, content="Hi",
+                                    metadata={})
+        recorded = dict((metric, value) for metric, value, _ in
+                        metrics.take())
+        self.assertEqual(recorded["vumimessage.tries"], 3)
+        self.assertEqual(recorded["vumimessage.latency.send.count"], 3)
+        for message in Outbound.objects.all():
+            self.assertGreaterEqual(message.sent_at, message.created_at)
+
+    @override_settings(METRICS_FLUSH_SIZE=1000)
+    def test_record_histogram(self):
+        for value in (0.5, 2, 30):
+            self.aggregator.record_histogram("latency", value, [1, 10])
+        self.assertEqual(self.aggregator.take(), [
+            ["latency.avg", 32.5 / 3, "avg"],
+            ["latency.count", 3.0, "sum"],
+            ["latency.le_1", 1.0, "sum"],
+            ["latency.le_10", 2.0, "sum"],
+            ["latency.max", 30.0, "max"],
+        ])
+
+
+@override_settings(CIRCUIT_BREAKER_MIN_CALLS=4, CIRCUIT_BREAKER_ERROR_RATE=0.5,
+                   CIRCUIT_BREAKER_SLOW_CALL=1, CIRCUIT_BREAKER_SLOW_RATE=0.5,
+                   CIRCUIT_BREAKER_WINDOW=30, CIRCUIT_BREAKER_OPEN_SECONDS=60)
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.now = [0]
+        self.breaker = CircuitBreaker("test", redis=lambda: None,
+                                      clock=lambda: self.now[0])
+
+    def call(self, ok=True, elapsed=0.1):
+        probe = self.breaker.before_call()
+        self.breaker.after_call(probe, ok, elapsed)
+        return probe
+
+    def test_opens_on_error_rate(self):
+        for ok in (True, False, True):
+            self.call(ok)
+        self.assertFalse(self.breaker.is_open())
+        self.call(False)
+        self.assertTrue(self.breaker.is_open())
+        with self.assertRaises(CircuitOpenError) as cm:
+            self.call()
+        self.assertEqual(cm.exception.retry_after, 60)
+
+    def test_opens_on_slow_calls(self):
+        for elapsed in (0.1, 2, 0.1, 2):
+            self.call(elapsed=elapsed)
+        self.assertTrue(self.breaker.is_open())
+
+    def test_counts_reset_each_window(self):
+        for ok in (False, False, True):
+            self.call(ok)
+        self.now[0] = 30
+        self.call(False)
+        self.assertFalse(self.breaker.is_open())
+
+    def test_half_open_probe(self):
+        for _ in range(4):
+            self.call(False)
+        self.now[0] = 60
+        probe = self.breaker.before_call()
+        self.assertTrue(probe)
+        # only the probe is let through
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+        self.breaker.after_call(probe, False, 0.1)
+        self.assertTrue(self.breaker.is_open())
+
+        self.now[0] = 120
+        self.assertTrue(self.call())
+        self.assertFalse(self.breaker.is_open())
+        self.assertFalse(self.call(False))
+
+    def test_falls_back_to_local_state(self):
+        breaker = CircuitBreaker("test", redis=FailingRedis,
+                                 clock=lambda: self.now[0])
+        for _ in range(4):
+            breaker.after_call(breaker.before_call(), False, 0.1)
+        self.assertTrue(breaker.is_open())
@@ -11,5 +11,7 @@ router.register(r'inbound', views.InboundViewSet)
 urlpatterns = [
     url('^events$',
         views.EventListener.as_view()),
+    url('^events/batch$',
+        views.EventBatchListener.as_view()),
     url(r'^', include(router.urls)),
 ]
@@ -2,10 +2,13 @@ from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from .models import Outbound, Inbound
+from django.db import transaction
+from mama_ng_control.apps.outbox.models import OutboxMessage
+from .models import Outbound, Inbound, PendingEvent
 from .serializers import OutboundSerializer, InboundSerializer
-from .tasks import send_message, scheduler_ack
+from .events import EVENT_TYPES, apply_event, apply_events
 
 
 class OutboundViewSet(viewsets.ModelViewSet):
@@ -40,40 +43,48 @@ class EventListener(APIView):
     """
     permission_classes = (AllowAny,)
 
+    def buffer(self, data):
+        """
+        Stores the event for the process_events task to apply later
+        """
+        if data["message_type"] != "event":
+            return Response({"accepted": False,
+                             "reason": "Unexpected message_type"},
+                            status=400)
+        if data["event_type"] not in EVENT_TYPES:
+            return Response({"accepted": False,
+                             "reason": "Unexpected event_type"},
+                            status=400)
+        PendingEvent.objects.create(
+            user_message_id=data["user_message_id"],
+            event_id=data["event_id"],
+            event_type=data["event_type"],
+            timestamp=data["timestamp"],
+            nack_reason=data.get("nack_reason"))
+        return Response({"accepted": True}, status=200)
+
     def post(self, request, *args, **kwargs):
         """
-        Checks for expect event types before continuing
+        Checks for expect event types before continuing. With
+        VUMI_EVENTS_FAST_ACCEPT the event is only stored.
         """
 
         try:
             expect = ["message_type", "event_type", "user_message_id",
                       "event_id", "timestamp"]
+            if set(expect).issubset(request.data.keys()) and \
+                    settings.VUMI_EVENTS_FAST_ACCEPT:
+                return self.buffer(request.data)
             if set(expect).issubset(request.data.keys()):
-                # Load message
-                message = Outbound.objects.get(
-                    vumi_message_id=request.data["user_message_id"])
+                # Load message through the vumi_message_id index
+                message = Outbound.objects.only(
+                    "id", "delivered", "nacks", "metadata", "triggered_at",
+                    "sent_at", "acked_at", "delivered_at").get(
+                        vumi_message_id=request.data["user_message_id"])
                 # only expecting `event` on this endpoint
                 if request.data["message_type"] == "event":
-                    event = request.data["event_type"]
                     # expecting ack, nack, delivery_report
-                    if event == "ack":
-                        message.delivered = True
-                        message.metadata["ack_timestamp"] = \
-                            request.data["timestamp"]
-                        message.save()
-                        scheduler_ack.delay(
-                            message.metadata["subscription"])
-                    elif event == "delivery_report":
-                        message.delivered = True
-                        message.metadata["delivery_timestamp"] = \
-                            request.data["timestamp"]
-                        message.save()
-                    elif event == "nack":
-                        if "nack_reason" in request.data:
-                            message.metadata["nack_reason"] = \
-                                request.data["nack_reason"]
-                            message.save()
-                        send_message.delay(str(message.id))
+                    apply_event(message, request.data)
                     # Return
                     status = 200
                     accepted = {"accepted": True}
@@ -90,3 +101,74 @@ class EventListener(APIView):
             accepted = {"accepted": False,
                         "reason": "Missing message in control"}
         return Response(accepted, status=status)
+
+
+class EventBatchListener(APIView):
+
+    """
+    Triggers updates to outbound messages based on a list of Vumi events
+    """
+    permission_classes = (AllowAny,)
+    expect = ["message_type", "event_type", "user_message_id", "event_id",
+              "timestamp"]
+
+    def check(self, event):
+        """
+        Returns the reason to reject the event, or None
+        """
+        if not isinstance(event, dict) or \
+                not set(self.expect).issubset(event.keys()):
+            return "Missing expected body keys"
+        if event["message_type"] != "event":
+            return "Unexpected message_type"
+        if event["event_type"] not in EVENT_TYPES:
+            return "Unexpected event_type"
+
+    def post(self, request, *args, **kwargs):
+        """
+        Expects a list of events and returns whether each was accepted, in
+        order. All of their messages are loaded and updated together.
+        """
+        events = request.data
+        if not isinstance(events, list):
+            return Response({"accepted": False,
+                             "reason": "Expected a list of events"},
+                            status=400)
+        if len(events) > settings.VUMI_EVENTS_BATCH_LIMIT:
+            return Response({"accepted": False,
+                             "reason": "Too many events, limit is %s" % (
+                                 settings.VUMI_EVENTS_BATCH_LIMIT,)},
+                            status=400)
+        results = []
+        valid = []
+        for event in events:
+            reason = self.check(event)
+            result = {"event_id": event.get("event_id")
+                      if isinstance(event, dict) else None,
+                      "accepted": reason is None}
+            if reason is not None:
+                result["reason"] = reason
+            else:
+                valid.append(event)
+            results.append(result)
+
+        if settings.VUMI_EVENTS_FAST_ACCEPT:
+            PendingEvent.objects.bulk_create([
+                PendingEvent(
+                    user_message_id=event["user_message_id"],
+                    event_id=event["event_id"],
+                    event_type=event["event_type"],
+                    timestamp=event["timestamp"],
+                    nack_reason=event.get("nack_reason"))
+                for event in valid])
+            return Response({"results": results}, status=200)
+
+        with transaction.atomic():
+            unknown = set(apply_events(valid))
+        # publish the queued scheduler acks and resends together
+        OutboxMessage.objects.relay(settings.OUTBOX_RELAY_BATCH_SIZE)
+        for result, event in zip(results, events):
+            if result["accepted"] and event["user_message_id"] in unknown:
+                result["accepted"] = False
+                result["reason"] = "Missing message in control"
+        return Response({"results": results}, status=200)
@@ -0,0 +1,217 @@
+"""
+Circuit breakers for the services the tasks call over HTTP.
+
+A breaker counts calls, errors and slow calls in fixed windows. When the
+error or slow call rate crosses its threshold the breaker opens, and calls
+fail straight away with CircuitOpenError instead of waiting out a timeout.
+Once CIRCUIT_BREAKER_OPEN_SECONDS have passed a single probe call is let
+through, which closes the breaker again if it succeeds.
+
+State is kept in Redis when SHARED_STATE_REDIS_URL is set, so one worker
+tripping a breaker spares the rest, and in-process otherwise or while
+Redis is unreachable.
+"""
+import logging
+import random
+import threading
+import time
+
+from redis import RedisError
+from requests.exceptions import RequestException
+
+from django.conf import settings
+
+from mama_ng_control.metrics import metrics
+from mama_ng_control.shared_redis import shared_redis
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(RequestException):
+
+    """
+    The call wasn't made because the service's breaker is open
+    """
+
+    def __init__(self, name, retry_after):
+        super(CircuitOpenError, self).__init__(
+            "Circuit for %s is open, retry after %.1fs" % (name, retry_after))
+        self.name = name
+        self.retry_after = retry_after
+
+    def countdown(self):
+        """
+        Seconds to defer work by, with jitter so deferred work doesn't
+        all come back at once
+        """
+        return self.retry_after + random.uniform(0, self.retry_after)
+
+
+class LocalCircuitState(object):
+
+    """
+    Breaker state for this process only
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.until = None
+            self.probe_until = 0
+            self.counts = {}
+
+    def opened_until(self):
+        return self.until
+
+    def open(self, until):
+        with self.lock:
+            self.until = until
+            self.probe_until = 0
+
+    def try_probe(self, now, ttl):
+        with self.lock:
+            if self.probe_until > now:
+                return False
+            self.probe_until = now + ttl
+            return True
+
+    def record(self, window, error, slow):
+        with self.lock:
+            if window not in self.counts:
+                self.counts = {window: [0, 0, 0]}
+            counts = self.counts[window]
+            counts[0] += 1
+            counts[1] += int(error)
+            counts[2] += int(slow)
+            return tuple(counts)
+
+
+class RedisCircuitState(object):
+
+    """
+    Breaker state shared through Redis
+    """
+
+    def __init__(self, redis, key, window_seconds):
+        self.redis = redis
+        self.key = key
+        self.window_seconds = window_seconds
+
+    def clear(self):
+        keys = [self.key, self.key + ":probe"]
+        keys.extend(self.redis.scan_iter(match=self.key + ":window:*"))
+        self.redis.delete(*keys)
+
+    def opened_until(self):
+        until = self.redis.get(self.key)
+        return None if until is None else float(until)
+
+    def open(self, until):
+        # left to expire if nothing probes, which closes the breaker
+        pipe = self.redis.pipeline()
+        pipe.set(self.key, "%.3f" % until, ex=3600)
+        pipe.delete(self.key + ":probe")
+        pipe.execute()
+
+    def try_probe(self, now, ttl):
+        return bool(self.redis.set(self.key + ":probe", "1",
+                                   ex=max(int(ttl), 1), nx=True))
+
+    def record(self, window, error, slow):
+        key = "%s:window:%s" % (self.key, window)
+        pipe = self.redis.pipeline()
+        pipe.hincrby(key, "total", 1)
+        pipe.hincrby(key, "errors", int(error))
+        pipe.hincrby(key, "slow", int(slow))
+        pipe.expire(key, self.window_seconds * 2)
+        return tuple(pipe.execute()[:3])
+
+
+class CircuitBreaker(object):
+
+    """
+    Breaker for one service.
+
+    :param str name:
+        The service, used in keys, errors and metric names.
+
+    :param callable redis:
+        Returns the shared StrictRedis, or None to keep state in-process.
+    """
+
+    def __init__(self, name, redis=shared_redis, clock=time.time):
+        self.name = name
+        self.redis = redis
+        self.clock = clock
+        self.local = LocalCircuitState()
+
+    def state(self, op, *args):
+        """
+        Runs op on the shared state, or on the local state when Redis
+        isn't configured or fails
+        """
+        redis = self.redis()
+        if redis is not None:
+            shared = RedisCircuitState(
+                redis, "circuit:%s" % self.name,
+                settings.CIRCUIT_BREAKER_WINDOW)
+            try:
+                return getattr(shared, op)(*args)
+            except RedisError:
+                logger.warning("Shared circuit state unavailable for %s" % (
+                    self.name,), exc_info=True)
+        return getattr(self.local, op)(*args)
+
+    def before_call(self):
+        """
+        Raises CircuitOpenError if the call shouldn't be made. Returns True
+        when the call is the probe of a half-open breaker.
+        """
+        until = self.state("opened_until")
+        if until is None:
+            return False
+        now = self.clock()
+        probe_ttl = settings.HTTP_CONNECT_TIMEOUT + settings.HTTP_READ_TIMEOUT
+        if now >= until and self.state("try_probe", now, probe_ttl):
+            return True
+        metrics.record("circuit.%s.rejected" % self.name, 1, "sum")
+        raise CircuitOpenError(self.name, max(until - now, 0) or probe_ttl)
+
+    def after_call(self, probe, ok, elapsed):
+        slow = elapsed >= settings.CIRCUIT_BREAKER_SLOW_CALL
+        if probe:
+            if ok and not slow:
+                self.close()
+            else:
+                self.trip("probe failed")
+            return
+        window = int(self.clock() // settings.CIRCUIT_BREAKER_WINDOW)
+        total, errors, slows = self.state("record", window, not ok, slow)
+        if total < settings.CIRCUIT_BREAKER_MIN_CALLS:
+            return
+        if errors >= total * settings.CIRCUIT_BREAKER_ERROR_RATE:
+            self.trip("%s of %s calls failed" % (errors, total))
+        elif slows >= total * settings.CIRCUIT_BREAKER_SLOW_RATE:
+            self.trip("%s of %s calls were slow" % (slows, total))
+
+    def trip(self, reason):
+        logger.warning("Opening circuit for %s: %s" % (self.name, reason))
+        self.state("open",
+                   self.clock() + settings.CIRCUIT_BREAKER_OPEN_SECONDS)
+        metrics.record("circuit.%s.opened" % self.name, 1, "sum")
+        metrics.record("circuit.%s.open" % self.name, 1, "last")
+
+    def close(self):
+        logger.info("Closing circuit for %s" % self.name)
+        self.state("clear")
+        metrics.record("circuit.%s.open" % self.name, 0, "last")
+
+    def is_open(self):
+        """
+        True while calls would be refused without a probe
+        """
+        until = self.state("opened_until")
+        return until is not None and self.clock() < until
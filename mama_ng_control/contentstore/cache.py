@@ -0,0 +1,191 @@
+"""
+Caching for Messaging Content Store lookups.
+
+Content is the same for every mother on a messageset, so lookups are kept
+in a per-process LRU and, when SHARED_STATE_REDIS_URL is set, in Redis so
+one worker's fetch serves the rest.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from redis import RedisError
+
+from django.conf import settings
+
+from mama_ng_control.shared_redis import shared_redis
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+
+    """
+    Thread-safe LRU cache whose entries expire after a fixed time.
+
+    :param int max_size:
+        Number of entries to keep.
+
+    :param int ttl:
+        Seconds an entry stays valid.
+    """
+
+    def __init__(self, max_size, ttl, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value, or None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= self.clock():
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (self.clock() + self.ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ContentStoreCache(object):
+
+    """
+    Two tier cache of Content Store responses with hit and miss counters.
+
+    :param TTLCache local:
+        The in-process tier.
+
+    :param int shared_ttl:
+        Seconds entries stay in the shared Redis tier.
+
+    :param callable redis:
+        Returns the shared tier's StrictRedis, or None to use only the
+        local tier.
+    """
+    prefix = "contentstore:"
+
+    def __init__(self, local, shared_ttl, redis=shared_redis):
+        self.local = local
+        self.shared_ttl = shared_ttl
+        self.redis = redis
+        self.stats = {
+            "local_hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+        }
+
+    def make_key(self, method, *args):
+        return "%s%s:%s" % (self.prefix, method, json.dumps(
+            args, sort_keys=True, separators=(",", ":")))
+
+    def get_or_fetch(self, key, fetch):
+        value = self.local.get(key)
+        if value is not None:
+            self.stats["local_hits"] += 1
+            return value
+        value = self.shared_get(key)
+        if value is not None:
+            self.stats["shared_hits"] += 1
+            self.local.set(key, value)
+            return value
+        self.stats["misses"] += 1
+        value = fetch()
+        self.local.set(key, value)
+        self.shared_set(key, value)
+        return value
+
+    def shared_get(self, key):
+        redis = self.redis()
+        if redis is None:
+            return None
+        try:
+            value = redis.get(key)
+        except RedisError:
+            logger.warning("Content cache read failed", exc_info=True)
+            return None
+        return None if value is None else json.loads(value)
+
+    def shared_set(self, key, value):
+        redis = self.redis()
+        if redis is None:
+            return
+        try:
+            redis.setex(key, self.shared_ttl, json.dumps(value))
+        except RedisError:
+            logger.warning("Content cache write failed", exc_info=True)
+
+    def invalidate(self, method, *args):
+        """
+        Drops one cached lookup, e.g. invalidate("get_schedule", 1)
+        """
+        key = self.make_key(method, *args)
+        self.local.delete(key)
+        redis = self.redis()
+        if redis is not None:
+            redis.delete(key)
+
+    def invalidate_all(self):
+        """
+        Empties the shared tier and this process's local tier. Other
+        processes' local tiers expire within CONTENTSTORE_CACHE_LOCAL_TTL.
+        """
+        self.local.clear()
+        redis = self.redis()
+        if redis is not None:
+            keys = list(redis.scan_iter(match=self.prefix + "*"))
+            if keys:
+                redis.delete(*keys)
+
+
+class CachedContentStoreApiClient(object):
+
+    """
+    Wraps a ContentStoreApiClient so the lookups the subscription tasks
+    make are served from a ContentStoreCache.
+    """
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+
+    def cached_call(self, method, *args):
+        return self.cache.get_or_fetch(
+            self.cache.make_key(method, *args),
+            lambda: getattr(self.client, method)(*args))
+
+    def get_schedule(self, schedule_id):
+        return self.cached_call("get_schedule", schedule_id)
+
+    def get_messageset_messages(self, messageset_id):
+        return self.cached_call("get_messageset_messages", messageset_id)
+
+    def get_messages(self, params=None):
+        return self.cached_call("get_messages", params)
+
+    def get_message_content(self, message_id):
+        return self.cached_call("get_message_content", message_id)
+
+
+content_cache = ContentStoreCache(
+    local=TTLCache(settings.CONTENTSTORE_CACHE_SIZE,
+                   settings.CONTENTSTORE_CACHE_LOCAL_TTL),
+    shared_ttl=settings.CONTENTSTORE_CACHE_SHARED_TTL)
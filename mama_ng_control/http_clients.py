@@ -0,0 +1,146 @@
+"""
+HTTP clients shared by the tasks in each worker process.
+
+Each service gets one requests Session per process, so connections are
+kept alive and reused between task runs instead of being set up for every
+send. Sessions are recreated after a fork, as Celery prefork workers
+can't share sockets with their parent. Every call goes through the
+service's circuit breaker.
+"""
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from go_http.send import HttpApiSender
+from client.messaging_contentstore.contentstore import ContentStoreApiClient
+
+from mama_ng_control.circuit_breaker import CircuitBreaker
+from mama_ng_control.scheduler.client import SchedulerApiClient
+
+
+class TimeoutSession(requests.Session):
+
+    """
+    A Session that applies the configured connect and read timeouts to
+    requests that don't set their own, and reports each call's outcome to
+    a CircuitBreaker when given one. 5xx responses count as errors.
+    """
+
+    def __init__(self, breaker=None):
+        super(TimeoutSession, self).__init__()
+        self.breaker = breaker
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (settings.HTTP_CONNECT_TIMEOUT,
+                                      settings.HTTP_READ_TIMEOUT))
+        if self.breaker is None:
+            return super(TimeoutSession, self).request(method, url, **kwargs)
+        probe = self.breaker.before_call()
+        start = time.time()
+        try:
+            response = super(TimeoutSession, self).request(
+                method, url, **kwargs)
+        except requests.RequestException:
+            self.breaker.after_call(probe, False, time.time() - start)
+            raise
+        self.breaker.after_call(
+            probe, response.status_code < 500, time.time() - start)
+        return response
+
+
+class SessionRegistry(object):
+
+    """
+    One pooled Session per service name for the current process
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pid = None
+        self.sessions = {}
+        self.breakers = {}
+
+    def breaker(self, name):
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name)
+            return self.breakers[name]
+
+    def make_session(self, name):
+        session = TimeoutSession(self.breaker(name))
+        adapter = HTTPAdapter(pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                              pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session(self, name):
+        with self.lock:
+            if self.pid != os.getpid():
+                # sockets can't be shared with a forked parent
+                self.pid = os.getpid()
+                self.sessions = {}
+            if name not in self.sessions:
+                self.sessions[name] = self.make_session(name)
+            return self.sessions[name]
+
+    def clear(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+    def stats(self):
+        """
+        Returns {name: {"requests", "connections", "reused"}} for the
+        connection pools of this process
+        """
+        stats = {}
+        with self.lock:
+            sessions = dict(self.sessions) if self.pid == os.getpid() else {}
+        for name, session in sessions.items():
+            requests_made = connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        requests_made += pool.num_requests
+                        connections += pool.num_connections
+            stats[name] = {
+                "requests": requests_made,
+                "connections": connections,
+                "reused": requests_made - connections,
+            }
+        return stats
+
+
+sessions = SessionRegistry()
+
+
+def vumi_sender():
+    return HttpApiSender(
+        api_url=settings.VUMI_API_URL,
+        account_key=settings.VUMI_ACCOUNT_KEY,
+        conversation_key=settings.VUMI_CONVERSATION_KEY,
+        conversation_token=settings.VUMI_ACCOUNT_TOKEN,
+        session=sessions.session("vumi"))
+
+
+def scheduler_api():
+    return SchedulerApiClient(
+        username=settings.SCHEDULER_USERNAME,
+        password=settings.SCHEDULER_PASSWORD,
+        api_url=settings.SCHEDULER_URL,
+        session=sessions.session("scheduler"))
+
+
+def contentstore_api():
+    return ContentStoreApiClient(
+        auth_token=settings.CONTENTSTORE_AUTH_TOKEN,
+        api_url=settings.CONTENTSTORE_API_URL,
+        session=sessions.session("contentstore"))
@@ -0,0 +1,145 @@
+"""
+Metric aggregation for each worker process.
+
+Recording a metric only updates a dict in memory. Values are combined by
+name and aggregation, and published as one send_metrics task once
+METRICS_FLUSH_INTERVAL seconds have passed or METRICS_FLUSH_SIZE values
+have been recorded, so counting a send doesn't cost a broker round trip.
+Each flush also publishes the connection reuse counters of the process's
+HTTP sessions as http.<service>.requests, .connections and .reused.
+"""
+from __future__ import absolute_import
+
+import os
+import threading
+import time
+
+from celery.signals import task_postrun, worker_process_shutdown
+
+from django.conf import settings
+
+AGGREGATES = ("sum", "avg", "max", "min", "last")
+
+
+def publish_metrics(metrics):
+    from mama_ng_control.apps.vumimessages.tasks import send_metrics
+    send_metrics.delay(metrics)
+
+
+def http_gauges():
+    from mama_ng_control.http_clients import sessions
+    return [["http.%s.%s" % (name, counter), value, "last"]
+            for name, counts in sorted(sessions.stats().items())
+            for counter, value in sorted(counts.items())]
+
+
+class MetricsAggregator(object):
+
+    """
+    Thread-safe aggregation of metric values between flushes.
+
+    :param callable publish:
+        Called with a list of [metric, value, agg] on each flush.
+
+    :param callable gauges:
+        Returns more [metric, value, agg] to read and publish on each
+        flush.
+    """
+
+    def __init__(self, publish=publish_metrics, clock=time.time,
+                 gauges=None):
+        self.publish = publish
+        self.clock = clock
+        self.gauges = gauges
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.values = {}
+        self.recorded = 0
+        self.flushed_at = self.clock()
+
+    def record(self, metric, value, agg="sum"):
+        if agg not in AGGREGATES:
+            raise ValueError("Unknown aggregation %r" % (agg,))
+        value = float(value)
+        with self.lock:
+            if self.pid != os.getpid():
+                # the parent flushes its own values
+                self.reset()
+            key = (metric, agg)
+            current = self.values.get(key)
+            if current is None:
+                self.values[key] = [value, 1]
+            elif agg in ("sum", "avg"):
+                current[0] += value
+                current[1] += 1
+            elif agg == "max":
+                current[0] = max(current[0], value)
+            elif agg == "min":
+                current[0] = min(current[0], value)
+            else:
+                current[0] = value
+            self.recorded += 1
+        self.maybe_flush()
+
+    def record_histogram(self, metric, value, buckets):
+        """
+        Records value's average and maximum, and counts it in
+        <metric>.le_<bound> for each bound it doesn't exceed and in
+        <metric>.count
+        """
+        self.record(metric + ".avg", value, "avg")
+        self.record(metric + ".max", value, "max")
+        for bound in buckets:
+            if value <= bound:
+                self.record("%s.le_%s" % (metric, bound), 1, "sum")
+        self.record(metric + ".count", 1, "sum")
+
+    def due(self):
+        return (self.recorded >= settings.METRICS_FLUSH_SIZE or
+                self.clock() - self.flushed_at >=
+                settings.METRICS_FLUSH_INTERVAL)
+
+    def maybe_flush(self):
+        if self.values and self.due():
+            self.flush()
+
+    def take(self):
+        """
+        Returns the aggregated [metric, value, agg] since the last flush
+        and starts again
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            values = self.values
+            self.values = {}
+            self.recorded = 0
+            self.flushed_at = self.clock()
+        return [
+            [metric, total / count if agg == "avg" else total, agg]
+            for (metric, agg), (total, count) in sorted(values.items())]
+
+    def flush(self):
+        metrics = self.take()
+        if metrics and self.gauges is not None:
+            metrics.extend(self.gauges())
+        if metrics:
+            self.publish(metrics)
+        return metrics
+
+
+metrics = MetricsAggregator(gauges=http_gauges)
+
+
+@task_postrun.connect
+def flush_metrics_if_due(**kwargs):
+    # publishes values left from a quiet spell once the next task ends
+    metrics.maybe_flush()
+
+
+@worker_process_shutdown.connect
+def flush_metrics(**kwargs):
+    metrics.flush()
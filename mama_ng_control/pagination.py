@@ -0,0 +1,95 @@
+"""
+Pagination for the API list endpoints.
+
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetOptInPagination(PageNumberPagination):
+
+    """
+    Page number pagination unless the ``cursor`` query parameter is given.
+
+    With ``?cursor=`` (empty for the first page) results are ordered on
+    ``(created_at, id)`` and each page starts after the last row of the
+    previous one, so there is no OFFSET to skip over and no COUNT(*).
+    Follow ``next`` until it is null to walk the whole table.
+
+    Either mode takes ``page_size`` to ask for smaller pages.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super(KeysetOptInPagination, self).paginate_queryset(
+                queryset, request, view=view)
+
+        self._handle_backwards_compat(view)
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(
+            request.query_params[self.cursor_query_param])
+
+        queryset = queryset.order_by('created_at', 'id')
+        if position is not None:
+            table = queryset.model._meta.db_table
+            queryset = queryset.extra(
+                where=['("%s"."created_at", "%s"."id") > (%%s, %%s)' % (
+                    table, table)],
+                params=list(position))
+        results = list(queryset[:page_size + 1])
+        self.has_next = len(results) > page_size
+        self.page = results[:page_size]
+        self.request = request
+        return self.page
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super(KeysetOptInPagination, self).get_paginated_response(
+                data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', None),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(KeysetOptInPagination, self).get_next_link()
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param,
+            self.encode_cursor(last.created_at, last.id))
+
+    def encode_cursor(self, created_at, pk):
+        position = "%s|%s" % (created_at.isoformat(), pk)
+        return urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        """
+        Returns (created_at, id) to start after, or None for the first page
+        """
+        if not encoded:
+            return None
+        try:
+            position = urlsafe_b64decode(encoded.encode('ascii'))
+            created_at, pk = position.decode('ascii').split('|', 1)
+            created_at = parse_datetime(created_at)
+        except (TypeError, ValueError):
+            created_at = None
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
@@ -0,0 +1,127 @@
+"""
+Token bucket rate limiting for calls to throttled services.
+
+Buckets are kept in Redis when SHARED_STATE_REDIS_URL is set, so every
+worker draws from the same allowance, and in-process otherwise or while
+Redis is unreachable.
+"""
+import logging
+import threading
+import time
+
+from redis import RedisError
+
+from django.conf import settings
+
+from mama_ng_control.shared_redis import shared_redis
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] bucket; ARGV rate, capacity, now, tokens requested.
+# Returns the seconds to wait, or "0" when the tokens were taken.
+ACQUIRE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call("HMSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket(object):
+
+    """
+    Allows rate calls a second on average, in bursts of up to capacity.
+
+    :param str key:
+        Redis key of the bucket.
+
+    :param float rate:
+        Tokens added per second. 0 disables the limit.
+
+    :param int capacity:
+        Most tokens the bucket holds.
+
+    :param callable redis:
+        Returns the shared StrictRedis, or None to limit only this
+        process.
+    """
+
+    def __init__(self, key, rate, capacity, redis=shared_redis,
+                 clock=time.time):
+        self.key = key
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.redis = redis
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+        self.updated = None
+
+    def acquire(self, tokens=1):
+        """
+        Takes tokens if they're available. Returns 0 when they were taken,
+        otherwise the seconds until they will be.
+        """
+        if not self.rate:
+            return 0
+        redis = self.redis()
+        if redis is not None:
+            try:
+                return self.shared_acquire(redis, tokens)
+            except RedisError:
+                logger.warning("Shared rate limit unavailable for %s" % (
+                    self.key,), exc_info=True)
+        return self.local_acquire(tokens)
+
+    def shared_acquire(self, redis, tokens):
+        # Workers' clocks are used rather than Redis TIME, which can't be
+        # followed by writes in a script on older Redis versions
+        script = redis.register_script(ACQUIRE_SCRIPT)
+        return float(script(keys=[self.key], args=[
+            self.rate, self.capacity, "%.6f" % self.clock(), tokens]))
+
+    def local_acquire(self, tokens):
+        with self.lock:
+            now = self.clock()
+            if self.updated is not None:
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + max(0, now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / float(self.rate)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def send_limiter(message_type):
+    """
+    Returns the bucket for sends of message_type ("text" or "voice") on
+    the configured Vumi conversation
+    """
+    key = "ratelimit:vumi:%s:%s" % (settings.VUMI_CONVERSATION_KEY,
+                                    message_type)
+    rate = settings.VUMI_SEND_RATES[message_type]
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None or bucket.rate != rate:
+            bucket = _buckets[key] = TokenBucket(
+                key, rate, settings.VUMI_SEND_BURST)
+        return bucket
@@ -0,0 +1,122 @@
+"""
+Cron definitions for the internal scheduling engine.
+
+Understands the five standard fields (minute, hour, day of month, month,
+day of week) with ``*``, lists, ranges and steps, e.g. ``1 6 * * 1,4`` or
+``*/15 8-17 * * *``. Day of week runs 0-6 from Sunday, with 7 also Sunday.
+"""
+from datetime import timedelta
+
+
+class CronError(ValueError):
+
+    """
+    The cron definition could not be parsed.
+    """
+
+
+FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day_of_month", 1, 31),
+    ("month_of_year", 1, 12),
+    ("day_of_week", 0, 7),
+)
+
+
+def parse_field(value, low, high):
+    """
+    Returns the set of values matched by one cron field
+    """
+    matched = set()
+    for part in value.split(","):
+        spec, _, step = part.partition("/")
+        try:
+            step = int(step) if step else 1
+            if spec == "*":
+                start, end = low, high
+            elif "-" in spec:
+                start, end = [int(v) for v in spec.split("-", 1)]
+            else:
+                start = end = int(spec)
+        except ValueError:
+            raise CronError("Invalid cron field <%s>" % value)
+        if step < 1 or start < low or end > high or start > end:
+            raise CronError("Invalid cron field <%s>" % value)
+        if step > 1 and start == end:
+            end = high
+        matched.update(range(start, end + 1, step))
+    return matched
+
+
+class CronSchedule(object):
+
+    """
+    A parsed cron definition.
+
+    :param str definition:
+        The five field cron string, as built by
+        ``Schedule_Create.schedule_to_cron``.
+    """
+
+    def __init__(self, definition):
+        parts = definition.split()
+        if len(parts) != len(FIELDS):
+            raise CronError("Expected %s fields in <%s>" % (
+                len(FIELDS), definition))
+        self.definition = definition
+        (self.minutes, self.hours, self.days, self.months,
+         days_of_week) = [
+            parse_field(part, low, high)
+            for part, (_, low, high) in zip(parts, FIELDS)]
+        self.days_of_week = set(d % 7 for d in days_of_week)
+        # as in cron, a restricted day of month and day of week match either
+        self.any_day = parts[2] == "*"
+        self.any_day_of_week = parts[4] == "*"
+
+    def __repr__(self):
+        return "<CronSchedule %s>" % self.definition
+
+    def matches_day(self, dt):
+        in_month = dt.day in self.days
+        # isoweekday is 1-7 from Monday, cron is 0-6 from Sunday
+        in_week = dt.isoweekday() % 7 in self.days_of_week
+        if self.any_day or self.any_day_of_week:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, dt):
+        """
+        Returns the first matching minute strictly after dt, keeping its
+        tzinfo. Gives up with CronError after roughly five years, e.g. for
+        the 31st of February.
+        """
+        dt = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = dt + timedelta(days=366 * 5)
+        while dt < limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) +
+                      timedelta(days=32)).replace(day=1)
+            elif not self.matches_day(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt
+        raise CronError("No time matches <%s>" % self.definition)
+
+
+_parsed = {}
+
+
+def parse_cron(definition):
+    """
+    Returns the CronSchedule for definition, parsing each distinct
+    definition only once per process
+    """
+    schedule = _parsed.get(definition)
+    if schedule is None:
+        schedule = _parsed[definition] = CronSchedule(definition)
+    return schedule
@@ -49,6 +49,7 @@ INSTALLED_APPS = (
     'mama_ng_control.apps.subscriptions',
     'mama_ng_control.apps.web',
     'mama_ng_control.apps.vumimessages',
+    'mama_ng_control.apps.outbox',
 )
 
 MIDDLEWARE_CLASSES = (
@@ -133,6 +134,33 @@ CELERY_IMPORTS = (
     'mama_ng_control.apps.subscriptions.tasks'
 )
 
+from datetime import timedelta
+
+CELERYBEAT_SCHEDULE = {
+    'relay-outbox': {
+        'task': 'mama_ng_control.apps.outbox.tasks.relay_outbox',
+        'schedule': timedelta(seconds=int(os.environ.get(
+            'MAMA_NG_CONTROL_OUTBOX_RELAY_INTERVAL', 5))),
+    },
+    'sync-message-content': {
+        'task': 'mama_ng_control.apps.subscriptions.tasks.'
+                'sync_message_content',
+        'schedule': timedelta(seconds=int(os.environ.get(
+            'MAMA_NG_CONTROL_CONTENT_SYNC_INTERVAL', 900))),
+    },
+    'refresh-subscription-rollup': {
+        'task': 'mama_ng_control.apps.subscriptions.tasks.'
+                'refresh_subscription_rollup',
+        'schedule': timedelta(seconds=int(os.environ.get(
+            'MAMA_NG_CONTROL_SUBSCRIPTION_ROLLUP_INTERVAL', 300))),
+    },
+    'process-events': {
+        'task': 'mama_ng_control.apps.vumimessages.tasks.process_events',
+        'schedule': timedelta(seconds=int(os.environ.get(
+            'MAMA_NG_CONTROL_VUMI_EVENTS_INTERVAL', 5))),
+    },
+}
+
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
@@ -161,6 +189,8 @@ RAVEN_CONFIG = {
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAdminUser',),
     'PAGINATE_BY': 500,
+    'DEFAULT_PAGINATION_CLASS':
+        'mama_ng_control.pagination.KeysetOptInPagination',
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.TokenAuthentication',
@@ -192,6 +222,16 @@ VUMI_CONVERSATION_KEY = \
     os.environ.get('MAMA_NG_CONTROL_VUMI_CONVERSATION_KEY', 'conv-key')
 VUMI_ACCOUNT_TOKEN = \
     os.environ.get('MAMA_NG_CONTROL_VUMI_ACCOUNT_TOKEN', 'conv-token')
+# store events and apply them in batches with the process_events task
+VUMI_EVENTS_FAST_ACCEPT = \
+    os.environ.get('MAMA_NG_CONTROL_VUMI_EVENTS_FAST_ACCEPT',
+                   'false').lower() == 'true'
+VUMI_EVENTS_BATCH_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_EVENTS_BATCH_SIZE', 1000))
+VUMI_EVENTS_MAX_BATCHES = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_EVENTS_MAX_BATCHES', 20))
+VUMI_EVENTS_BATCH_LIMIT = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_EVENTS_BATCH_LIMIT', 5000))
 
 CONTENTSTORE_AUTH_TOKEN = \
     os.environ.get('MAMA_NG_CONTROL_CONTENTSTORE_AUTH_TOKEN', 'auth-token')
@@ -199,11 +239,113 @@ CONTENTSTORE_API_URL = \
     os.environ.get('MAMA_NG_CONTROL_CONTENTSTORE_API_URL',
                    'http://example.com/contentstore/')
 
+SUBSCRIPTION_SEND_BATCH_LIMIT = \
+    int(os.environ.get('MAMA_NG_CONTROL_SUBSCRIPTION_SEND_BATCH_LIMIT', 5000))
+SUBSCRIPTION_SEND_BATCH_CHUNK_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_SUBSCRIPTION_SEND_BATCH_CHUNK_SIZE',
+                       100))
+SUBSCRIPTION_BULK_CREATE_LIMIT = \
+    int(os.environ.get('MAMA_NG_CONTROL_SUBSCRIPTION_BULK_CREATE_LIMIT', 5000))
+SUBSCRIPTION_IMPORT_CHUNK_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_SUBSCRIPTION_IMPORT_CHUNK_SIZE', 1000))
+SUBSCRIPTION_BULK_SCHEDULE_CHUNK_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_SUBSCRIPTION_BULK_SCHEDULE_CHUNK_SIZE',
+                       500))
+
+CONTENTSTORE_CACHE_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_CONTENTSTORE_CACHE_SIZE', 1000))
+CONTENTSTORE_CACHE_LOCAL_TTL = \
+    int(os.environ.get('MAMA_NG_CONTROL_CONTENTSTORE_CACHE_LOCAL_TTL', 300))
+CONTENTSTORE_CACHE_SHARED_TTL = \
+    int(os.environ.get('MAMA_NG_CONTROL_CONTENTSTORE_CACHE_SHARED_TTL', 3600))
+
+# Redis for state shared between workers, e.g. the content cache.
+# Set to an empty string to keep that state per process.
+SHARED_STATE_REDIS_URL = \
+    os.environ.get('MAMA_NG_CONTROL_SHARED_STATE_REDIS_URL',
+                   'redis://%s:%s/1' % (
+                       os.environ.get('MAMA_NG_CONTROL_REDIS_SERVICE',
+                                      '127.0.0.1'),
+                       os.environ.get('MAMA_NG_CONTROL_REDIS_PORT', '6379')))
+SHARED_STATE_REDIS_TIMEOUT = \
+    float(os.environ.get('MAMA_NG_CONTROL_SHARED_STATE_REDIS_TIMEOUT', 0.5))
+
+# Sends a second allowed per message type on the Vumi conversation, shared
+# by all workers through SHARED_STATE_REDIS_URL. 0 means unlimited.
+VUMI_SEND_RATES = {
+    'text': float(os.environ.get('MAMA_NG_CONTROL_VUMI_SEND_RATE_TEXT', 0)),
+    'voice': float(os.environ.get('MAMA_NG_CONTROL_VUMI_SEND_RATE_VOICE', 0)),
+}
+VUMI_SEND_BURST = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_SEND_BURST', 10))
+# "single" queues a send_message task per new outbound, "batch" leaves
+# them for the send_outbounds task to send concurrently
+VUMI_SEND_MODE = \
+    os.environ.get('MAMA_NG_CONTROL_VUMI_SEND_MODE', 'single')
+VUMI_SEND_BATCH_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_SEND_BATCH_SIZE', 200))
+VUMI_SEND_MAX_BATCHES = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_SEND_MAX_BATCHES', 50))
+VUMI_SEND_CONCURRENCY = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_SEND_CONCURRENCY', 20))
+# seconds a claimed batch is kept from other senders, which should cover
+# sending the whole batch. Messages whose results weren't recorded by
+# then are sent again.
+VUMI_SEND_LEASE = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_SEND_LEASE', 600))
+# failed sends and nacked messages are retried after a backoff, doubling
+# from the base up to the cap, until their budget runs out. Messages that
+# run out go to the dead letter table.
+VUMI_RETRY_BACKOFF_BASE = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_RETRY_BACKOFF_BASE', 30))
+VUMI_RETRY_BACKOFF_CAP = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_RETRY_BACKOFF_CAP', 3600))
+VUMI_HTTP_RETRY_BUDGET = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_HTTP_RETRY_BUDGET', 8))
+VUMI_NACK_RETRY_BUDGET = \
+    int(os.environ.get('MAMA_NG_CONTROL_VUMI_NACK_RETRY_BUDGET', 3))
+
+if VUMI_SEND_MODE == 'batch':
+    CELERYBEAT_SCHEDULE['send-outbounds'] = {
+        'task': 'mama_ng_control.apps.vumimessages.tasks.send_outbounds',
+        'schedule': timedelta(seconds=int(os.environ.get(
+            'MAMA_NG_CONTROL_VUMI_SEND_INTERVAL', 10))),
+    }
+
+# metrics are aggregated in each worker process and published together
+# every interval seconds or once this many values have been recorded
+METRICS_FLUSH_INTERVAL = \
+    int(os.environ.get('MAMA_NG_CONTROL_METRICS_FLUSH_INTERVAL', 10))
+METRICS_FLUSH_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_METRICS_FLUSH_SIZE', 1000))
+# upper bounds in seconds of the message latency histogram buckets
+LATENCY_BUCKETS = [
+    int(bound) for bound in os.environ.get(
+        'MAMA_NG_CONTROL_LATENCY_BUCKETS',
+        '1,5,15,60,300,900,3600,14400').split(',')]
+
 MAMA_NG_CONTROL_MAX_RETRIES = \
     os.environ.get('MAMA_NG_CONTROL_MAX_RETRIES', 3)
 MAMA_NG_CONTROL_MAX_FAILURES = \
     os.environ.get('MAMA_NG_CONTROL_MAX_FAILURES', 5)
 
+# Outbox messages are relayed immediately when written outside a
+# transaction, otherwise by the relay_outbox task or command
+OUTBOX_ALWAYS_RELAY = False
+OUTBOX_RELAY_BATCH_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_OUTBOX_RELAY_BATCH_SIZE', 500))
+OUTBOX_RELAY_MAX_BATCHES = \
+    int(os.environ.get('MAMA_NG_CONTROL_OUTBOX_RELAY_MAX_BATCHES', 20))
+
+CONTACT_BULK_SEARCH_LIMIT = \
+    int(os.environ.get('MAMA_NG_CONTROL_CONTACT_BULK_SEARCH_LIMIT', 5000))
+CONTACT_ADDRESS_CACHE_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_CONTACT_ADDRESS_CACHE_SIZE', 10000))
+CONTACT_IMPORT_CHUNK_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_CONTACT_IMPORT_CHUNK_SIZE', 1000))
+CONTACT_IMPORT_MAX_ERRORS = \
+    int(os.environ.get('MAMA_NG_CONTROL_CONTACT_IMPORT_MAX_ERRORS', 1000))
+
 SCHEDULER_URL = \
     os.environ.get('MAMA_NG_CONTROL_SCHEDULER_URL',
                    'http://example.com/mama-ng-scheduler/rest/')
@@ -213,7 +355,54 @@ SCHEDULER_USERNAME = \
 SCHEDULER_PASSWORD = \
     os.environ.get('MAMA_NG_CONTROL_SCHEDULER_PASSWORD',
                    'sc-password')
+# "external" creates schedules on the scheduler service, "internal" stores
+# next_send_at on each subscription for the dispatch_subscriptions task
+SCHEDULER_ENGINE = \
+    os.environ.get('MAMA_NG_CONTROL_SCHEDULER_ENGINE', 'external')
+# concurrent scheduler calls made by schedule_create_bulk
+SCHEDULER_CONCURRENCY = \
+    int(os.environ.get('MAMA_NG_CONTROL_SCHEDULER_CONCURRENCY', 10))
+SUBSCRIPTION_DISPATCH_BATCH_SIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_SUBSCRIPTION_DISPATCH_BATCH_SIZE',
+                       500))
+SUBSCRIPTION_DISPATCH_MAX_BATCHES = \
+    int(os.environ.get('MAMA_NG_CONTROL_SUBSCRIPTION_DISPATCH_MAX_BATCHES',
+                       20))
+
+if SCHEDULER_ENGINE == 'internal':
+    CELERYBEAT_SCHEDULE['dispatch-subscriptions'] = {
+        'task': 'mama_ng_control.apps.subscriptions.tasks.'
+                'dispatch_subscriptions',
+        'schedule': timedelta(seconds=int(os.environ.get(
+            'MAMA_NG_CONTROL_SUBSCRIPTION_DISPATCH_INTERVAL', 60))),
+    }
 
 CONTROL_URL = \
     os.environ.get('MAMA_NG_CONTROL_URL',
                    'http://examplecontrol.com/api/v1')
+
+# pooled sessions for the Vumi, scheduler and content store clients
+HTTP_POOL_CONNECTIONS = \
+    int(os.environ.get('MAMA_NG_CONTROL_HTTP_POOL_CONNECTIONS', 10))
+HTTP_POOL_MAXSIZE = \
+    int(os.environ.get('MAMA_NG_CONTROL_HTTP_POOL_MAXSIZE', 20))
+HTTP_CONNECT_TIMEOUT = \
+    float(os.environ.get('MAMA_NG_CONTROL_HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = \
+    float(os.environ.get('MAMA_NG_CONTROL_HTTP_READ_TIMEOUT', 30))
+
+# breakers open for CIRCUIT_BREAKER_OPEN_SECONDS once, within a window of
+# CIRCUIT_BREAKER_WINDOW seconds and at least CIRCUIT_BREAKER_MIN_CALLS
+# calls, the share of failed or of slow calls reaches its rate
+CIRCUIT_BREAKER_WINDOW = \
+    int(os.environ.get('MAMA_NG_CONTROL_CIRCUIT_BREAKER_WINDOW', 30))
+CIRCUIT_BREAKER_MIN_CALLS = \
+    int(os.environ.get('MAMA_NG_CONTROL_CIRCUIT_BREAKER_MIN_CALLS', 20))
+CIRCUIT_BREAKER_ERROR_RATE = \
+    float(os.environ.get('MAMA_NG_CONTROL_CIRCUIT_BREAKER_ERROR_RATE', 0.5))
+CIRCUIT_BREAKER_SLOW_CALL = \
+    float(os.environ.get('MAMA_NG_CONTROL_CIRCUIT_BREAKER_SLOW_CALL', 10))
+CIRCUIT_BREAKER_SLOW_RATE = \
+    float(os.environ.get('MAMA_NG_CONTROL_CIRCUIT_BREAKER_SLOW_RATE', 0.8))
+CIRCUIT_BREAKER_OPEN_SECONDS = \
+    int(os.environ.get('MAMA_NG_CONTROL_CIRCUIT_BREAKER_OPEN_SECONDS', 30))
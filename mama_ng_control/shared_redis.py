@@ -0,0 +1,28 @@
+"""
+Redis connection for state shared between worker processes.
+
+"""
+import os
+
+import redis
+
+from django.conf import settings
+
+_connection = {}
+
+
+def shared_redis():
+    """
+    Returns this process's StrictRedis for SHARED_STATE_REDIS_URL, or None
+    when no URL is configured and callers should keep state in-process
+    """
+    if not settings.SHARED_STATE_REDIS_URL:
+        return None
+    pid = os.getpid()
+    if _connection.get("pid") != pid:
+        # connections can't be shared with a forked parent
+        _connection["pid"] = pid
+        _connection["redis"] = redis.StrictRedis.from_url(
+            settings.SHARED_STATE_REDIS_URL,
+            socket_timeout=settings.SHARED_STATE_REDIS_TIMEOUT)
+    return _connection["redis"]
@@ -30,6 +30,14 @@ SCHEDULER_URL = 'http://127.0.0.1:8000/mama-ng-scheduler/rest/'
 SCHEDULER_USERNAME = 'sc-username'
 SCHEDULER_PASSWORD = 'sc-password'
 
+SHARED_STATE_REDIS_URL = ''
+
+# Keep failures mocked in one test from opening breakers for the next
+CIRCUIT_BREAKER_MIN_CALLS = 1000000
+
 CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
 CELERY_ALWAYS_EAGER = True
 BROKER_BACKEND = 'memory'
+
+# Tests run inside a transaction, so relay outbox messages as they're written
+OUTBOX_ALWAYS_RELAY = True